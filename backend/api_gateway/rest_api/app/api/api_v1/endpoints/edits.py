@@ -38,14 +38,13 @@ async def get_edit(
            detail="Shot Locker bucket not found"
         )
 
-    if not shotlocker.edit.is_shot_locker_bucket_edit_valid(locker, edit):
+    edit = shotlocker.edit.resolve_edit(locker, edit)
+    if not edit:
         raise HTTPException(
            status_code=404,
            detail="Shot Locker edit not found"
         )
 
-    edit = shotlocker.edit.get_shot_locker_bucket_edit_info(locker, edit)
-
     return edit
 
 
@@ -115,13 +114,14 @@ async def enable_locker(
            detail="Shot Locker bucket not found"
         )
 
-    if not shotlocker.edit.is_shot_locker_bucket_edit_valid(locker, edit):
+    edit_info = shotlocker.edit.resolve_edit(locker, edit, as_s3_uri=False)
+    if not edit_info:
         raise HTTPException(
            status_code=404,
            detail="Shot Locker edit not found"
         )
 
-    if not shotlocker.edit.set_shot_locker_bucket_edit(locker, edit, enable=True):
+    if not shotlocker.edit.set_shot_locker_bucket_edit(locker, edit, enable=True, edit_info=edit_info):
         raise HTTPException(
            status_code=500,
            detail="Shot Locker edit unable to enable"
@@ -129,8 +129,8 @@ async def enable_locker(
     
     shotlocker.log.log_entry(edit, f"Edit ({edit}) is enabled")
 
-    edit = shotlocker.edit.get_shot_locker_bucket_edit_info(locker, edit)
-    return {"edit": edit}
+    edit_info['active'] = True
+    return {"edit": shotlocker.edit.get_edit_info_as_s3_uri(locker, edit_info)}
 
 
 @router.put("/lockers/{locker}/edits/{edit}/disable")
@@ -144,13 +144,14 @@ async def disable_locker(
            detail="Shot Locker bucket not found"
         )
 
-    if not shotlocker.edit.is_shot_locker_bucket_edit_valid(locker, edit):
+    edit_info = shotlocker.edit.resolve_edit(locker, edit, as_s3_uri=False)
+    if not edit_info:
         raise HTTPException(
            status_code=404,
            detail="Shot Locker edit not found"
         )
 
-    if not shotlocker.edit.set_shot_locker_bucket_edit(locker, edit, enable=False):
+    if not shotlocker.edit.set_shot_locker_bucket_edit(locker, edit, enable=False, edit_info=edit_info):
         raise HTTPException(
            status_code=500,
            detail="Shot Locker edit unable to disable"
@@ -158,5 +159,5 @@ async def disable_locker(
 
     shotlocker.log.log_entry(edit, f"Edit ({edit}) is disabled")
 
-    edit = shotlocker.edit.get_shot_locker_bucket_edit_info(locker, edit)
-    return {"edit": edit}
+    edit_info['active'] = False
+    return {"edit": shotlocker.edit.get_edit_info_as_s3_uri(locker, edit_info)}
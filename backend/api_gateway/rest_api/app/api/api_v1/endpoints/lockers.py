@@ -34,41 +34,27 @@ async def get_lockers(
 async def get_locker(    
     locker: str,
 ) -> Any:
-    buckets = (shotlocker.bucket.get_shot_locker_bucket_list() +
-               shotlocker.bucket.get_shot_locker_available_bucket_list())
+    state = shotlocker.bucket.get_locker_state(locker)
 
-    locker_info = None
-    for b in buckets:
-        if b['name'] == locker:
-            locker_info = {
-                'name': b['name'],
-                'active': b['active'],
-            }
-
-    if not locker_info:
+    if not state or not (state['locker'] or state['available']):
         raise HTTPException(
            status_code=404,
            detail="Bucket not found"
         )
     
-    return {"locker": locker_info}
+    return {"locker": {
+        'name': state['name'],
+        'active': state['active'],
+    }}
 
 
 @router.put("/lockers/{locker}/enable")
 async def enable_locker(    
     locker: str,
 ) -> Any:
-    buckets = shotlocker.bucket.get_shot_locker_available_bucket_list()
-
-    locker_info = None
-    for b in buckets:
-        if b['name'] == locker:
-            locker_info = {
-                'name': b['name'],
-                'active': True
-            }
+    state = shotlocker.bucket.get_locker_state(locker)
 
-    if not locker_info:
+    if not state or not state['available']:
         raise HTTPException(
            status_code=404,
            detail="Bucket not found"
@@ -80,24 +66,19 @@ async def enable_locker(
            detail="Bucket not disabled"
         )
 
-    return {"locker": locker_info}
+    return {"locker": {
+        'name': state['name'],
+        'active': True
+    }}
 
 
 @router.put("/lockers/{locker}/disable")
 async def disable_locker(    
     locker: str,
 ) -> Any:
-    buckets = shotlocker.bucket.get_shot_locker_bucket_list()
+    state = shotlocker.bucket.get_locker_state(locker)
 
-    locker_info = None
-    for b in buckets:
-        if b['name'] == locker:
-            locker_info = {
-                'name': b['name'],
-                'active': False
-            }
-
-    if not locker_info:
+    if not state or not state['locker']:
         raise HTTPException(
            status_code=404,
            detail="Bucket not found"
@@ -109,5 +90,7 @@ async def disable_locker(
            detail="Bucket not disabled"
         )
 
-    return {"locker": locker_info}
-
+    return {"locker": {
+        'name': state['name'],
+        'active': False
+    }}
@@ -3,7 +3,7 @@
 
 import os
 import re
-import boto3
+import shotlocker
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -16,7 +16,7 @@ def get_origins():
 
     try:
         # Amazon Cloudfront CDN domain
-        ssm_client = boto3.client("ssm")
+        ssm_client = shotlocker.clients.get_client("ssm")
         response = ssm_client.get_parameter(Name=f"/ShotLocker/Config/CdnDomainUrl")
         origins.append(response['Parameter']['Value'])
 
@@ -0,0 +1,48 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Replay a local json feed of S3 events against the content lake index, e.g.
+
+    PYTHONPATH=backend/core/shotlocker python backend/content_index/replay-event-feed.py \
+        backend/content_index/sample-event-feed.json --dry-run
+
+The feed is an S3 event notification, an SQS batch of them, an EventBridge S3
+event or a list of any of these. --dry-run prints the change of each object the
+feed coalesces to without AWS access, otherwise the changes are applied to the
+content index of each bucket with the local AWS credentials.
+"""
+
+import sys
+import json
+import argparse
+
+import shotlocker
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay a json feed of S3 events against the content lake index')
+    parser.add_argument('feed', help='json file of S3 events')
+    parser.add_argument('--dry-run', action='store_true', help='print the coalesced changes, the index is not updated')
+    parser.add_argument('--lock-wait', type=float, default=30, help='seconds to wait for a locked index')
+    args = parser.parse_args(argv)
+
+    records = shotlocker.content_index.load_s3_event_records(args.feed)
+    changes = shotlocker.content_index.coalesce_s3_event_records(records)
+
+    print(f'{len(records)} S3 event records, {sum(len(c) for c in changes.values())} object changes')
+
+    if args.dry_run:
+        for bucket, bucket_changes in sorted(changes.items()):
+            for key, (created, event_time) in sorted(bucket_changes.items()):
+                print(f"{event_time} {'add' if created else 'remove'} s3://{bucket}/{key}")
+        return 0
+
+    summary = shotlocker.content_index.update_content_index_from_records(records, lock_wait=args.lock_wait)
+    print(json.dumps(summary, indent=2))
+
+    return 1 if any('deferred' in s for s in summary.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
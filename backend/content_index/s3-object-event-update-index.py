@@ -0,0 +1,35 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import shotlocker
+from shotlocker.cwprint import cwprint_exc
+
+
+s3_client = shotlocker.clients.get_client('s3')
+
+
+def lambda_handler(event, context):
+
+    # S3 object created and deleted events arrive in batches from the queue,
+    # a burst of events is applied with a single write of each bucket index
+    records = shotlocker.content_index.get_s3_event_records(event)
+
+    print(f"ShotLocker Content Index: {len(records)} S3 event records")
+
+    try:
+        summary = shotlocker.content_index.update_content_index_from_records(records, s3_client=s3_client)
+    except Exception as e:
+        cwprint_exc('Error updating the content lake index')
+        raise
+
+    # the messages of buckets whose index is locked (e.g. being built) are left in
+    # the queue and delivered again once their visibility timeout expires
+    deferred = {bucket for bucket, changes in summary.items() if 'deferred' in changes}
+    message_buckets = shotlocker.content_index.get_sqs_message_buckets(event)
+    failures = [{'itemIdentifier': message_id} 
+                for message_id, buckets in message_buckets.items() if buckets & deferred]
+
+    if failures:
+        print(f"ShotLocker Content Index: {len(failures)} messages deferred for buckets {', '.join(sorted(deferred))}")
+
+    return {'batchItemFailures': failures}
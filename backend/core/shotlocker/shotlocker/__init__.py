@@ -1,14 +1,24 @@
 
 from . import bucket
 from . import bucket_policy
+from . import catalog
+from . import checkpoint
+from . import clients
+from . import concurrency
+from . import content_index
 from . import edit
 from . import frame_range
 from . import log
+from . import media_match
 from . import object_tag
 from . import otio
+from . import registry
 from . import s3_utils
 from . import stepfn
+from . import tag_shards
 from . import token
+from . import token_index
+from . import work_queue
 
 
 __version__ = "1.0"
@@ -3,94 +3,138 @@
 
 import os
 import json
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from .cwprint import cwprint, cwprint_exc
 from . import s3_utils
 from . import stepfn
-import boto3
+from . import clients
+from . import concurrency
+from . import edit
+from . import object_tag
+from . import bucket_policy
+from . import registry
+from . import content_index
 from botocore.exceptions import ClientError
 
 
-def get_shot_locker_bucket_list(*, s3_client=None, include_inactive=True):
+# buckets with these name prefixes are not offered as lockers
+SKIP_BUCKET_PREFIXES = ('cloudtrail-', 
+                        'sagemaker-', 
+                        'kendra-', 
+                        'do-not-delete-', 
+                        'cf-templates-', 
+                        'aws-', 
+                        'amplify-', 
+                        'cdk-', 
+                        'cloudfront', 
+                        'shotlocker-stack-')
+
+
+@functools.lru_cache(maxsize=4096)
+def is_skipped_bucket_name(bucket_name) -> bool:
+    return bucket_name.startswith(SKIP_BUCKET_PREFIXES)
+
+
+def get_locker_state(bucket_name, *, s3_client=None):
     """
-    @returns list of shotlocker buckets
+    State of one bucket from its tags, a single get_bucket_tagging request
+    @returns {'name', 'tags', 'locker', 'active', 'available'} or None when the
+    bucket does not exist or can not be read. locker is set for active and inactive
+    Shot Locker buckets, available for buckets that can be enabled as a locker.
     """
-    sl_buckets = []
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    try:
+        tag_set = s3_client.get_bucket_tagging(Bucket=bucket_name)['TagSet']
+    except ClientError as e:
+        # a bucket without tags has no tag set
+        if e.response['Error']['Code'] != 'NoSuchTagSet':
+            return None
+        tag_set = []
 
+    return _get_locker_state_from_tags(bucket_name, tag_set)
+
+
+def scan_bucket_locker_states(*, s3_client=None, max_workers=clients.MAX_WORKERS):
+    """
+    State of every bucket in the account, the bucket tags are read concurrently
+    @returns list of get_locker_state results in the list_buckets order
+    """
     if not s3_client:
-        s3_client = boto3.client('s3')
-    
+        s3_client = clients.get_client('s3')
+
     buckets = s3_client.list_buckets()['Buckets']
 
-    enabled_tag_values = s3_utils.get_enabled_tag_value_list()
+    # lockers whose bucket was deleted are removed from the registry
+    try:
+        pruned = registry.prune_lockers([bucket['Name'] for bucket in buckets])
+        if pruned:
+            cwprint(f"scan_bucket_locker_states: unregistered deleted lockers {', '.join(pruned)}")
+    except:
+        cwprint_exc('scan_bucket_locker_states: unable to prune the locker registry')
 
-    # list all of the buckets with ShotLocker tag
-    for bucket in buckets:
-        bucket_name = bucket['Name']
-        try:
-            tag_set = s3_client.get_bucket_tagging(Bucket=bucket_name)['TagSet']
-        except:
-            tag_set = []
+    def _get_state(bucket):
+        # listed buckets that can not be read are handled as buckets without tags
+        return (get_locker_state(bucket['Name'], s3_client=s3_client) 
+                or _get_locker_state_from_tags(bucket['Name'], []))
 
-        for tag in tag_set:
-            if tag['Key'] == 'ShotLocker':
-                if include_inactive or (not include_inactive and tag['Value'] in enabled_tag_values):
-                    sl_buckets.append({
-                        'name': bucket_name, 
-                        'tags': tag_set,
-                        'active': tag['Value'] in enabled_tag_values
-                    })
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_get_state, buckets))
 
-    return sl_buckets
 
+def _get_locker_state_from_tags(bucket_name, tag_set):
+    locker = False
+    active = False
+    for tag in tag_set:
+        if tag['Key'] == 'ShotLocker':
+            locker = True
+            active = tag['Value'] in s3_utils.get_enabled_tag_value_list()
+
+    return {
+        'name': bucket_name,
+        'tags': tag_set,
+        'locker': locker,
+        'active': active,
+        'available': not active and not is_skipped_bucket_name(bucket_name),
+    }
 
-def get_shot_locker_available_bucket_list(*, s3_client=None):
+
+def get_shot_locker_bucket_list(*, s3_client=None, include_inactive=True, bucket_states=None):
     """
-    @returns list of buckets available to be used for Shot Locker
+    @returns list of shotlocker buckets
+    bucket_states is a scan_bucket_locker_states result to reuse, the buckets are scanned without it
     """
-    avail_buckets = []
-
-    if not s3_client:
-        s3_client = boto3.client('s3')
-    
-    buckets = s3_client.list_buckets()['Buckets']
+    if bucket_states is None:
+        bucket_states = scan_bucket_locker_states(s3_client=s3_client)
 
-    enabled_tag_values = s3_utils.get_enabled_tag_value_list()
+    sl_buckets = []
+    for state in bucket_states:
+        if state['locker'] and (include_inactive or state['active']):
+            sl_buckets.append({
+                'name': state['name'], 
+                'tags': state['tags'],
+                'active': state['active']
+            })
 
-    # skip buckets with a starting name prefix
-    skip_prefix = ('cloudtrail-', 
-                   'sagemaker-', 
-                   'kendra-', 
-                   'do-not-delete-', 
-                   'cf-templates-', 
-                   'aws-', 
-                   'amplify-', 
-                   'cdk-', 
-                   'cloudfront', 
-                   'shotlocker-stack-')
+    return sl_buckets
 
-    # list all of the buckets with ShotLocker tag
-    for bucket in buckets:
-        bucket_name = bucket['Name']
 
-        if bucket_name.startswith(skip_prefix):
-            continue
+def get_shot_locker_available_bucket_list(*, s3_client=None, bucket_states=None):
+    """
+    @returns list of buckets available to be used for Shot Locker
+    bucket_states is a scan_bucket_locker_states result to reuse, the buckets are scanned without it
+    """
+    if bucket_states is None:
+        bucket_states = scan_bucket_locker_states(s3_client=s3_client)
 
-        is_shot_locker_bucket = False
-        tag_set = []
-        try:
-            # if there are no tagsets set on the bucket, will throw exception
-            tag_set = s3_client.get_bucket_tagging(Bucket=bucket_name)['TagSet']
-            for tag in tag_set:
-                if tag['Key'] == 'ShotLocker' and tag['Value'] in enabled_tag_values:
-                    is_shot_locker_bucket = True
-            
-        except ClientError as e:
-            pass
-
-        if not is_shot_locker_bucket:
+    avail_buckets = []
+    for state in bucket_states:
+        if state['available']:
             avail_buckets.append({
-                'name': bucket_name, 
-                'tags': tag_set,
+                'name': state['name'], 
+                'tags': state['tags'],
                 'active': False,
             })
 
@@ -111,7 +155,7 @@ def set_shot_locker_bucket(
     success = False
 
     if not s3_client:
-        s3_client = boto3.client('s3')
+        s3_client = clients.get_client('s3')
 
     # notify event lambda
     if enable:
@@ -143,12 +187,23 @@ def set_shot_locker_bucket(
     except:
         cwprint_exc()
 
+    # write through the locker registry, it only holds active lockers
+    if success:
+        try:
+            if enable:
+                registry.set_locker(bucket_name, True)
+            else:
+                registry.delete_locker(bucket_name)
+        except:
+            cwprint_exc()
+            success = False
+
     if not enable and start_stepfn_execution:
         # call step function to complete edit activation
         stepfn_name = stepfn.get_stepfn_arn(None, "BucketDisableArn")
 
         try:
-            sfn_client = boto3.client('stepfunctions')
+            sfn_client = clients.get_client('stepfunctions')
             response = sfn_client.start_execution(
                 stateMachineArn=stepfn_name,
                 input=json.dumps({
@@ -164,13 +219,36 @@ def set_shot_locker_bucket(
 
 
 def is_shot_locker_bucket_valid(bucket_name, *, s3_client=None):
-    buckets = get_shot_locker_bucket_list(s3_client=s3_client)
-    return any([bucket_name == b['name'] for b in buckets])
+    """ @returns True for an active or inactive Shot Locker bucket """
+    try:
+        if registry.get_locker(bucket_name) is not None:
+            return True
+    except:
+        # the bucket tags are checked when the registry can not be read
+        cwprint_exc(f'is_shot_locker_bucket_valid: unable to read the registry of bucket {bucket_name}')
+
+    state = get_locker_state(bucket_name, s3_client=s3_client)
+    if not state or not state['locker']:
+        return False
+
+    # active lockers set before the registry existed are registered on their first
+    # check and send the object events their content index is updated from
+    if state['active']:
+        try:
+            registry.set_locker(bucket_name, True)
+        except:
+            cwprint_exc(f'is_shot_locker_bucket_valid: unable to register bucket {bucket_name}')
+        try:
+            content_index.enable_object_event_notifications(bucket_name, s3_client=s3_client)
+        except:
+            cwprint_exc(f'is_shot_locker_bucket_valid: unable to enable the object events of bucket {bucket_name}')
+
+    return True
 
 
 def _add_bucket_upload_notification(bucket_name, *, s3_client=None):
     if not s3_client:
-        s3_client = boto3.client('s3')
+        s3_client = clients.get_client('s3')
 
     config = s3_client.get_bucket_notification_configuration(Bucket=bucket_name)
 
@@ -180,6 +258,10 @@ def _add_bucket_upload_notification(bucket_name, *, s3_client=None):
     if 'LambdaFunctionConfigurations' not in config or not isinstance(config['LambdaFunctionConfigurations'], list):
         config['LambdaFunctionConfigurations'] = []
 
+    # object created and deleted events keep the content lake index up to date
+    changed = 'EventBridgeConfiguration' not in config
+    config['EventBridgeConfiguration'] = {}
+
     found = False
     for lfc in config['LambdaFunctionConfigurations']:
         if 'LambdaFunctionArn' in lfc:
@@ -187,8 +269,9 @@ def _add_bucket_upload_notification(bucket_name, *, s3_client=None):
                 found = True
 
     if not found:
-        account_id = boto3.client('sts').get_caller_identity()["Account"]
-        aws_partition = os.environ.get('AWS_PARTITION')
+        changed = True
+        account_id = clients.get_account_id()
+        aws_partition = clients.get_partition()
         aws_region = os.environ.get('AWS_REGION')
         arn = f'arn:{aws_partition}:lambda:{aws_region}:{account_id}:function:ShotLocker-Upload-Edit'
 
@@ -208,6 +291,7 @@ def _add_bucket_upload_notification(bucket_name, *, s3_client=None):
 
             config['LambdaFunctionConfigurations'].append(notify)
 
+    if changed:
         cwprint({"description": "ShotLocker add_bucket_upload_notification",
                 "bucket": bucket_name, 
                 "put_bucket_notification_configuration": config,
@@ -218,7 +302,7 @@ def _add_bucket_upload_notification(bucket_name, *, s3_client=None):
 
 def _remove_bucket_upload_notification(bucket_name, *, s3_client=None):
     if not s3_client:
-        s3_client = boto3.client('s3')
+        s3_client = clients.get_client('s3')
 
     config = s3_client.get_bucket_notification_configuration(Bucket=bucket_name)
 
@@ -242,3 +326,56 @@ def _remove_bucket_upload_notification(bucket_name, *, s3_client=None):
             })
 
     s3_client.put_bucket_notification_configuration(Bucket=bucket_name, NotificationConfiguration=config)
+
+
+def migrate_shot_locker_bucket_access_tags(
+    bucket_name, 
+    *, 
+    s3_client=None, 
+    tag_s3_client=None, 
+    stop_fn=None, 
+    start_after=None, 
+    drop_legacy=True
+):
+    """
+    Migrate a bucket tagged when every access token was stored in ShotLockerAccess:
+    the bucket policy grants on both tags, the tagged objects after start_after are
+    re-tagged and, with drop_legacy, the legacy policy statements are dropped once
+    every object is migrated. Running it again continues an interrupted migration,
+    summary.last_key is the start_after to continue from. tag_s3_client makes the
+    tag requests paced by the concurrency controller, defaults to s3_client.
+    @returns work_queue.WorkSummary of the objects
+    """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    # the policy is updated first so access holds for the objects already re-tagged
+    policy = bucket_policy.get_shot_locker_bucket_policy_as_json(bucket_name, s3_client=s3_client)
+    policy = bucket_policy.migrate_shot_locker_bucket_policy(bucket_name, 
+                                                            policy, 
+                                                            keep_legacy=True, 
+                                                            s3_client=s3_client)
+
+    keys = edit.get_shot_locker_tagged_keys(bucket_name, s3_client=s3_client)
+    if keys is None:
+        cwprint(f'shotlocker.bucket.migrate_shot_locker_bucket_access_tags: listing every object in {bucket_name}')
+        keys = s3_utils.iter_objects(bucket_name, s3_client=s3_client, recursive=True, parallel=True, start_after=start_after)
+    elif start_after:
+        keys = [key for key in keys if key > start_after]
+
+    summary = object_tag.migrate_shot_locker_access_tags((f's3://{bucket_name}/{key}' for key in keys), 
+                                                         s3_client=tag_s3_client or s3_client,
+                                                         concurrency=concurrency.AdaptiveConcurrency(),
+                                                         stop_fn=stop_fn)
+    if summary.last_key:
+        summary.last_key = s3_utils.get_bucket_key_from_s3_uri(summary.last_key)[1]
+
+    if drop_legacy and not summary.failed and not summary.stopped:
+        bucket_policy.migrate_shot_locker_bucket_policy(bucket_name, 
+                                                        policy, 
+                                                        keep_legacy=False, 
+                                                        s3_client=s3_client)
+        # users added from now on are only granted on the hashed tag
+        bucket_policy.set_bucket_access_tags_migrated(bucket_name, s3_client=s3_client)
+
+    return summary
@@ -2,7 +2,9 @@
 # SPDX-License-Identifier: MIT-0
 
 import json
-import boto3
+from . import clients
+from . import object_tag
+from . import token_index
 from botocore.exceptions import ClientError
 from .token import create_alphanumeric_random_string
 
@@ -21,6 +23,77 @@ def get_access_token_from_sid_name(sid_name):
     return None
 
 
+def get_access_condition(access_token):
+    """
+    condition on the tag holding the access token, tokens are fixed length alphanumeric
+    so the pattern only matches a whole token between the ':' separators
+    """
+    tag_key = object_tag.get_shot_locker_tag_key(access_token)
+    return { "StringLike": { f"s3:ExistingObjectTag/{tag_key}": f"*{access_token}*" } }
+
+
+def get_legacy_access_condition(access_token):
+    """ condition on ShotLockerAccess, the tag every token was stored in before they were spread """
+    tag_key = object_tag.SHOT_LOCKER_TAG_KEY
+    return { "StringLike": { f"s3:ExistingObjectTag/{tag_key}": f"*{access_token}*" } }
+
+
+# bucket tag set once every object of the bucket is migrated to the tags picked from
+# the token hash, see bucket.migrate_shot_locker_bucket_access_tags. Until then users
+# are granted on ShotLockerAccess too.
+ACCESS_TAGS_MIGRATED_TAG = 'ShotLockerAccessTags'
+ACCESS_TAGS_MIGRATED_VALUE = 'hashed'
+
+
+def is_bucket_access_tags_migrated(bucket_name, *, s3_client=None) -> bool:
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+    try:
+        tag_set = s3_client.get_bucket_tagging(Bucket=bucket_name)['TagSet']
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchTagSet':
+            raise
+        tag_set = []
+    return any(tag['Key'] == ACCESS_TAGS_MIGRATED_TAG and tag['Value'] == ACCESS_TAGS_MIGRATED_VALUE 
+               for tag in tag_set)
+
+
+def set_bucket_access_tags_migrated(bucket_name, *, s3_client=None):
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+    try:
+        tag_set = s3_client.get_bucket_tagging(Bucket=bucket_name)['TagSet']
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchTagSet':
+            raise
+        tag_set = []
+    tag_set = [tag for tag in tag_set if tag['Key'] != ACCESS_TAGS_MIGRATED_TAG]
+    tag_set.append({'Key': ACCESS_TAGS_MIGRATED_TAG, 'Value': ACCESS_TAGS_MIGRATED_VALUE})
+    s3_client.put_bucket_tagging(Bucket=bucket_name, Tagging={'TagSet': tag_set})
+
+
+# statements granting the prefixes an edit fully uses, see token_index.find_prefix_grants
+PREFIX_SID_SUFFIX = 'Prefix'
+
+
+def get_prefix_grant_statement(statement, bucket_name, prefixes):
+    """
+    @returns the statement granting the prefixes to the principal of the access
+    statement, with the same expiry date and no tag condition
+    """
+    partition = statement['Resource'].split(':')[1]
+    prefix_statement = {
+        'Sid': f"{statement['Sid']}{PREFIX_SID_SUFFIX}",
+        'Effect': 'Allow',
+        'Action': 's3:GetObject',
+        'Resource': [f'arn:{partition}:s3:::{bucket_name}/{prefix}*' for prefix in sorted(prefixes)],
+        'Principal': statement['Principal'],
+    }
+    if 'DateLessThan' in statement.get('Condition', {}):
+        prefix_statement['Condition'] = {'DateLessThan': statement['Condition']['DateLessThan']}
+    return prefix_statement
+
+
 def get_default_policy():
     bucket_policy = {
         'Version': '2012-10-17',
@@ -31,7 +104,7 @@ def get_default_policy():
 
 def get_shot_locker_bucket_policy_as_json(bucket_name, *, s3_client=None):
     if not s3_client:
-        s3_client = boto3.client('s3')
+        s3_client = clients.get_client('s3')
     try:
         result = s3_client.get_bucket_policy(Bucket=bucket_name)
     except ClientError as e:
@@ -41,13 +114,13 @@ def get_shot_locker_bucket_policy_as_json(bucket_name, *, s3_client=None):
 
 def put_shot_locker_bucket_policy_as_json(bucket_name, bucket_policy, *, s3_client=None):
     if not s3_client:
-        s3_client = boto3.client('s3')
+        s3_client = clients.get_client('s3')
     s3_client.put_bucket_policy(Bucket=bucket_name, Policy=bucket_policy)
 
 
 def delete_shot_locker_bucket_policy_as_json(bucket_name, *, s3_client=None):
     if not s3_client:
-        s3_client = boto3.client('s3')
+        s3_client = clients.get_client('s3')
     s3_client.delete_bucket_policy(Bucket=bucket_name)
 
 
@@ -58,8 +131,14 @@ def add_user_to_shot_locker_bucket_policy(
     access_token, 
     *, 
     expired_date=None,
+    prefixes=None,
     s3_client=None
 ):
+    """
+    grant the user the objects tagged with the access token and the prefixes granted
+    to the access token, prefixes is read from the token index when None. Until the
+    bucket is migrated the user is also granted on the token in ShotLockerAccess.
+    """
     if not bucket_policy:
         bucket_policy = get_default_policy()
     dict_policy = json.loads(bucket_policy)
@@ -87,8 +166,7 @@ def add_user_to_shot_locker_bucket_policy(
 
         # figure out current partition
         try:
-            arn = boto3.client('sts').get_caller_identity().get('Arn')
-            partition = arn.split()[1]
+            partition = clients.get_partition()
         except:
             partition = 'aws'
 
@@ -98,11 +176,27 @@ def add_user_to_shot_locker_bucket_policy(
             'Action': 's3:GetObject',
             'Resource': f'arn:{partition}:s3:::{bucket_name}/*',
             'Principal': { "AWS": user_arn },
-            'Condition': { "StringLike": { "s3:ExistingObjectTag/ShotLockerAccess": f"*{access_token}*" } }
+            'Condition': get_access_condition(access_token)
         }
         if expired_date:
             policy['Condition']['DateLessThan'] = {"aws:CurrentTime": f"{expired_date}T23:59:59Z"}
         dict_policy['Statement'].append(policy)
+
+        # objects tagged before the tokens were spread hold the token in ShotLockerAccess,
+        # the same statement pair migrate_shot_locker_bucket_policy(keep_legacy=True) writes
+        legacy_condition = get_legacy_access_condition(access_token)
+        if (legacy_condition['StringLike'] != policy['Condition']['StringLike'] and
+            not is_bucket_access_tags_migrated(bucket_name, s3_client=s3_client)):
+            legacy = dict(policy)
+            legacy['Sid'] = f"{access_sid}Index{create_alphanumeric_random_string(8)}"
+            legacy['Condition'] = dict(policy['Condition'])
+            legacy['Condition'].update(legacy_condition)
+            dict_policy['Statement'].append(legacy)
+
+        if prefixes is None:
+            prefixes = token_index.read_prefix_grants(bucket_name, access_token, s3_client=s3_client)
+        if prefixes:
+            dict_policy['Statement'].append(get_prefix_grant_statement(policy, bucket_name, prefixes))
         changed = True
 
     if changed:
@@ -221,11 +315,15 @@ def get_shot_locker_bucket_user_access_token_list(
         if 'Sid' in statement and statement['Sid'].startswith('ShotLocker'):
             if 'Principal' in statement and 'AWS' in statement['Principal']:
                 principal_user = statement['Principal']['AWS']
+                access_token = None
                 if access_sid:
                     if 'Sid' in statement and statement['Sid'].startswith(access_sid):
-                        user_in_statements.append(get_access_token_from_sid_name(access_sid))
+                        access_token = get_access_token_from_sid_name(access_sid)
                 elif 'Sid' in statement:
-                    user_in_statements.append(get_access_token_from_sid_name(statement['Sid']))
+                    access_token = get_access_token_from_sid_name(statement['Sid'])
+                # the prefix statements of an access token repeat it
+                if access_token and access_token not in user_in_statements:
+                    user_in_statements.append(access_token)
 
     return user_in_statements
 
@@ -256,12 +354,144 @@ def get_shot_locker_bucket_user_access_list(bucket_policy, access_token, include
                             if k == 'DateLessThan':
                                 if 'aws:CurrentTime' in v:
                                     expired = v['aws:CurrentTime'][:10]
-                    users.append({
+                    user = {
                         'user_role_arn': user,
                         'expired_date': expired
-                    })
-                else:
+                    }
+                # a statement migrating to another tag key is a copy of the legacy statement
+                if user not in users:
                     users.append(user)
 
     return users
 
+
+def migrate_shot_locker_bucket_policy(
+    bucket_name, 
+    bucket_policy, 
+    *, 
+    keep_legacy=True, 
+    access_token=None,
+    s3_client=None
+):
+    """
+    Move the conditions of the access statements to the tag each token is stored in,
+    for statements written when every token was stored in ShotLockerAccess.
+    With keep_legacy a copy of each statement is added and the legacy statement kept,
+    so access holds while the objects are re-tagged, run again without keep_legacy
+    once the objects are migrated to drop the legacy statements.
+    access_token limits the migration to the statements of one token.
+    """
+    if not bucket_policy:
+        return bucket_policy
+    dict_policy = json.loads(bucket_policy)
+
+    statements = dict_policy.get('Statement', [])
+    new_statements = []
+    changed = False
+
+    def _get_key(statement):
+        principal = statement.get('Principal', {}).get('AWS')
+        access_token = get_access_token_from_sid_name(statement['Sid'])
+        return (access_token, json.dumps(principal, sort_keys=True))
+
+    def _is_current(statement):
+        access_token = get_access_token_from_sid_name(statement['Sid'])
+        condition = statement.get('Condition', {}).get('StringLike', {})
+        return condition == get_access_condition(access_token)['StringLike']
+
+    shot_locker_statements = [statement for statement in statements 
+                              if statement.get('Sid', '').startswith('ShotLocker')
+                              and 'StringLike' in statement.get('Condition', {})
+                              and (not access_token or get_access_token_from_sid_name(statement['Sid']) == access_token)]
+    current = {_get_key(statement) for statement in shot_locker_statements if _is_current(statement)}
+
+    for statement in statements:
+        if statement not in shot_locker_statements or _is_current(statement):
+            new_statements.append(statement)
+            continue
+
+        access_token = get_access_token_from_sid_name(statement['Sid'])
+        migrated = dict(statement)
+        migrated['Sid'] = f"{get_sid_name(access_token)}Index{create_alphanumeric_random_string(8)}"
+        migrated['Condition'] = dict(statement['Condition'])
+        migrated['Condition'].update(get_access_condition(access_token))
+
+        if keep_legacy:
+            new_statements.append(statement)
+            if _get_key(statement) not in current:
+                new_statements.append(migrated)
+                current.add(_get_key(statement))
+                changed = True
+        else:
+            # the legacy statement is replaced by its migrated copy
+            if _get_key(statement) not in current:
+                new_statements.append(migrated)
+                current.add(_get_key(statement))
+            changed = True
+
+    if changed:
+        dict_policy['Statement'] = new_statements
+        bucket_policy = json.dumps(dict_policy)
+        put_shot_locker_bucket_policy_as_json(bucket_name, bucket_policy, s3_client=s3_client)
+
+    return bucket_policy
+
+
+def set_shot_locker_prefix_grants(
+    bucket_name, 
+    bucket_policy, 
+    access_token, 
+    prefixes, 
+    *, 
+    s3_client=None
+):
+    """ replace the prefix statements of every user granted the access token """
+    if not bucket_policy:
+        return bucket_policy
+    dict_policy = json.loads(bucket_policy)
+
+    access_sid = get_sid_name(access_token)
+
+    new_statements = []
+    granted = set()
+
+    for statement in dict_policy.get('Statement', []):
+        if not statement.get('Sid', '').startswith(access_sid):
+            new_statements.append(statement)
+        elif not statement['Sid'].endswith(PREFIX_SID_SUFFIX):
+            new_statements.append(statement)
+            # one prefix statement for each user, a user migrating tag keys has two statements
+            principal = json.dumps(statement.get('Principal'), sort_keys=True)
+            if prefixes and 'StringLike' in statement.get('Condition', {}) and principal not in granted:
+                new_statements.append(get_prefix_grant_statement(statement, bucket_name, prefixes))
+                granted.add(principal)
+
+    # only written when the prefix statements changed
+    if new_statements != dict_policy.get('Statement', []):
+        dict_policy['Statement'] = new_statements
+        bucket_policy = json.dumps(dict_policy)
+        put_shot_locker_bucket_policy_as_json(bucket_name, bucket_policy, s3_client=s3_client)
+
+    return bucket_policy
+
+
+def remove_shot_locker_prefix_grants(bucket_name, bucket_policy, *, s3_client=None):
+    """ remove the prefix statements of every access token, e.g. when the bucket is disabled """
+    if not bucket_policy:
+        return bucket_policy
+    dict_policy = json.loads(bucket_policy)
+
+    statements = dict_policy.get('Statement', [])
+    new_statements = [statement for statement in statements
+                      if not (statement.get('Sid', '').startswith(get_sid_name('')) and
+                              statement['Sid'].endswith(PREFIX_SID_SUFFIX))]
+
+    if new_statements != statements:
+        dict_policy['Statement'] = new_statements
+        bucket_policy = json.dumps(dict_policy)
+        if not new_statements:
+            delete_shot_locker_bucket_policy_as_json(bucket_name, s3_client=s3_client)
+        else:
+            put_shot_locker_bucket_policy_as_json(bucket_name, bucket_policy, s3_client=s3_client)
+
+    return bucket_policy
@@ -0,0 +1,200 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from . import clients
+from . import edit
+from .cwprint import cwprint, cwprint_exc
+from botocore.exceptions import ClientError
+
+
+# Catalog of the edits of a Shot Locker bucket, so listing the edits is a single
+# GET instead of a listing of every edit file and a get_object_tagging per edit.
+#
+#   ShotLocker/catalog.json
+#       {"version": 1, "update_time": "...", "edits": {"{edit}": {
+#           "name", "original", "manifest", "results", "create_time",
+#           "active", "process_status"}}}
+#
+# original, manifest and results are file names like the detailed edit list. The
+# catalog is written with conditional puts (IfMatch the read ETag, IfNoneMatch
+# when it is created) and read again when another writer changed it first. A
+# catalog that can not be updated is marked stale and rebuilt from a scan of the
+# edits on its next read.
+#
+# process_status is a hint: it is set to RUNNING when an edit is validated and
+# SUCCEEDED when its tagging completes, a failed or aborted execution never
+# updates it and a rebuilt catalog does not have it. Listing the edits confirms
+# the RUNNING entries, and every entry of a rebuilt catalog, with the process
+# edit execution.
+
+CATALOG_KEY = 'ShotLocker/catalog.json'
+CATALOG_VERSION = 1
+
+# conditional writes tried before the catalog is marked stale
+CATALOG_WRITE_ATTEMPTS = 5
+
+CATALOG_FIELDS = ('original', 'manifest', 'results', 'create_time', 'active', 'process_status')
+
+# process_status values still to be confirmed with the execution
+CATALOG_UNCONFIRMED_STATUS = (None, 'RUNNING')
+
+
+def read_catalog(bucket, *, s3_client=None):
+    """ @returns (catalog, etag), (None, None) when the bucket has no catalog """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=CATALOG_KEY)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return None, None
+        raise
+
+    return json.loads(response['Body'].read().decode()), response['ETag']
+
+
+def write_catalog(bucket, catalog, *, etag=None, s3_client=None) -> bool:
+    """
+    write the catalog if it is unchanged since it was read with etag, or if it
+    does not exist when etag is None
+    @returns False when another writer changed the catalog first
+    """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    catalog['version'] = CATALOG_VERSION
+    catalog['update_time'] = _utc_now()
+    condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+
+    try:
+        s3_client.put_object(Bucket=bucket,
+                             Key=CATALOG_KEY,
+                             Body=json.dumps(catalog).encode(),
+                             ContentType='application/json',
+                             **condition)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            return False
+        raise
+
+    return True
+
+
+def rebuild_catalog(bucket, *, s3_client=None):
+    """ @returns a catalog of the bucket from a scan of its edits, it is not written """
+    edits = edit.scan_shot_locker_bucket_edit_list(bucket, s3_client=s3_client)
+    # the scan has no process status, it is looked up on the next listing
+    return {'edits': {e['name']: e for e in edits}, 'status_confirmed': False}
+
+
+def get_catalog_edits(bucket, *, s3_client=None):
+    """
+    @returns list of the edits of the bucket with the detailed edit list fields, a
+    missing or stale catalog is rebuilt, the unconfirmed process status of its
+    edits is looked up and the catalog is written when it changed
+    """
+    catalog, etag = read_catalog(bucket, s3_client=s3_client)
+    changed = False
+
+    if catalog is None or catalog.get('stale') or catalog.get('version') != CATALOG_VERSION:
+        catalog = rebuild_catalog(bucket, s3_client=s3_client)
+        changed = True
+
+    if _confirm_process_status(catalog):
+        changed = True
+
+    if changed:
+        try:
+            # a writer that updated the catalog meanwhile wins, the next read has its update
+            write_catalog(bucket, catalog, etag=etag, s3_client=s3_client)
+        except:
+            cwprint_exc(f'get_catalog_edits: unable to write the catalog of bucket {bucket}')
+
+    return list(catalog['edits'].values())
+
+
+def update_catalog_edit(bucket, edit_name, *, s3_client=None, **fields) -> bool:
+    """
+    set the catalog fields of an edit, e.g. update_catalog_edit(bucket, edit_name, active=True)
+    @returns success, the catalog is marked stale when it could not be updated
+    """
+    unknown = set(fields) - set(CATALOG_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown edit catalog fields: {', '.join(sorted(unknown))}")
+
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    try:
+        for _ in range(CATALOG_WRITE_ATTEMPTS):
+            catalog, etag = read_catalog(bucket, s3_client=s3_client)
+            if catalog is None or catalog.get('stale') or catalog.get('version') != CATALOG_VERSION:
+                # the scan already finds the edit as far as it is uploaded and processed
+                catalog = rebuild_catalog(bucket, s3_client=s3_client)
+
+            entry = catalog['edits'].setdefault(edit_name, _new_catalog_entry(edit_name))
+            entry.update(fields)
+
+            if write_catalog(bucket, catalog, etag=etag, s3_client=s3_client):
+                return True
+    except:
+        cwprint_exc(f'update_catalog_edit: unable to update the catalog of bucket {bucket} edit {edit_name}')
+
+    cwprint(f'update_catalog_edit: catalog of bucket {bucket} marked stale')
+    mark_catalog_stale(bucket, s3_client=s3_client)
+    return False
+
+
+def mark_catalog_stale(bucket, *, s3_client=None):
+    """ the next read rebuilds the catalog from a scan of the edits """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    try:
+        s3_client.put_object(Bucket=bucket,
+                             Key=CATALOG_KEY,
+                             Body=json.dumps({'version': CATALOG_VERSION, 'stale': True, 'edits': {}}).encode(),
+                             ContentType='application/json')
+    except:
+        cwprint_exc(f'mark_catalog_stale: unable to write the catalog of bucket {bucket}')
+
+
+def _confirm_process_status(catalog) -> bool:
+    """
+    look up the process edit execution of the RUNNING entries, or of every entry
+    without a status when the catalog was rebuilt
+    @returns True if a status or the catalog status_confirmed changed
+    """
+    unconfirmed = ('RUNNING',) if catalog.get('status_confirmed', True) else CATALOG_UNCONFIRMED_STATUS
+    entries = [e for e in catalog['edits'].values() if e.get('process_status') in unconfirmed]
+
+    changed = not catalog.get('status_confirmed', True)
+    catalog['status_confirmed'] = True
+    if not entries:
+        return changed
+
+    with ThreadPoolExecutor(max_workers=clients.MAX_WORKERS) as executor:
+        statuses = list(executor.map(lambda e: edit.get_process_edit_status(e['name']), entries))
+
+    # an execution that can not be found keeps the status it has
+    for entry, status in zip(entries, statuses):
+        if status and status != entry.get('process_status'):
+            entry['process_status'] = status
+            changed = True
+
+    return changed
+
+
+def _new_catalog_entry(edit_name):
+    entry = {field: None for field in CATALOG_FIELDS}
+    entry['name'] = edit_name
+    entry['active'] = False
+    return entry
+
+
+def _utc_now():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S') + 'Z'
@@ -0,0 +1,77 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+from . import clients
+from . import s3_utils
+from botocore.exceptions import ClientError
+
+
+# Long running lambdas stop before their timeout, save a checkpoint and return
+# with event['continue'] set so the state machine invokes them again to resume.
+#
+#   ShotLocker/Checkpoints/{name}.json
+
+CHECKPOINT_PREFIX = 'ShotLocker/Checkpoints/'
+
+# time kept to finish the work in flight and write the checkpoint
+CHECKPOINT_RESERVE_MS = 90 * 1000
+
+
+def get_checkpoint_key(name):
+    return f'{CHECKPOINT_PREFIX}{name}.json'
+
+
+class Deadline:
+    """
+    Lambda deadline, expired() once less than reserve_ms is left to run.
+    Without a lambda context (e.g. run locally) it never expires.
+    """
+
+    def __init__(self, context, *, reserve_ms=CHECKPOINT_RESERVE_MS):
+        self.context = context
+        self.reserve_ms = reserve_ms
+
+    def expired(self) -> bool:
+        if not self.context:
+            return False
+        return self.context.get_remaining_time_in_millis() < self.reserve_ms
+
+
+def read_checkpoint(bucket, checkpoint_key, *, s3_client=None):
+    """ @returns the checkpoint state or None if there is no checkpoint """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=checkpoint_key)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return None
+        raise
+
+    return json.loads(response['Body'].read().decode())
+
+
+def write_checkpoint(state, bucket, checkpoint_key, *, s3_client=None):
+    s3_utils.write_json_to_s3(state, bucket, checkpoint_key, s3_client=s3_client)
+
+
+def delete_checkpoint(bucket, checkpoint_key, *, s3_client=None):
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+    s3_client.delete_object(Bucket=bucket, Key=checkpoint_key)
+
+
+def set_continuation(event, checkpoint_key=None):
+    """
+    mark the event to continue from checkpoint_key, or as done when it is None
+    @returns the event
+    """
+    if checkpoint_key:
+        event['continue'] = True
+        event['checkpoint_key'] = checkpoint_key
+    else:
+        event['continue'] = False
+        event.pop('checkpoint_key', None)
+    return event
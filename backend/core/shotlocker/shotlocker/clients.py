@@ -0,0 +1,97 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import threading
+import boto3
+from botocore.config import Config
+
+
+# Width of the thread pools the library runs concurrent requests with. The client
+# connection pool is sized for two pools in flight at once (e.g. a parallel listing
+# feeding a tagging pool) so threads never wait on a connection.
+MAX_WORKERS = int(os.environ.get('SHOTLOCKER_MAX_WORKERS', '16'))
+MAX_POOL_CONNECTIONS = 2 * MAX_WORKERS
+
+DEFAULT_CONFIG_OPTIONS = {
+    'max_pool_connections': MAX_POOL_CONNECTIONS,
+    'retries': {
+        'max_attempts': 10,
+        'mode': 'adaptive',
+    },
+}
+
+# Requests paced by concurrency.AdaptiveConcurrency are retried once and without the
+# client side rate limiting of the adaptive mode, so the controller sees the throttles
+# and backs off. The work queue retries the failed items with backoff.
+CONCURRENCY_CONFIG_OPTIONS = {
+    'retries': {
+        'max_attempts': 1,
+        'mode': 'standard',
+    },
+}
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+# sts get_caller_identity response, it does not change for the process lifetime
+_caller_identity = None
+_caller_identity_lock = threading.Lock()
+
+
+def get_client(service_name, *, region_name=None, **config_options):
+    """
+    @returns a boto3 client shared by the whole process, clients are created once for
+    each service, region and config so warm invocations reuse their connections.
+    config_options override the botocore Config defaults.
+    """
+    if not region_name:
+        region_name = os.environ.get('AWS_REGION')
+
+    options = dict(DEFAULT_CONFIG_OPTIONS)
+    options.update(config_options)
+
+    client_key = (service_name, region_name, repr(sorted(options.items())))
+
+    client = _clients.get(client_key)
+    if client:
+        return client
+
+    # boto3 client creation is not thread safe
+    with _clients_lock:
+        if client_key not in _clients:
+            _clients[client_key] = boto3.client(service_name,
+                                                region_name=region_name,
+                                                config=Config(**options))
+        return _clients[client_key]
+
+
+def clear_clients():
+    """ drop the shared clients, e.g. after the credentials changed """
+    global _caller_identity
+    with _clients_lock:
+        _clients.clear()
+    with _caller_identity_lock:
+        _caller_identity = None
+
+
+def get_account_id():
+    """ @returns the AWS account id of the caller, looked up once per process """
+    return _get_caller_identity()['Account']
+
+
+def get_partition():
+    """ @returns the AWS partition (e.g. aws, aws-cn) of the caller """
+    partition = os.environ.get('AWS_PARTITION')
+    if partition:
+        return partition
+    # arn:{partition}:sts::{account}:assumed-role/...
+    return _get_caller_identity()['Arn'].split(':')[1]
+
+
+def _get_caller_identity():
+    global _caller_identity
+    with _caller_identity_lock:
+        if _caller_identity is None:
+            _caller_identity = get_client('sts').get_caller_identity()
+        return _caller_identity
@@ -0,0 +1,206 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import time
+import threading
+import contextlib
+from . import clients
+from botocore.exceptions import ClientError
+
+
+# S3 answers SlowDown (503) when the request rate of a key prefix is too high
+THROTTLE_ERROR_CODES = (
+    'SlowDown',
+    'ServiceUnavailable',
+    'Throttling',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    '503',
+)
+
+# requests in flight at most, the shared clients have a connection for each
+CONCURRENCY_MAX_LIMIT = int(os.environ.get('SHOTLOCKER_MAX_CONCURRENCY', clients.MAX_POOL_CONNECTIONS))
+
+# a request slower than this multiple of the fastest recent latency signals congestion
+CONCURRENCY_LATENCY_FACTOR = 4.0
+CONCURRENCY_DECREASE_FACTOR = 0.5
+# seconds between decreases of a limit, a burst of throttles is a single signal
+CONCURRENCY_DECREASE_INTERVAL = 1.0
+# idle prefixes are dropped once this many are tracked
+CONCURRENCY_MAX_PREFIXES = 10000
+
+
+def is_throttle_error(e) -> bool:
+    if not isinstance(e, ClientError):
+        return False
+    error = e.response.get('Error', {})
+    status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return error.get('Code') in THROTTLE_ERROR_CODES or status == 503
+
+
+def get_key_prefix(key):
+    """ S3 request rates are per prefix, use the 'directory' of the key """
+    return key[:key.rfind('/') + 1]
+
+
+class _Limit:
+
+    def __init__(self, limit):
+        self.limit = float(limit)
+        self.in_flight = 0
+        self.successes = 0
+        self.throttles = 0
+        self.slow = 0
+        self.errors = 0
+        self.fastest = None
+        self.last_decrease = 0.0
+
+    def increase(self, max_limit):
+        # additive increase, about one more request in flight for each limit successes
+        self.limit = min(max_limit, self.limit + 1.0 / self.limit)
+
+    def decrease(self, min_limit, now):
+        if now - self.last_decrease < CONCURRENCY_DECREASE_INTERVAL:
+            return
+        self.limit = max(min_limit, self.limit * CONCURRENCY_DECREASE_FACTOR)
+        self.last_decrease = now
+
+    def is_slow(self, latency) -> bool:
+        # the fastest latency drifts up so an old fast request does not count forever
+        if self.fastest is None or latency < self.fastest:
+            self.fastest = latency
+        else:
+            self.fastest += 0.01 * (latency - self.fastest)
+        return latency > self.fastest * CONCURRENCY_LATENCY_FACTOR
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD (additive increase, multiplicative decrease) limit of the requests in flight.
+
+    The overall limit grows while request latency stays healthy and halves when
+    requests slow down. Each key prefix has its own limit which halves when S3
+    throttles the prefix, so a hot prefix is slowed down without holding back the
+    requests to the other prefixes.
+
+        concurrency = AdaptiveConcurrency()
+        with ThreadPoolExecutor(max_workers=concurrency.max_limit) as executor:
+            executor.map(lambda key: concurrency.call(key, fn, key), keys)
+    """
+
+    def __init__(
+        self,
+        *,
+        initial_limit=8,
+        min_limit=1,
+        max_limit=CONCURRENCY_MAX_LIMIT,
+        prefix_max_limit=None
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.initial_limit = min(max(initial_limit, min_limit), self.max_limit)
+        self.prefix_max_limit = prefix_max_limit if prefix_max_limit else self.max_limit
+        self._limit = _Limit(self.initial_limit)
+        self._prefixes = {}
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit.limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._limit.in_flight
+
+    @property
+    def throttles(self) -> int:
+        return self._limit.throttles
+
+    def _get_prefix_limit(self, prefix):
+        prefix_limit = self._prefixes.get(prefix)
+        if not prefix_limit:
+            if len(self._prefixes) >= CONCURRENCY_MAX_PREFIXES:
+                self._prune_prefixes()
+            prefix_limit = _Limit(self.prefix_max_limit)
+            self._prefixes[prefix] = prefix_limit
+        return prefix_limit
+
+    def _prune_prefixes(self):
+        # keep the prefixes with requests in flight or a lowered limit
+        self._prefixes = {prefix: prefix_limit for prefix, prefix_limit in self._prefixes.items()
+                          if prefix_limit.in_flight or prefix_limit.limit < self.prefix_max_limit}
+
+    def acquire(self, key):
+        """ wait for a free slot for the key, @returns the key prefix to release """
+        prefix = get_key_prefix(key)
+        with self._cond:
+            while True:
+                prefix_limit = self._get_prefix_limit(prefix)
+                if (self._limit.in_flight < int(self._limit.limit) and
+                    prefix_limit.in_flight < int(prefix_limit.limit)):
+                    break
+                self._cond.wait()
+            self._limit.in_flight += 1
+            prefix_limit.in_flight += 1
+        return prefix
+
+    def release(self, prefix, latency, error=None):
+        now = time.monotonic()
+        with self._cond:
+            prefix_limit = self._get_prefix_limit(prefix)
+            self._limit.in_flight -= 1
+            prefix_limit.in_flight -= 1
+
+            if error is None:
+                self._limit.successes += 1
+                prefix_limit.successes += 1
+                if self._limit.is_slow(latency):
+                    self._limit.slow += 1
+                    self._limit.decrease(self.min_limit, now)
+                else:
+                    self._limit.increase(self.max_limit)
+                    prefix_limit.increase(self.prefix_max_limit)
+            elif is_throttle_error(error):
+                self._limit.throttles += 1
+                prefix_limit.throttles += 1
+                prefix_limit.decrease(self.min_limit, now)
+            else:
+                self._limit.errors += 1
+                prefix_limit.errors += 1
+
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, key):
+        """ context manager running one request for the key """
+        prefix = self.acquire(key)
+        start_time = time.monotonic()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.release(prefix, time.monotonic() - start_time, error)
+
+    def call(self, key, fn, *args, **kwargs):
+        """ @returns fn(*args, **kwargs) called within a slot for the key """
+        with self.slot(key):
+            return fn(*args, **kwargs)
+
+    def get_stats(self):
+        with self._cond:
+            return {
+                'limit': int(self._limit.limit),
+                'in_flight': self._limit.in_flight,
+                'successes': self._limit.successes,
+                'throttles': self._limit.throttles,
+                'slow': self._limit.slow,
+                'errors': self._limit.errors,
+                'throttled_prefixes': {prefix: int(prefix_limit.limit)
+                                       for prefix, prefix_limit in self._prefixes.items()
+                                       if prefix_limit.throttles},
+            }
@@ -0,0 +1,713 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import json
+import time
+import uuid
+import contextlib
+import zlib
+import datetime
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from . import s3_utils
+from .cwprint import cwprint, cwprint_exc
+from . import clients
+from botocore.exceptions import ClientError
+
+
+# The content index maps media file base names to the S3 keys holding them
+# so an edit can be conformed without listing the whole content lake.
+#
+#   ShotLocker/Index/Content/manifest.json         index information
+#   ShotLocker/Index/Content/shard-NNNN.json.gz    {root: {basename: [dirname, ...]}}
+#   ShotLocker/Index/Content/lock.json             held while the index is built or updated
+#   ShotLocker/Index/Content/Build/                partial index of a build continued by
+#                                                  the next invocation, same layout
+#
+# Entries are sharded by the base name root (base name without extension) so
+# an exact base name lookup and an extension agnostic root lookup land on the
+# same shard and only the shards for the referenced media have to be read.
+#
+# The index is kept current from the S3 object events of the bucket. The build
+# records the time its listing started as create_time, events from before it are
+# already in the listing and events arriving while the lock is held are deferred
+# (left in the queue) and applied once the lock is released. A build running out
+# of time keeps the lock and saves its partial index with the listing cursor, it
+# is published under the index keys once the listing is done.
+
+CONTENT_INDEX_PREFIX = 'ShotLocker/Index/Content/'
+CONTENT_INDEX_MANIFEST_KEY = CONTENT_INDEX_PREFIX + 'manifest.json'
+CONTENT_INDEX_LOCK_KEY = CONTENT_INDEX_PREFIX + 'lock.json'
+CONTENT_INDEX_BUILD_PREFIX = CONTENT_INDEX_PREFIX + 'Build/'
+CONTENT_INDEX_VERSION = 1
+CONTENT_INDEX_SHARDS = 256
+
+# a lock left by a failed invocation expires, a build renews its lock while listing
+CONTENT_INDEX_LOCK_TTL = 300
+CONTENT_INDEX_LOCK_RENEW_INTERVAL = 60
+
+# the index is rebuilt from a full listing when not updated for this many seconds,
+# in case object events were missed
+CONTENT_INDEX_MAX_AGE = float(os.environ.get('SHOTLOCKER_CONTENT_INDEX_MAX_AGE', str(7 * 24 * 3600)))
+
+# ShotLocker keeps its own bookkeeping under this prefix, it is never media
+SHOT_LOCKER_PREFIX = 'ShotLocker/'
+
+
+def get_shard_key(shard, prefix=CONTENT_INDEX_PREFIX):
+    return f'{prefix}shard-{shard:04d}.json.gz'
+
+
+def get_basename_root(basename):
+    root, _ = os.path.splitext(basename)
+    return root
+
+
+def is_indexed_key(key):
+    """ only media objects are indexed, skip folders and ShotLocker bookkeeping """
+    return not key.startswith(SHOT_LOCKER_PREFIX) and not key.endswith('/')
+
+
+class ContentIndex:
+    """
+    Basename index of a content lake bucket. Shards are loaded on first use
+    and only modified shards are written back by save(). prefix is where the
+    index is stored, CONTENT_INDEX_BUILD_PREFIX for a partial build.
+    """
+
+    def __init__(self, bucket, manifest, *, s3_client=None, prefix=CONTENT_INDEX_PREFIX):
+        self.bucket = bucket
+        self.manifest = manifest
+        self.s3_client = s3_client if s3_client else clients.get_client('s3')
+        self.prefix = prefix
+        self._shards = {}
+        self._dirty = set()
+
+    @classmethod
+    def create_empty(cls, bucket, *, s3_client=None, shard_count=CONTENT_INDEX_SHARDS, prefix=CONTENT_INDEX_PREFIX):
+        now = _isonow()
+        manifest = {
+            'version': CONTENT_INDEX_VERSION,
+            'bucket': bucket,
+            'shards': shard_count,
+            'count': 0,
+            'create_time': now,
+            'update_time': now,
+        }
+        index = cls(bucket, manifest, s3_client=s3_client, prefix=prefix)
+        for shard in range(shard_count):
+            index._shards[shard] = {}
+            index._dirty.add(shard)
+        return index
+
+    @property
+    def shard_count(self):
+        return self.manifest['shards']
+
+    @property
+    def count(self):
+        return self.manifest['count']
+
+    def _shard_for_root(self, root):
+        return zlib.crc32(root.encode()) % self.shard_count
+
+    def _get_shard(self, shard):
+        if shard not in self._shards:
+            self._shards[shard] = self._read_shard(shard)
+        return self._shards[shard]
+
+    def find(self, basename):
+        """ @returns sorted list of keys with the exact base name """
+        root = get_basename_root(basename)
+        entries = self._get_shard(self._shard_for_root(root)).get(root, {})
+        # sorted by key like a listing, the directory order differs e.g. for 'a-b/' and 'a/'
+        return sorted(_join_key(d, basename) for d in entries.get(basename, []))
+
+    def find_root(self, root):
+        """ @returns sorted list of keys with the same base name root and any extension """
+        entries = self._get_shard(self._shard_for_root(root)).get(root, {})
+        keys = []
+        for basename, dirs in entries.items():
+            keys.extend(_join_key(d, basename) for d in dirs)
+        return sorted(keys)
+
+    def add(self, key) -> bool:
+        if not is_indexed_key(key):
+            return False
+        dirname, basename = _split_key(key)
+        root = get_basename_root(basename)
+        shard = self._shard_for_root(root)
+        dirs = self._get_shard(shard).setdefault(root, {}).setdefault(basename, [])
+        if dirname in dirs:
+            return False
+        dirs.append(dirname)
+        dirs.sort()
+        self.manifest['count'] += 1
+        self._dirty.add(shard)
+        return True
+
+    def remove(self, key) -> bool:
+        if not is_indexed_key(key):
+            return False
+        dirname, basename = _split_key(key)
+        root = get_basename_root(basename)
+        shard = self._shard_for_root(root)
+        entries = self._get_shard(shard)
+        dirs = entries.get(root, {}).get(basename)
+        if not dirs or dirname not in dirs:
+            return False
+        dirs.remove(dirname)
+        if not dirs:
+            del entries[root][basename]
+            if not entries[root]:
+                del entries[root]
+        self.manifest['count'] -= 1
+        self._dirty.add(shard)
+        return True
+
+    def save(self, *, max_workers=clients.MAX_WORKERS):
+        """ write the modified shards, the manifest is written last """
+        self.manifest['update_time'] = _isonow()
+
+        def _write_shard(shard):
+            s3_utils.write_json_to_s3(self._shards[shard],
+                                      self.bucket,
+                                      get_shard_key(shard, self.prefix),
+                                      s3_client=self.s3_client,
+                                      compressed=True)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # list() to raise any write exceptions
+            list(executor.map(_write_shard, sorted(self._dirty)))
+
+        self._dirty.clear()
+
+        s3_utils.write_json_to_s3(self.manifest, self.bucket, self.prefix + 'manifest.json', s3_client=self.s3_client)
+
+    def load(self, *, max_workers=clients.MAX_WORKERS):
+        """ read every shard not loaded yet """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            shards = [shard for shard in range(self.shard_count) if shard not in self._shards]
+            for shard, entries in zip(shards, executor.map(self._read_shard, shards)):
+                self._shards[shard] = entries
+
+    def _read_shard(self, shard):
+        try:
+            return s3_utils.read_json_from_s3(self.bucket,
+                                              get_shard_key(shard, self.prefix),
+                                              s3_client=self.s3_client,
+                                              compressed=True)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                raise
+            return {}
+
+
+def read_content_index(bucket, *, s3_client=None, prefix=CONTENT_INDEX_PREFIX):
+    """
+    @returns the ContentIndex of the bucket or None if it has not been built
+    """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    # a missing index is expected, read the manifest directly rather than
+    # with s3_utils.read_json_from_s3 which logs every failed read
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=prefix + 'manifest.json')
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return None
+        raise
+
+    manifest = json.loads(response['Body'].read().decode())
+
+    if manifest.get('version') != CONTENT_INDEX_VERSION:
+        return None
+
+    return ContentIndex(bucket, manifest, s3_client=s3_client, prefix=prefix)
+
+
+def get_content_index_status(bucket, *, s3_client=None):
+    """
+    @returns 'built' when the bucket has an index, 'building' while its first build
+    holds the index lock, None otherwise (e.g. a bucket that is not a locker)
+    """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    for key, status in ((CONTENT_INDEX_MANIFEST_KEY, 'built'), (CONTENT_INDEX_LOCK_KEY, 'building')):
+        try:
+            s3_client.head_object(Bucket=bucket, Key=key)
+            return status
+        except ClientError as e:
+            # buckets of other applications may not be readable at all
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey', '403', 'AccessDenied'):
+                raise
+    return None
+
+
+def create_content_index(bucket, *, s3_client=None, shard_count=CONTENT_INDEX_SHARDS, lock_wait=60):
+    """
+    Build the content index with a full recursive listing of the bucket and save it
+    @returns the ContentIndex, None when another build or update held the index lock
+    for lock_wait seconds
+    """
+    return build_content_index(bucket, s3_client=s3_client, shard_count=shard_count, lock_wait=lock_wait).get('index')
+
+
+def build_content_index(
+    bucket, 
+    *, 
+    owner=None, 
+    s3_client=None, 
+    shard_count=CONTENT_INDEX_SHARDS, 
+    lock_wait=60, 
+    stop_fn=None
+):
+    """
+    Build the content index with a full recursive listing of the bucket under the
+    index lock, the lock is renewed while listing. When stop_fn (e.g.
+    checkpoint.Deadline.expired) stops the listing the partial index is saved with
+    the listing cursor and the lock is kept, call again with the returned owner to
+    continue the build.
+    @returns {'status': 'built', 'index': ContentIndex}, {'status': 'stopped', 'owner': lock owner}
+    or {'status': 'locked'} when another build or update held the index lock for lock_wait seconds
+    """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    index = None
+    if owner:
+        # the partial index is only continued while its build held the lock throughout,
+        # the events of a lapsed lock were skipped
+        if renew_content_index_lock(bucket, owner, s3_client=s3_client):
+            index = read_content_index(bucket, s3_client=s3_client, prefix=CONTENT_INDEX_BUILD_PREFIX)
+            if index and index.manifest.get('owner') != owner:
+                index = None
+        else:
+            cwprint(f'shotlocker.content_index.build_content_index: lost the index lock of bucket {bucket}, building again')
+            owner = None
+
+    if not owner:
+        owner = acquire_content_index_lock(bucket, wait=lock_wait, s3_client=s3_client)
+        if not owner:
+            cwprint(f'shotlocker.content_index.build_content_index: index of bucket {bucket} is locked')
+            return {'status': 'locked'}
+
+    keep_lock = False
+    try:
+        if not index:
+            # the index is only kept current when the bucket sends its object events
+            try:
+                enable_object_event_notifications(bucket, s3_client=s3_client)
+            except:
+                cwprint_exc(f'shotlocker.content_index.build_content_index: unable to enable the object events of bucket {bucket}')
+
+            index = ContentIndex.create_empty(bucket, 
+                                              s3_client=s3_client, 
+                                              shard_count=shard_count, 
+                                              prefix=CONTENT_INDEX_BUILD_PREFIX)
+
+            # the watermark of the build, events from before the listing started are in the listing
+            index.manifest['create_time'] = _isonow()
+            index.manifest['owner'] = owner
+            index.manifest['cursor'] = None
+
+        # a resumed listing is sequential, see s3_utils.iter_pages
+        pages = s3_utils.iter_pages(bucket, 
+                                    s3_client=s3_client, 
+                                    names_only=True, 
+                                    recursive=True, 
+                                    parallel=True, 
+                                    start_after=index.manifest['cursor'])
+        renew_time = time.monotonic()
+        stopped = False
+
+        try:
+            with contextlib.closing(pages):
+                for page in pages:
+                    for key in page:
+                        index.add(key)
+                    if page:
+                        index.manifest['cursor'] = page[-1]
+
+                    if time.monotonic() - renew_time > CONTENT_INDEX_LOCK_RENEW_INTERVAL:
+                        if not renew_content_index_lock(bucket, owner, s3_client=s3_client):
+                            raise RuntimeError(f'lost the index lock of bucket {bucket}')
+                        renew_time = time.monotonic()
+
+                    if stop_fn and stop_fn():
+                        stopped = True
+                        break
+        except:
+            cwprint_exc(f'shotlocker.content_index.build_content_index: unable to list bucket {bucket}')
+            raise
+
+        if stopped:
+            index.save()
+            keep_lock = renew_content_index_lock(bucket, owner, s3_client=s3_client)
+            if not keep_lock:
+                raise RuntimeError(f'lost the index lock of bucket {bucket}')
+            cwprint(f'shotlocker.content_index.build_content_index: {index.count} objects of bucket {bucket} '
+                    f'indexed, continuing after {index.manifest["cursor"]}')
+            return {'status': 'stopped', 'owner': owner}
+
+        # publish the whole index under the index keys, the manifest is written last
+        index.load()
+        manifest = {key: value for key, value in index.manifest.items() if key not in ('owner', 'cursor')}
+        built = ContentIndex(bucket, manifest, s3_client=s3_client)
+        built._shards = index._shards
+        built._dirty = set(range(built.shard_count))
+        built.save()
+
+        delete_content_index_build(bucket, s3_client=s3_client)
+    finally:
+        if not keep_lock:
+            release_content_index_lock(bucket, owner, s3_client=s3_client)
+
+    return {'status': 'built', 'index': built}
+
+
+def delete_content_index_build(bucket, *, s3_client=None):
+    """ delete the partial index of a build, the manifest first """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    keys = list(s3_utils.iter_objects(bucket, CONTENT_INDEX_BUILD_PREFIX, s3_client=s3_client))
+    keys.sort(key=lambda key: not key.endswith('manifest.json'))
+    for i in range(0, len(keys), 1000):
+        s3_client.delete_objects(Bucket=bucket, Delete={
+            'Objects': [{'Key': key} for key in keys[i:i + 1000]],
+            'Quiet': True,
+        })
+
+
+def acquire_content_index_lock(bucket, *, wait=0, ttl=CONTENT_INDEX_LOCK_TTL, s3_client=None):
+    """
+    Take the index lock of the bucket with a conditional write, waiting up to wait
+    seconds for the holder to release it. A lock older than ttl seconds is taken over.
+    @returns the owner id to release the lock with, None when it is held
+    """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    owner = uuid.uuid4().hex
+    body = json.dumps({'owner': owner, 'expire_time': time.time() + ttl}).encode()
+    deadline = time.monotonic() + wait
+
+    while True:
+        condition = {'IfNoneMatch': '*'}
+        try:
+            response = s3_client.get_object(Bucket=bucket, Key=CONTENT_INDEX_LOCK_KEY)
+            lock = json.loads(response['Body'].read().decode())
+            if lock.get('expire_time', 0) < time.time():
+                condition = {'IfMatch': response['ETag']}
+            else:
+                condition = None
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                raise
+
+        if condition:
+            try:
+                s3_client.put_object(Bucket=bucket, Key=CONTENT_INDEX_LOCK_KEY, Body=body, **condition)
+                return owner
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                    raise
+
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(2)
+
+
+def renew_content_index_lock(bucket, owner, *, ttl=CONTENT_INDEX_LOCK_TTL, s3_client=None) -> bool:
+    """
+    Extend the lock held by owner to ttl seconds from now with a conditional write
+    @returns False when the lock is not held by owner (e.g. expired and taken over)
+    """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=CONTENT_INDEX_LOCK_KEY)
+        lock = json.loads(response['Body'].read().decode())
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return False
+        raise
+
+    if lock.get('owner') != owner:
+        return False
+
+    body = json.dumps({'owner': owner, 'expire_time': time.time() + ttl}).encode()
+    try:
+        s3_client.put_object(Bucket=bucket, Key=CONTENT_INDEX_LOCK_KEY, Body=body, IfMatch=response['ETag'])
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            raise
+        return False
+    return True
+
+
+def release_content_index_lock(bucket, owner, *, s3_client=None):
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=CONTENT_INDEX_LOCK_KEY)
+        lock = json.loads(response['Body'].read().decode())
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return
+        raise
+
+    # an expired lock may have been taken over
+    if lock.get('owner') == owner:
+        s3_client.delete_object(Bucket=bucket, Key=CONTENT_INDEX_LOCK_KEY)
+
+
+def enable_object_event_notifications(bucket, *, s3_client=None) -> bool:
+    """
+    send the object created and deleted events of the bucket to EventBridge, e.g. for
+    lockers enabled before the events were turned on
+    @returns True if the notification configuration was changed
+    """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    config = s3_client.get_bucket_notification_configuration(Bucket=bucket)
+    config.pop('ResponseMetadata', None)
+    if 'EventBridgeConfiguration' in config:
+        return False
+
+    config['EventBridgeConfiguration'] = {}
+    s3_client.put_bucket_notification_configuration(Bucket=bucket, NotificationConfiguration=config)
+    return True
+
+
+def get_content_index_age(index):
+    """ @returns seconds since the index was built from a full listing """
+    create_time = datetime.datetime.fromisoformat(index.manifest['create_time'].rstrip('Z'))
+    return (datetime.datetime.utcnow() - create_time).total_seconds()
+
+
+def is_content_index_current(index, max_age=CONTENT_INDEX_MAX_AGE) -> bool:
+    """ @returns True if the index is no older than max_age seconds (always with None) """
+    return max_age is None or get_content_index_age(index) <= max_age
+
+
+def get_content_index(bucket, *, s3_client=None, max_age=CONTENT_INDEX_MAX_AGE, build=True):
+    """
+    @returns the ContentIndex of the bucket, building it when it is missing or
+    when it is older than max_age seconds (never rebuilt by age with None).
+    An index being built by another invocation is waited on, None when it is
+    missing and could not be built. Without build the index is only read, e.g.
+    when it is built by its own step (see build_content_index).
+    """
+    index = read_content_index(bucket, s3_client=s3_client)
+
+    if not build or (index and is_content_index_current(index, max_age)):
+        return index
+
+    built = create_content_index(bucket, s3_client=s3_client)
+
+    # the older index is still better than none
+    return built or index
+
+
+def get_s3_event_records(event):
+    """
+    @returns the S3 event notification records in an event. The event can be an
+    S3 event notification, an SQS batch of S3 event notifications or an
+    EventBridge S3 event, which is converted to the S3 event notification shape.
+    """
+    if isinstance(event, list):
+        records = []
+        for e in event:
+            records.extend(get_s3_event_records(e))
+        return records
+
+    if event.get('source') == 'aws.s3' and 'detail' in event:
+        return _get_records_from_eventbridge_event(event)
+
+    records = []
+    for record in event.get('Records', []):
+        if record.get('eventSource') == 'aws:sqs':
+            # S3 test events do not carry records
+            records.extend(get_s3_event_records(json.loads(record['body'])))
+        elif 's3' in record:
+            records.append(record)
+    return records
+
+
+def load_s3_event_records(filename):
+    """ read S3 event notification records from a local json event feed """
+    with open(filename) as fd:
+        return get_s3_event_records(json.load(fd))
+
+
+def coalesce_s3_event_records(records):
+    """
+    Reduce a burst of S3 events to the latest change of each object
+    @returns {bucket: {key: (created, event_time)}}
+    """
+    latest = {}
+
+    for record in records:
+        event_name = record.get('eventName', '')
+        if event_name.startswith('ObjectCreated:'):
+            created = True
+        elif event_name.startswith('ObjectRemoved:'):
+            created = False
+        else:
+            continue
+
+        bucket = record['s3']['bucket']['name']
+        key = urllib.parse.unquote_plus(record['s3']['object']['key'], encoding='utf-8')
+        sequencer = record['s3']['object'].get('sequencer', '')
+        event_time = record.get('eventTime', '')
+
+        bucket_changes = latest.setdefault(bucket, {})
+        if key in bucket_changes:
+            # the sequencer orders events of the same key, compare right padded with zeros
+            previous_sequencer = bucket_changes[key][2]
+            width = max(len(sequencer), len(previous_sequencer))
+            if sequencer.ljust(width, '0') < previous_sequencer.ljust(width, '0'):
+                continue
+        bucket_changes[key] = (created, event_time, sequencer)
+
+    return {bucket: {key: (created, event_time) for key, (created, event_time, _) in changes.items()}
+            for bucket, changes in latest.items()}
+
+
+def update_content_index_from_records(records, *, s3_client=None, lock_wait=30):
+    """
+    Apply the object adds and deletes in S3 event records to the content index of
+    each bucket. Each bucket index is read and written once for the whole batch under
+    the index lock and the watermark records the latest event time applied. Events
+    from before the index was built are already in its listing and skipped. Buckets
+    without an index (e.g. buckets that are not lockers) are skipped without taking
+    the lock, the index is built from a full listing when first needed. A bucket whose
+    index lock is held (e.g. while it is built) is deferred, its records are to be
+    delivered again.
+    @returns summary of the changes for each bucket, {'deferred': n} for deferred buckets
+    """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    summary = {}
+
+    for bucket, changes in coalesce_s3_event_records(records).items():
+        status = get_content_index_status(bucket, s3_client=s3_client)
+        if not status:
+            summary[bucket] = {'skipped': len(changes)}
+            continue
+
+        owner = acquire_content_index_lock(bucket, wait=lock_wait, s3_client=s3_client)
+        if not owner:
+            summary[bucket] = {'deferred': len(changes)}
+            continue
+
+        try:
+            summary[bucket] = _apply_changes(bucket, changes, s3_client)
+        finally:
+            release_content_index_lock(bucket, owner, s3_client=s3_client)
+
+    cwprint(summary, 'shotlocker.content_index.update_content_index_from_records')
+
+    return summary
+
+
+def _apply_changes(bucket, changes, s3_client):
+    index = read_content_index(bucket, s3_client=s3_client)
+    if not index:
+        return {'skipped': len(changes)}
+
+    # compared to the second, events in the second the listing started are applied again
+    build_time = index.manifest['create_time'][:19]
+
+    added = 0
+    removed = 0
+    skipped = 0
+    latest_event_time = ''
+    for key, (created, event_time) in changes.items():
+        if event_time and event_time[:19] < build_time:
+            skipped += 1
+            continue
+        changed = index.add(key) if created else index.remove(key)
+        if created:
+            added += changed
+        else:
+            removed += changed
+        # only the events that changed the index move the watermark
+        if changed:
+            latest_event_time = max(latest_event_time, event_time)
+
+    watermark = index.manifest.get('watermark', {})
+    if added or removed:
+        watermark['event_time'] = max(watermark.get('event_time', ''), latest_event_time)
+        watermark['events'] = watermark.get('events', 0) + added + removed
+        index.manifest['watermark'] = watermark
+        index.save()
+
+    return {
+        'added': added,
+        'removed': removed,
+        'events': len(changes),
+        'before_build': skipped,
+        'watermark': watermark,
+    }
+
+
+def get_sqs_message_buckets(event):
+    """ @returns {SQS message id: set of the buckets of its S3 event records} """
+    buckets = {}
+    for record in event.get('Records', []):
+        if record.get('eventSource') == 'aws:sqs':
+            records = get_s3_event_records(json.loads(record['body']))
+            buckets[record['messageId']] = {r['s3']['bucket']['name'] for r in records}
+    return buckets
+
+
+def get_content_index_watermark(index):
+    """ @returns the time of the latest S3 event applied to the index, or when it was built """
+    return index.manifest.get('watermark', {}).get('event_time') or index.manifest['create_time']
+
+
+def _get_records_from_eventbridge_event(event):
+    detail_type = event.get('detail-type')
+    if detail_type == 'Object Created':
+        event_name = 'ObjectCreated:' + event['detail'].get('reason', 'PutObject')
+    elif detail_type == 'Object Deleted':
+        event_name = 'ObjectRemoved:' + event['detail'].get('reason', 'DeleteObject')
+    else:
+        return []
+
+    return [{
+        'eventSource': 'aws:s3',
+        'eventTime': event.get('time', ''),
+        'eventName': event_name,
+        's3': {
+            'bucket': {'name': event['detail']['bucket']['name']},
+            'object': {
+                'key': event['detail']['object']['key'],
+                'sequencer': event['detail']['object'].get('sequencer', ''),
+            },
+        },
+    }]
+
+
+def _split_key(key):
+    dirname, _, basename = key.rpartition('/')
+    return dirname, basename
+
+
+def _join_key(dirname, basename):
+    return f'{dirname}/{basename}' if dirname else basename
+
+
+def _isonow():
+    # lambda runs with UTC timestamp
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S') + 'Z'
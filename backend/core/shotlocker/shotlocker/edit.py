@@ -3,11 +3,14 @@
 
 import os
 import json
+from concurrent.futures import ThreadPoolExecutor
+from . import catalog
 from . import s3_utils
 from . import stepfn
 from . import token
+from . import token_index
 from .cwprint import cwprint, cwprint_exc
-import boto3
+from . import clients
 from botocore.exceptions import ClientError
 
 
@@ -23,15 +26,33 @@ def get_shot_locker_bucket_edit_detailed_list(
     bucket_name, 
     *, 
     s3_client=None, 
-    include_inactive=False
+    include_inactive=False,
+    use_catalog=True
 ):
     """
     get a list of edits with detailed information for a given shotlocker
+    the edits are read from the bucket catalog, or scanned without use_catalog
+    """
+    if use_catalog:
+        edits = catalog.get_catalog_edits(bucket_name, s3_client=s3_client)
+    else:
+        edits = scan_shot_locker_bucket_edit_list(bucket_name, s3_client=s3_client)
+
+    if not include_inactive:
+        edits = [e for e in edits if e['active']]
+
+    return edits
+
+
+def scan_shot_locker_bucket_edit_list(bucket_name, *, s3_client=None):
+    """
+    get a list of all of the edits with detailed information for a given shotlocker
+    from a listing of the edit files and the tags of each original upload
     """
     if not s3_client:
-        s3_client = boto3.client('s3')
+        s3_client = clients.get_client('s3')
 
-    objects = s3_utils.list_all_objects(bucket_name, 'ShotLocker/Edits/', s3_client=s3_client, recursive=True, names_only=False)
+    objects = s3_utils.iter_objects(bucket_name, 'ShotLocker/Edits/', s3_client=s3_client, recursive=True, names_only=False)
 
     enabled_tag_values = s3_utils.get_enabled_tag_value_list()
 
@@ -57,6 +78,7 @@ def get_shot_locker_bucket_edit_detailed_list(
                     'manifest': None,
                     'results': None,
                     'active': False,
+                    'process_status': None,
                 }
 
             if processed:
@@ -83,14 +105,6 @@ def get_shot_locker_bucket_edit_detailed_list(
                     if tag['Key'] == 'ShotLocker':
                         edits[access_token]['active'] = tag['Value'] in enabled_tag_values
 
-
-    if not include_inactive:
-        active_edits = {}
-        for k,v in edits.items():
-            if v['active']:
-                active_edits[k] = v
-        edits = active_edits
-
     return list(edits.values())
 
 
@@ -100,18 +114,23 @@ def set_shot_locker_bucket_edit(
     *, 
     enable=True, 
     s3_client=None,
-    start_stepfn_execution=True
+    start_stepfn_execution=True,
+    edit_info=None
 ) -> bool:
     """
     Set an S3 Bucket Edit as a Shot Locker bucket enabled or disabled
+    edit_info is the edit already resolved with resolve_edit(as_s3_uri=False)
     @return success
     """
     success = False
 
     if not s3_client:
-        s3_client = boto3.client('s3')
+        s3_client = clients.get_client('s3')
 
-    edit_info = get_shot_locker_bucket_edit_info(bucket_name, edit_name, s3_client=s3_client, as_s3_uri=False)
+    if not edit_info:
+        edit_info = resolve_edit(bucket_name, edit_name, s3_client=s3_client, as_s3_uri=False, process_status=False)
+        if not edit_info:
+            return False
 
     # use the original upload as the source of enabled or not
     key = edit_info['original']
@@ -155,6 +174,9 @@ def set_shot_locker_bucket_edit(
     except:
         cwprint_exc(f'set_shot_locker_bucket_edit: put_object_tagging to bucket {bucket_name} key {key}')
 
+    if success:
+        catalog.update_catalog_edit(bucket_name, edit_name, active=enable, s3_client=s3_client)
+
     if start_stepfn_execution:
         # call step function to complete edit activation
         edit_stepfn = "AddEditAccessArn" if enable else "RemoveEditAccessArn"
@@ -162,7 +184,7 @@ def set_shot_locker_bucket_edit(
         stepfn_name = stepfn.get_stepfn_arn(edit_name, edit_stepfn)
 
         try:
-            sfn_client = boto3.client('stepfunctions')
+            sfn_client = clients.get_client('stepfunctions')
             response = sfn_client.start_execution(
                 stateMachineArn=stepfn_name,
                 input=json.dumps({
@@ -181,11 +203,41 @@ def set_shot_locker_bucket_edit(
 
 
 def is_shot_locker_bucket_edit_valid(bucket_name, edit_name, *, s3_client=None):
-    edits = get_shot_locker_bucket_edit_list(bucket_name, s3_client=s3_client)
-    return edit_name in edits
+    if not edit_name or '/' in edit_name:
+        return False
+
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    # the edit folder has at least its folder object
+    response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=get_edit_prefix(edit_name), MaxKeys=1)
+    return response.get('KeyCount', 0) > 0
+
+
+def get_edit_prefix(edit_name):
+    return f'ShotLocker/Edits/{edit_name}/'
 
 
 def get_shot_locker_bucket_edit_info(bucket_name, edit_name, *, s3_client=None, as_s3_uri=True):
+    return resolve_edit(bucket_name, edit_name, s3_client=s3_client, as_s3_uri=as_s3_uri)
+
+
+def resolve_edit(bucket_name, edit_name, *, s3_client=None, as_s3_uri=True, process_status=True):
+    """
+    @returns the edit information, or None when the bucket has no edit edit_name.
+    The edit folder is listed once, the active tag of the original upload and the
+    process status (skipped without process_status) are looked up concurrently.
+    """
+    if not edit_name or '/' in edit_name:
+        return None
+
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    objects = list(s3_utils.iter_objects(bucket_name, get_edit_prefix(edit_name), s3_client=s3_client, names_only=False, recursive=True))
+    if not objects:
+        return None
+
     edit = {
         'name': edit_name,
         "original": None,
@@ -196,15 +248,6 @@ def get_shot_locker_bucket_edit_info(bucket_name, edit_name, *, s3_client=None,
         "active": True
     }
 
-    if not s3_client:
-        s3_client = boto3.client('s3')
-
-    edits = get_shot_locker_bucket_edit_list(bucket_name, s3_client=s3_client)
-    if edit_name not in edits:
-        return None
-
-    objects = s3_utils.list_all_objects(bucket_name, f'ShotLocker/Edits/{edit_name}/', s3_client=s3_client, names_only=False, recursive=True)
-
     original_upload_name = None
 
     for o in objects:
@@ -214,51 +257,138 @@ def get_shot_locker_bucket_edit_info(bucket_name, edit_name, *, s3_client=None,
 
         if processed:
             if name.endswith('.otio'):
-                edit['manifest'] = f's3://{bucket_name}/{name}' if as_s3_uri else name
+                edit['manifest'] = name
             elif name.endswith('.json'):
-                edit['results'] = f's3://{bucket_name}/{name}' if as_s3_uri else name
+                edit['results'] = name
         elif (name.endswith('.xml') or 
               name.endswith('.aaf') or
               name.endswith('.otio')):
-            edit['original'] = f's3://{bucket_name}/{name}' if as_s3_uri else name
+            edit['original'] = name
             edit['create_time'] = o['LastModified'].isoformat()
             original_upload_name = name
 
-    # check if edit is active
-    # if the ShotLocker tag is missing, assume it is active
     if not original_upload_name:
         raise IOError(f"Unable to find original upload for {edit_name}")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        active = executor.submit(_get_edit_active, bucket_name, original_upload_name, s3_client)
+        if process_status:
+            status = executor.submit(get_process_edit_status, edit_name)
+            edit['process_status'] = status.result()
+        active = active.result()
+
+    # if the ShotLocker tag is missing, assume it is active
+    if active is not None:
+        edit['active'] = active
+
+    if as_s3_uri:
+        edit = get_edit_info_as_s3_uri(bucket_name, edit)
+
+    return edit
+
+
+def get_edit_info_as_s3_uri(bucket_name, edit):
+    """ @returns a copy of the edit information of resolve_edit(as_s3_uri=False) with the keys as s3 uris """
+    edit = dict(edit)
+    for field in ('original', 'manifest', 'results'):
+        if edit[field]:
+            edit[field] = f's3://{bucket_name}/{edit[field]}'
+    return edit
+
+
+def get_process_edit_status(edit_name):
+    """ @returns the status of the process edit execution of the edit, None if it can not be found """
+    aws_region = os.environ.get('AWS_REGION')
+    arn = None
+    try:
+        arn = f'arn:{clients.get_partition()}:states:{aws_region}:{clients.get_account_id()}:execution:ShotLocker-Process-Edit-StepFn:ShotLocker-Put-Object-StepFn-{edit_name}'
+        sf_client = clients.get_client('stepfunctions')
+        resp = sf_client.describe_execution(executionArn=arn)
+        return resp['status']
+    except:
+        cwprint_exc(f"ERROR: Unable to retrieve the stepfunction execution (arn {arn})")
+    return None
+
+
+def _get_edit_active(bucket_name, key, s3_client):
+    """ @returns whether the ShotLocker tag of the original upload is enabled, None without the tag """
     try:
-        tag_set = s3_client.get_object_tagging(Bucket=bucket_name, Key=original_upload_name)['TagSet']
+        tag_set = s3_client.get_object_tagging(Bucket=bucket_name, Key=key)['TagSet']
     except:
-        cwprint_exc(f'get_shot_locker_bucket_edit_info: get_object_tagging from bucket {bucket_name} key {name}')
+        cwprint_exc(f'resolve_edit: get_object_tagging from bucket {bucket_name} key {key}')
         raise
 
     enabled_tag_values = s3_utils.get_enabled_tag_value_list()
+    active = None
     for tag in tag_set:
         if tag['Key'] == 'ShotLocker':
-            edit['active'] = tag['Value'] in enabled_tag_values
+            active = tag['Value'] in enabled_tag_values
+    return active
 
-    # Get the process status
-    # AWS Account Id
-    account_id = boto3.client('sts').get_caller_identity()["Account"]
 
-    aws_partition = os.environ.get('AWS_PARTITION')
-    aws_region = os.environ.get('AWS_REGION')
-    arn = f'arn:{aws_partition}:states:{aws_region}:{account_id}:execution:ShotLocker-Process-Edit-StepFn:ShotLocker-Put-Object-StepFn-{edit_name}'
-    try:
-        sf_client = boto3.client('stepfunctions')
-        resp = sf_client.describe_execution(executionArn=arn)
-        edit['process_status'] = resp['status']
-    except:
-        cwprint_exc(f"ERROR: Unable to retrieve the stepfunction execution (arn {arn})")
+def get_shot_locker_tagged_keys(bucket_name, *, s3_client=None):
+    """
+    @returns sorted list of the keys that can carry access tokens, the union of the
+    token indexes and of the files_tagged recorded in the results of every edit.
+    None when an uploaded edit has neither (e.g. its processing failed) and only a
+    full scan of the bucket is sure to find the objects it tagged.
+    """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
 
-    return edit
+    results_keys = {}
+    uploaded = set()
+
+    for key in s3_utils.iter_objects(bucket_name, 'ShotLocker/Edits/', s3_client=s3_client, recursive=True):
+        # ShotLocker/Edits/[ACCESS_KEY]/[UPLOADED]
+        # ShotLocker/Edits/[ACCESS_KEY]/processed/[RESULTS]
+        parts = key.split('/')
+        if len(parts) == 5 and parts[3] == 'processed' and parts[4].endswith('.json'):
+            results_keys[parts[2]] = key
+        elif len(parts) == 4 and parts[3].endswith(('.xml', '.aaf', '.otio')):
+            uploaded.add(parts[2])
+
+    indexed = set(token_index.list_indexed_tokens(bucket_name, s3_client=s3_client))
+
+    # an edit folder without an upload never tagged anything
+    if any(edit_name not in results_keys and edit_name not in indexed for edit_name in uploaded):
+        return None
+
+    def _read_files_tagged(edit_name):
+        if edit_name not in results_keys:
+            return []
+        try:
+            results = s3_utils.read_json_from_s3(bucket_name, results_keys[edit_name], s3_client=s3_client)
+        except Exception:
+            return None
+        return results.get('files_tagged')
+
+    def _read_token_index(access_token):
+        return token_index.read_token_index(bucket_name, access_token, s3_client=s3_client) or []
+
+    with ThreadPoolExecutor(max_workers=clients.MAX_WORKERS) as executor:
+        edit_files_tagged = dict(zip(sorted(uploaded), executor.map(_read_files_tagged, sorted(uploaded))))
+        indexed_keys = list(executor.map(_read_token_index, sorted(indexed)))
+
+    keys = set()
+    for edit_name, files_tagged in edit_files_tagged.items():
+        if files_tagged is None:
+            if edit_name not in indexed:
+                return None
+            continue
+        for s3_uri in files_tagged:
+            tagged_bucket, key = s3_utils.get_bucket_key_from_s3_uri(s3_uri)
+            if tagged_bucket == bucket_name:
+                keys.add(key)
+    for token_keys in indexed_keys:
+        keys.update(token_keys)
+
+    return sorted(keys)
 
 
 def create_new_edit_folder(bucket_name, *, s3_client=None):
     if not s3_client:
-        s3_client = boto3.client('s3')
+        s3_client = clients.get_client('s3')
 
     current_edits = get_shot_locker_bucket_edit_list(bucket_name, s3_client=s3_client)
 
@@ -286,7 +416,7 @@ def create_new_edit_folder(bucket_name, *, s3_client=None):
 def upload_new_edit(bucket_name, filename, body, *, s3_client=None):
     
     if not s3_client:
-        s3_client = boto3.client('s3')
+        s3_client = clients.get_client('s3')
 
     folder = create_new_edit_folder(bucket_name, s3_client=s3_client)
     if not folder:
@@ -22,13 +22,43 @@ def frame_ranges(s3_uri):
     return (int(frame_range[0]), int(frame_range[1])+1)
 
 
+def set_frame_range(s3_uri, first_frame, last_frame):
+    """
+    @returns the s3_uri with the frame range replaced by first_frame to last_frame
+    (inclusive), keeping the frame number padding
+    """
+    parts = re.split('\[|\]', s3_uri)
+    if len(parts) != 3:
+        return s3_uri
+    frame_range = parts[1].split('-')
+    if len(frame_range) != 2:
+        return s3_uri
+
+    leading_zero_size = _leading_zero_size(frame_range)
+    first = str(first_frame).zfill(leading_zero_size)
+    last = str(last_frame).zfill(leading_zero_size)
+
+    return f'{parts[0]}[{first}-{last}]{parts[2]}'
+
+
+def _leading_zero_size(frame_range):
+    if frame_range[0][0] == '0' or frame_range[1][0] == '0':
+        return max(len(frame_range[0]), len(frame_range[1]))
+    return 0
+
+
 def expand_filename_frame_range(
     s3_uri, 
     *, 
     s3_client=None,
     check_exist=False,
-    bucket=None
+    bucket=None,
+    listing_cache=None
 ):
+    """
+    listing_cache (s3_utils.ListingCache) shares the existence check listings
+    between references to the same sequence
+    """
     # file name ranges use format PREFIX.[0001-0005].exr format
     parts = re.split('\[|\]', s3_uri)
     if len(parts) != 3:
@@ -43,9 +73,7 @@ def expand_filename_frame_range(
         return [s3_uri]
 
     # leading zero number size
-    leading_zero_size = 0
-    if frame_range[0][0] == '0' or frame_range[1][0] == '0':
-        leading_zero_size = max(len(frame_range[0]), len(frame_range[1]))
+    leading_zero_size = _leading_zero_size(frame_range)
 
     filenames = []
     for frame_number in range(int(frame_range[0]), int(frame_range[1])+1):
@@ -56,21 +84,65 @@ def expand_filename_frame_range(
     if not check_exist:
        return filenames
 
-    # strip protocol
-    key = s3_uri
-    if s3_uri.startswith('s3://'):
-        parts = s3_uri[5:].split('/')
-        bucket = parts[0]
-        key = '/'.join(parts[1:])
-
+    bucket, key = _get_bucket_key(s3_uri, bucket)
     if not bucket:
        return filenames
 
-    prefix = '/'.join(key.split('/')[:-1]) + '/'
+    frame_keys = expand_filename_frame_range(key)
+    existing_keys = list_existing_frame_keys(bucket, 
+                                             key, 
+                                             frame_keys, 
+                                             s3_client=s3_client, 
+                                             listing_cache=listing_cache)
+
+    return [(fn, frame_key in existing_keys) for fn, frame_key in zip(filenames, frame_keys)]
+
+
+def plan_frame_range_listing(s3_uri, listing_cache, *, bucket=None):
+    """ add the key range of a frame range reference to the listing_cache plan """
+    if not has_frame_range(s3_uri):
+        return
+
+    bucket, key = _get_bucket_key(s3_uri, bucket)
+    frame_keys = expand_filename_frame_range(key)
+    if not bucket or not frame_keys:
+        return
+
+    listing_cache.plan(bucket, _get_frame_range_prefix(key), min(frame_keys), max(frame_keys))
+
+
+def list_existing_frame_keys(bucket, key, frame_keys, *, s3_client=None, listing_cache=None):
+    """
+    @returns set of the frame_keys of the frame range key that exist in the bucket.
+    Only the keys from the first frame to the last frame are listed, not the
+    whole directory the sequence is in.
+    """
+    if not frame_keys:
+        return set()
+
+    # frame numbers without padding do not sort in frame order, bound by the keys
+    first_key = min(frame_keys)
+    last_key = max(frame_keys)
+    prefix = _get_frame_range_prefix(key)
 
-    objects = set([f's3://{bucket}/{fn}' for fn in s3_utils.list_all_objects(bucket, prefix, s3_client=s3_client)])
+    if listing_cache:
+        listed_keys = listing_cache.list_keys(bucket, prefix, first_key, last_key)
+    else:
+        listed_keys = s3_utils.list_keys_in_range(bucket, prefix, first_key, last_key, s3_client=s3_client)
 
-    return [(fn, fn in objects) for fn in filenames]
-        
+    return set(frame_key for frame_key in frame_keys if frame_key in listed_keys)
 
 
+def _get_frame_range_prefix(key):
+    # every frame key starts with the part of the key before the frame range
+    return re.split('\[|\]', key)[0]
+
+
+def _get_bucket_key(s3_uri, bucket):
+    # strip protocol
+    key = s3_uri
+    if s3_uri.startswith('s3://'):
+        parts = s3_uri[5:].split('/')
+        bucket = parts[0]
+        key = '/'.join(parts[1:])
+    return bucket, key
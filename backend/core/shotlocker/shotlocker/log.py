@@ -3,11 +3,30 @@
 
 import os
 import json
+import contextlib
+import threading
 from datetime import datetime
 import time
 from typing import Any
 from .cwprint import cwprint_exc
-import boto3
+from . import clients
+
+
+# put_log_events limits for a single request
+LOG_BATCH_MAX_EVENTS = 10000
+LOG_BATCH_MAX_BYTES = 1048576
+LOG_EVENT_OVERHEAD_BYTES = 26
+
+# buffered log entries are written at least this often
+LOG_FLUSH_INTERVAL = 5  # seconds
+
+_log_lock = threading.RLock()
+_log_streams = set()
+_log_buffer = {}
+_log_buffer_size = {}
+_log_buffer_start = None
+_log_buffering = 0
+_log_flush_timer = None
 
 
 def log_entry(
@@ -16,6 +35,13 @@ def log_entry(
     *, 
     region=None
 ):
+    """
+    Write a log entry to the edit (id) log stream. Inside buffered_log_entries()
+    entries are batched and written on exit, when a batch fills up or at the latest
+    LOG_FLUSH_INTERVAL seconds after they were buffered, otherwise each entry is
+    written immediately.
+    """
+    global _log_buffer_start
 
     log_group_name = os.environ.get("LOG_GROUP_NAME")
 
@@ -40,9 +66,133 @@ def log_entry(
         log['Message'] = ','.join(content)
     else:
         log['Message'] = content
-    
-    log_client = boto3.client('logs', region_name=region)
 
+    message = json.dumps(log, indent=2)
+    stream = (region, log_group_name, id)
+
+    with _log_lock:
+        _log_buffer.setdefault(stream, []).append({
+            'timestamp': timestamp,
+            'message': message
+        })
+        _log_buffer_size[stream] = (_log_buffer_size.get(stream, 0) + 
+                                    len(message.encode()) + LOG_EVENT_OVERHEAD_BYTES)
+        if _log_buffer_start is None:
+            _log_buffer_start = time.time()
+
+        flush = (not _log_buffering or
+                 len(_log_buffer[stream]) >= LOG_BATCH_MAX_EVENTS or 
+                 _log_buffer_size[stream] >= LOG_BATCH_MAX_BYTES or
+                 time.time() - _log_buffer_start >= LOG_FLUSH_INTERVAL)
+        if not flush:
+            # a handler that stops logging for a while still writes its entries
+            _start_flush_timer()
+
+    if flush:
+        flush_log_entries()
+
+
+def flush_log_entries():
+    """ write all of the buffered log entries """
+    global _log_buffer_start, _log_flush_timer
+
+    # swap the buffer out, other threads keep logging while it is written
+    with _log_lock:
+        buffer = dict(_log_buffer)
+        _log_buffer.clear()
+        _log_buffer_size.clear()
+        _log_buffer_start = None
+        if _log_flush_timer:
+            _log_flush_timer.cancel()
+            _log_flush_timer = None
+
+    for (region, log_group_name, id), events in buffer.items():
+        for batch in _get_log_event_batches(events):
+            _put_log_events(region, log_group_name, id, batch)
+
+
+def _start_flush_timer():
+    """ flush the buffer LOG_FLUSH_INTERVAL seconds from now, called with _log_lock held """
+    global _log_flush_timer
+
+    if _log_flush_timer is None:
+        _log_flush_timer = threading.Timer(LOG_FLUSH_INTERVAL, _flush_on_timer)
+        _log_flush_timer.daemon = True
+        _log_flush_timer.start()
+
+
+def _flush_on_timer():
+    try:
+        flush_log_entries()
+    except:
+        cwprint_exc("shotlocker.log: unable to write log entries")
+
+
+@contextlib.contextmanager
+def buffered_log_entries():
+    """
+    Batch the log entries written inside the context, also usable as a lambda handler decorator:
+
+        @buffered_log_entries()
+        def lambda_handler(event, context):
+    """
+    global _log_buffering
+
+    with _log_lock:
+        _log_buffering += 1
+    try:
+        yield
+    finally:
+        with _log_lock:
+            _log_buffering -= 1
+        try:
+            flush_log_entries()
+        except:
+            # never hide the result (or exception) of the work with a logging failure
+            cwprint_exc("shotlocker.log.buffered_log_entries: unable to write log entries")
+
+
+def _get_log_event_batches(events):
+    batch = []
+    batch_size = 0
+    # the events of a batch must be in chronological order, threads logging at the
+    # same time can buffer their entries out of order
+    for event in sorted(events, key=lambda event: event['timestamp']):
+        event_size = len(event['message'].encode()) + LOG_EVENT_OVERHEAD_BYTES
+        if batch and (len(batch) >= LOG_BATCH_MAX_EVENTS or batch_size + event_size > LOG_BATCH_MAX_BYTES):
+            yield batch
+            batch = []
+            batch_size = 0
+        batch.append(event)
+        batch_size += event_size
+    if batch:
+        yield batch
+
+
+def _put_log_events(region, log_group_name, id, events):
+    log_client = clients.get_client('logs', region_name=region)
+
+    # log streams are created once for the life of the process
+    if (log_group_name, id) not in _log_streams:
+        _create_log_stream(log_client, log_group_name, id)
+
+    try:
+        log_client.put_log_events(
+            logGroupName=log_group_name,
+            logStreamName=id,
+            logEvents=events,
+        )
+    except log_client.exceptions.ResourceNotFoundException:
+        # the log stream was deleted since it was created
+        _create_log_stream(log_client, log_group_name, id)
+        log_client.put_log_events(
+            logGroupName=log_group_name,
+            logStreamName=id,
+            logEvents=events,
+        )
+
+
+def _create_log_stream(log_client, log_group_name, id):
     try:
         log_client.create_log_stream(
             logGroupName=log_group_name,
@@ -50,17 +200,7 @@ def log_entry(
         )
     except log_client.exceptions.ResourceAlreadyExistsException:
         pass
-
-    response = log_client.put_log_events(
-        logGroupName=log_group_name,
-        logStreamName=id,
-        logEvents=[
-            {
-                'timestamp': timestamp,
-                'message': json.dumps(log, indent=2)
-            },
-        ],
-    )
+    _log_streams.add((log_group_name, id))
 
 
 def get_log_entries(
@@ -72,8 +212,11 @@ def get_log_entries(
 
     if not region:
         region = os.environ.get('AWS_REGION')
+
+    # include any entries still buffered
+    flush_log_entries()
     
-    log_client = boto3.client('logs', region_name=region)
+    log_client = clients.get_client('logs', region_name=region)
 
     events = []
 
@@ -0,0 +1,117 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+class MediaMatcher:
+    """
+    Resolve edit media references to content lake objects in a single pass.
+
+    media_files maps each media base name to its S3 URI, or None when it is not
+    resolved yet, and is updated in place. A reference is resolved by (in order)
+      - an object with the same base name
+      - the first frame of a frame range reference (first_frame_files maps the
+        first frame base name to the frame range base name)
+      - an object with the same base name root and a different extension
+        (media_files_root maps the root to the base name)
+
+    Exact and first frame matches are final, the first one seen wins. A root match
+    is only used if no exact match is seen, so listing can only stop early once
+    every reference has an exact match.
+    """
+
+    def __init__(self, bucket, media_files, first_frame_files, media_files_root):
+        self.bucket = bucket
+        self.media_files = media_files
+
+        self._unresolved = {base for base, s3_uri in media_files.items() if not s3_uri}
+        self._first_frame = {first_frame: base for first_frame, base in first_frame_files.items()
+                             if base in self._unresolved}
+        self._root = {root: base for root, base in media_files_root.items()
+                      if base in self._unresolved}
+        self._root_matches = {}
+
+    @property
+    def done(self) -> bool:
+        """ every reference has an exact match """
+        return not self._unresolved
+
+    def match_objects(self, object_list) -> bool:
+        """
+        Match a page of object keys, e.g. from s3_utils.iter_pages
+        @returns True when done and the listing can stop
+        """
+        unresolved = self._unresolved
+        first_frame = self._first_frame
+        root_refs = self._root
+        root_matches = self._root_matches
+
+        for key in object_list:
+            if not unresolved:
+                break
+
+            base = key[key.rfind('/') + 1:]
+
+            if base in unresolved:
+                self._resolve(base, f's3://{self.bucket}/{key}')
+            elif base in first_frame:
+                ref = first_frame[base]
+                if ref in unresolved:
+                    self._resolve(ref, f's3://{self.bucket}/{key[:len(key) - len(base)]}{ref}')
+            elif root_refs:
+                ref = root_refs.get(_get_root(base))
+                if ref and ref in unresolved and ref not in root_matches:
+                    root_matches[ref] = f's3://{self.bucket}/{key}'
+
+        return self.done
+
+    def match_content_index(self, index):
+        """
+        match with direct lookups in a shotlocker.content_index.ContentIndex, the
+        same objects as match_objects with a full listing: the first key in listing
+        order wins, whether it is an exact or a first frame match
+        """
+        # ref -> (key, s3_uri) of its first exact or first frame match
+        matches = {}
+
+        for base in self._unresolved:
+            keys = index.find(base)
+            if keys:
+                matches[base] = (keys[0], f's3://{self.bucket}/{keys[0]}')
+
+        for first_frame, ref in self._first_frame.items():
+            if ref not in self._unresolved:
+                continue
+            keys = index.find(first_frame)
+            if keys and (ref not in matches or keys[0] < matches[ref][0]):
+                key = keys[0]
+                matches[ref] = (key, f's3://{self.bucket}/{key[:len(key) - len(first_frame)]}{ref}')
+
+        for ref, (key, s3_uri) in matches.items():
+            self._resolve(ref, s3_uri)
+
+        for root, ref in self._root.items():
+            if ref not in self._unresolved:
+                continue
+            keys = index.find_root(root)
+            if keys:
+                self._root_matches[ref] = f's3://{self.bucket}/{keys[0]}'
+
+    def finish(self):
+        """ resolve the references without an exact match with their root match """
+        for ref, s3_uri in self._root_matches.items():
+            if ref in self._unresolved:
+                self._resolve(ref, s3_uri)
+        self._root_matches = {}
+        return self.media_files
+
+    def _resolve(self, base, s3_uri):
+        self.media_files[base] = s3_uri
+        self._unresolved.discard(base)
+
+
+def _get_root(base):
+    # same as os.path.splitext(base)[0], leading dots are not an extension
+    dot = base.rfind('.')
+    if dot > 0 and base[:dot].lstrip('.'):
+        return base[:dot]
+    return base
@@ -1,8 +1,15 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import zlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from . import s3_utils
-import boto3
+from . import clients
+from . import token_index
+from . import work_queue
+from .cwprint import cwprint
+from botocore.exceptions import ClientError
 
 
 def get_s3_object_tag_list(
@@ -12,7 +19,7 @@ def get_s3_object_tag_list(
 ):
     bucket, key = s3_utils.get_bucket_key_from_s3_uri(s3_uri)
     if not s3_client:
-        s3_client = boto3.client('s3')
+        s3_client = clients.get_client('s3')
     response = s3_client.get_object_tagging(Bucket=bucket, Key=key)
 
     # if TagSet is empty, it returns an empty list
@@ -27,7 +34,7 @@ def put_s3_object_tag_list(
 ):
     bucket, key = s3_utils.get_bucket_key_from_s3_uri(s3_uri)
     if not s3_client:
-        s3_client = boto3.client('s3')
+        s3_client = clients.get_client('s3')
     s3_client.put_object_tagging(Bucket=bucket,
                                  Key=key,
                                  Tagging={
@@ -35,11 +42,88 @@ def put_s3_object_tag_list(
                                  })
 
 
+# rounds of reading back the written tags and re-applying a change another writer overwrote
+TAG_PLAN_MAX_APPLY_ATTEMPTS = 3
+
+# objects written by TagPlan.apply kept to be verified, the rest are not verified
+TAG_PLAN_MAX_VERIFY = 100000
+
+
+# Access tokens are spread over up to SHOT_LOCKER_TAG_KEYS tags, ShotLockerAccess,
+# ShotLockerAccess1, ... so an object is not limited to the tokens that fit in one
+# 256 character tag value. A token is placed in the tag picked from a hash of the
+# token, so a bucket policy statement only needs a condition on one tag. Tokens
+# already on an object stay in the tag they are in, tokens written when every token
+# was stored in ShotLockerAccess keep matching their policy statements until the
+# bucket is migrated (bucket.migrate_shot_locker_bucket_access_tags).
+# Tags without tokens are not written, leaving the rest of the 10 object tags to
+# other applications.
+SHOT_LOCKER_TAG_KEY = 'ShotLockerAccess'
+SHOT_LOCKER_TAG_KEYS = 4
+SHOT_LOCKER_TAG_VALUE_MAX_LENGTH = 256
+S3_OBJECT_MAX_TAGS = 10
+
+
+def get_shot_locker_tag_key(access_token):
+    """ @returns the tag key the access token is stored in """
+    shard = zlib.crc32(access_token.encode()) % SHOT_LOCKER_TAG_KEYS
+    return SHOT_LOCKER_TAG_KEY if shard == 0 else f'{SHOT_LOCKER_TAG_KEY}{shard}'
+
+
+def is_shot_locker_tag_key(tag_key):
+    return tag_key == SHOT_LOCKER_TAG_KEY or (tag_key.startswith(SHOT_LOCKER_TAG_KEY) 
+                                              and tag_key[len(SHOT_LOCKER_TAG_KEY):].isdigit())
+
+
 def get_shot_locker_access_token_list(tag_list=None):
+    access_token_list = []
+    for tag in tag_list:
+        if is_shot_locker_tag_key(tag['Key']) and tag['Value']:
+            for access_token in tag['Value'].split(':'):
+                if access_token and access_token not in access_token_list:
+                    access_token_list.append(access_token)
+    return access_token_list
+
+
+def get_shot_locker_access_token_tag_keys(tag_list):
+    """ @returns {access token: tag key it is stored in} """
+    tag_keys = {}
     for tag in tag_list:
-        if tag['Key'] == 'ShotLockerAccess':
-            return tag['Value'].split(':') if tag['Value'] else []
-    return []
+        if is_shot_locker_tag_key(tag['Key']) and tag['Value']:
+            for access_token in tag['Value'].split(':'):
+                if access_token:
+                    tag_keys.setdefault(access_token, tag['Key'])
+    return tag_keys
+
+
+def encode_shot_locker_access_tags(access_token_list, tag_list=None, *, rehash=False):
+    """
+    @returns tag_list with its ShotLockerAccess tags replaced by the tags holding
+    access_token_list, the other tags are kept as they are. Tokens already in
+    tag_list stay in their tag, new tokens (every token with rehash) go in the tag
+    picked from their hash.
+    """
+    current = {} if rehash else get_shot_locker_access_token_tag_keys(tag_list or [])
+
+    values = {}
+    for access_token in access_token_list:
+        tag_key = current.get(access_token) or get_shot_locker_tag_key(access_token)
+        values.setdefault(tag_key, []).append(access_token)
+
+    encoded = [tag for tag in (tag_list or []) if not is_shot_locker_tag_key(tag['Key'])]
+    for tag_key in sorted(values):
+        tag_value = ':'.join(values[tag_key])
+        if len(tag_value) > SHOT_LOCKER_TAG_VALUE_MAX_LENGTH:
+            raise ValueError(f'shotlocker.object_tag: too many access tokens for tag {tag_key}')
+        encoded.append({
+            'Key': tag_key,
+            'Value': tag_value
+        })
+
+    if len(encoded) > S3_OBJECT_MAX_TAGS:
+        raise ValueError(f'shotlocker.object_tag: {len(encoded)} tags is more than the {S3_OBJECT_MAX_TAGS} tags of an object')
+
+    return encoded
 
 
 def put_shot_locker_access_token_list(
@@ -49,25 +133,11 @@ def put_shot_locker_access_token_list(
     *, 
     s3_client=None
 ):
-    tag_value = ':'.join(access_token_list)
-
     tag_list = in_tag_list
     if tag_list is None:
         tag_list = get_s3_object_tag_list(s3_uri, s3_client=s3_client)
 
-    updated = False
-    for tag in tag_list:
-        if tag['Key'] == 'ShotLockerAccess':
-            tag['Value'] = tag_value
-            updated = True
-
-    if not updated:
-        tag_list.append({
-            'Key': 'ShotLockerAccess',
-            'Value': tag_value
-        })
-
-    put_s3_object_tag_list(s3_uri, tag_list, s3_client=s3_client)
+    put_s3_object_tag_list(s3_uri, encode_shot_locker_access_tags(access_token_list, tag_list), s3_client=s3_client)
 
 
 def add_access_token_to_shot_locker_tag(
@@ -119,29 +189,361 @@ def get_shot_locker_object_list(
     bucket_name, 
     access_token, 
     *, 
-    s3_client=None
+    s3_client=None,
+    full_scan=False
 ):
+    """
+    @returns the s3 uris of the objects the access token grants, the objects of its
+    prefix grants and the objects tagged with it read from the token index. Without
+    an index (e.g. edits tagged before the index existed) or with full_scan the tags
+    of every object in the bucket are read.
+    """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    # objects of the directories granted as a whole carry no tags
     object_list = []
+    for prefix in token_index.read_prefix_grants(bucket_name, access_token, s3_client=s3_client):
+        for key in s3_utils.iter_objects(bucket_name, prefix, s3_client=s3_client, recursive=True):
+            object_list.append(f"s3://{bucket_name}/{key}")
+
+    if not full_scan:
+        keys = token_index.read_token_index(bucket_name, access_token, s3_client=s3_client)
+        if keys is not None:
+            return sorted(set(object_list + [f"s3://{bucket_name}/{key}" for key in keys]))
+
+    for key in s3_utils.iter_objects(bucket_name, s3_client=s3_client, recursive=True):
+        response = s3_client.get_object_tagging(Bucket=bucket_name, Key=key)
+        if access_token in get_shot_locker_access_token_list(response['TagSet']):
+            object_list.append(f"s3://{bucket_name}/{key}")
+
+    return sorted(set(object_list))
+
+
+class TagPlan:
+    """
+    Plan of ShotLockerAccess tag changes for many objects. Token adds and removes
+    for the same object are merged into a single write.
+
+        plan = TagPlan()
+        plan.add_token(s3_uri, access_token)
+        plan.prepare()      # read the current tags in parallel
+        plan.writes         # inspect the writes, no-op changes are skipped
+        plan.execute()      # write the changed tags and verify them
+
+    S3 has no conditional write of object tags, so a concurrent writer (e.g. another
+    edit tagging the same object) can overwrite a change between its read and write.
+    The changes are kept as deltas and, once the writes are done, verify() reads the
+    written tags back and re-applies the delta where it was overwritten, so each plan
+    ends with its own change in place.
+    """
+
+    def __init__(self, *, s3_client=None, max_workers=clients.MAX_WORKERS, concurrency=None, verify=True):
+        """
+        concurrency (concurrency.AdaptiveConcurrency) limits the tag requests in flight,
+        share one between plans to keep what it learned about the bucket.
+        verify keeps the objects written by apply() for verify()
+        """
+        self.s3_client = s3_client if s3_client else clients.get_client('s3')
+        self.concurrency = concurrency
+        self.max_workers = max(max_workers, concurrency.max_limit) if concurrency else max_workers
+        # s3_uri -> (clear, {access_token: add})
+        self.changes = {}
+        # s3_uri -> (tag_list read, access token list to write)
+        self.writes = {}
+        self.skipped = []
+        self.missing = []
+        self.written = []
+        self.failed = {}
+        self.reapplied = 0
+        # s3_uri -> change of the objects written and not verified yet
+        self._written_changes = {}
+        self._verify_writes = verify
+        self._lock = threading.Lock()
+
+    def add_token(self, s3_uri, access_token):
+        self._get_change(s3_uri)[1][access_token] = True
 
+    def remove_token(self, s3_uri, access_token):
+        self._get_change(s3_uri)[1][access_token] = False
+
+    def clear_tokens(self, s3_uri):
+        """ remove every access token, later adds still apply """
+        self.changes[s3_uri] = (True, {})
+
+    def _get_change(self, s3_uri):
+        if s3_uri not in self.changes:
+            self.changes[s3_uri] = (False, {})
+        return self.changes[s3_uri]
+
+    def apply_change(self, s3_uri, access_token_list):
+        """ @returns the access token list after the planned change of the object """
+        return _apply_change(self.changes[s3_uri], access_token_list)
+
+    def prepare(self):
+        """ read the current tags of the planned objects and compute the writes """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for s3_uri, tag_list in zip(self.changes, executor.map(self._read_tags, self.changes)):
+                if isinstance(tag_list, Exception):
+                    self.failed[s3_uri] = str(tag_list)
+                elif tag_list is None:
+                    self.missing.append(s3_uri)
+                else:
+                    self._plan_write(s3_uri, tag_list)
+        return self
+
+    def execute(self):
+        """ write the planned tags and verify them, @returns the summary """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for s3_uri, error in zip(self.writes, executor.map(self._write_tags, self.writes)):
+                if error:
+                    self.failed[s3_uri] = error
+                else:
+                    self.written.append(s3_uri)
+                    self._written_changes[s3_uri] = self.changes[s3_uri]
+        return self.verify()
+
+    def verify(self):
+        """
+        Read back the tags of the objects written since the last verify and re-apply
+        the change of the objects another writer overwrote meanwhile, for up to
+        TAG_PLAN_MAX_APPLY_ATTEMPTS rounds. Objects still overwritten after that are failed.
+        @returns the summary
+        """
+        with self._lock:
+            pending = self._written_changes
+            self._written_changes = {}
+
+        for attempt in range(TAG_PLAN_MAX_APPLY_ATTEMPTS + 1):
+            if not pending:
+                break
+            reapply = attempt < TAG_PLAN_MAX_APPLY_ATTEMPTS
+
+            # transient errors (e.g. throttles) are retried by the work queue
+            results = {}
+
+            def _verify(item):
+                results[item[0]] = self._verify_tags(*item, reapply)
+
+            summary = work_queue.run_work_queue(pending.items(), 
+                                                _verify, 
+                                                key_fn=lambda item: item[0], 
+                                                max_workers=self.max_workers)
+            self.failed.update(summary.failed)
+
+            reapplied = {}
+            for s3_uri, change in pending.items():
+                result = results.get(s3_uri)
+                if result is True:
+                    reapplied[s3_uri] = change
+                elif result:
+                    self.failed[s3_uri] = result
+            self.reapplied += len(reapplied)
+            pending = reapplied
+
+        return self.get_summary()
+
+    def get_summary(self):
+        return {
+            'planned': len(self.changes),
+            'written': len(self.written),
+            'skipped': len(self.skipped),
+            'missing': len(self.missing),
+            'failed': len(self.failed),
+            'reapplied': self.reapplied,
+        }
+
+    def _plan_write(self, s3_uri, tag_list):
+        access_token_list = get_shot_locker_access_token_list(tag_list)
+        updated = self.apply_change(s3_uri, access_token_list)
+        if updated == access_token_list:
+            self.skipped.append(s3_uri)
+        else:
+            self.writes[s3_uri] = (tag_list, updated)
+
+    def _call(self, s3_uri, fn, *args, **kwargs):
+        if self.concurrency:
+            return self.concurrency.call(s3_uri, fn, *args, **kwargs)
+        return fn(*args, **kwargs)
+
+    def _read_tags(self, s3_uri):
+        try:
+            return self._call(s3_uri, get_s3_object_tag_list, s3_uri, s3_client=self.s3_client)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey':
+                return None
+            return e
+        except Exception as e:
+            return e
+
+    def apply(self, s3_uri) -> bool:
+        """
+        Read, plan and write the change of one object without holding it in the plan,
+        for streaming executors (e.g. work_queue.run_work_queue). Errors are raised.
+        @returns True if the tags were written
+        """
+        try:
+            tag_list = self._call(s3_uri, get_s3_object_tag_list, s3_uri, s3_client=self.s3_client)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                raise
+            self.changes.pop(s3_uri, None)
+            return False
+
+        access_token_list = get_shot_locker_access_token_list(tag_list)
+        updated = self.apply_change(s3_uri, access_token_list)
+        if updated != access_token_list:
+            self._put_tags(s3_uri, tag_list, updated)
+            if self._verify_writes:
+                with self._lock:
+                    if len(self._written_changes) < TAG_PLAN_MAX_VERIFY:
+                        self._written_changes[s3_uri] = self.changes[s3_uri]
+
+        # keep the change of a failed object so it can be applied again
+        self.changes.pop(s3_uri, None)
+        return updated != access_token_list
+
+    def _write_tags(self, s3_uri):
+        """ @returns the error of the write or None """
+        tag_list, access_token_list = self.writes[s3_uri]
+        try:
+            self._put_tags(s3_uri, tag_list, access_token_list)
+        except Exception as e:
+            return str(e)
+        return None
+
+    def _verify_tags(self, s3_uri, change, reapply):
+        """
+        @returns None when the change is in place (or the object is gone), True when
+        it was re-applied, else the error
+        """
+        try:
+            tag_list = self._call(s3_uri, get_s3_object_tag_list, s3_uri, s3_client=self.s3_client)
+            current = get_shot_locker_access_token_list(tag_list)
+            expected = _apply_change(change, current)
+            if current == expected:
+                return None
+            if not reapply:
+                return f'tags changed concurrently {TAG_PLAN_MAX_APPLY_ATTEMPTS} times'
+
+            cwprint(f'shotlocker.object_tag.TagPlan: re-applying tag change of {s3_uri}')
+            self._put_tags(s3_uri, tag_list, expected)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey':
+                return None
+            if work_queue.is_transient_error(e):
+                raise
+            return str(e)
+        except Exception as e:
+            if work_queue.is_transient_error(e):
+                raise
+            return str(e)
+
+    def _put_tags(self, s3_uri, tag_list, access_token_list):
+        """ write the access token list over the tags read """
+        self._call(s3_uri,
+                   put_shot_locker_access_token_list,
+                   s3_uri, 
+                   access_token_list, 
+                   [dict(tag) for tag in tag_list], 
+                   s3_client=self.s3_client)
+
+
+def _apply_change(change, access_token_list):
+    """ @returns the access token list after a (clear, {access_token: add}) change """
+    clear, tokens = change
+    updated = [] if clear else list(access_token_list)
+    for access_token, add in tokens.items():
+        if add and access_token not in updated:
+            updated.append(access_token)
+        elif not add and access_token in updated:
+            updated.remove(access_token)
+    return updated
+
+
+def tag_objects(
+    s3_uris, 
+    access_token, 
+    *, 
+    add=True, 
+    s3_client=None, 
+    concurrency=None, 
+    stop_fn=None
+):
+    """
+    Add (or remove) the access token on each object, streamed through a bounded
+    work queue. Pass the s3_uris sorted so summary.last_key can be used as a cursor
+    when stop_fn (e.g. checkpoint.Deadline.expired) stops the work early.
+    @returns work_queue.WorkSummary
+    """
+    tag_plan = TagPlan(s3_client=s3_client, concurrency=concurrency)
+
+    def _tag_object(s3_uri):
+        if add:
+            tag_plan.add_token(s3_uri, access_token)
+        else:
+            tag_plan.remove_token(s3_uri, access_token)
+        return tag_plan.apply(s3_uri)
+
+    summary = work_queue.run_work_queue(s3_uris, 
+                                        _tag_object, 
+                                        max_workers=tag_plan.max_workers, 
+                                        stop_fn=stop_fn)
+
+    # the objects overwritten by a concurrent writer get the token again
+    tag_plan.verify()
+    summary.retried += tag_plan.reapplied
+    for s3_uri, error in tag_plan.failed.items():
+        summary.failed[s3_uri] = error
+
+    return summary
+
+
+def migrate_shot_locker_access_tags(
+    s3_uris, 
+    *, 
+    s3_client=None, 
+    concurrency=None, 
+    stop_fn=None
+):
+    """
+    Rewrite the access tokens of each object in the tags picked from their hash, e.g.
+    objects tagged when every token was stored in ShotLockerAccess. Objects already
+    in place are skipped. The bucket policy must grant on both tags first, see
+    bucket.migrate_shot_locker_bucket_access_tags.
+    @returns work_queue.WorkSummary
+    """
     if not s3_client:
-        s3_client = boto3.client('s3')
-    objs = s3_client.list_objects_v2(Bucket=bucket_name)
+        s3_client = clients.get_client('s3')
 
-    while True:
-        for obj in objs['Contents']:
-            response = s3_client.get_object_tagging(Bucket=bucket_name, Key=obj['Key'])
-            for tag_set in response['TagSet']:
-                if tag_set['Key'] == 'ShotLockerAccess':
-                    if access_token in tag_set['Value']:
-                        object_list.append(f"s3://{bucket_name}/{obj['Key']}")
+    def _call(s3_uri, fn, *args, **kwargs):
+        if concurrency:
+            return concurrency.call(s3_uri, fn, *args, **kwargs)
+        return fn(*args, **kwargs)
 
-        if 'NextContinuationToken' not in objs:
-            break
-        objs = s3_client.list_objects_v2(Bucket=bucket_name,
-                                         ContinuationToken=objs['NextContinuationToken'])
+    def _migrate_object(s3_uri):
+        try:
+            tag_list = _call(s3_uri, get_s3_object_tag_list, s3_uri, s3_client=s3_client)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey':
+                return False
+            raise
 
-    return object_list
+        access_token_list = get_shot_locker_access_token_list(tag_list)
+        encoded = encode_shot_locker_access_tags(access_token_list, tag_list, rehash=True)
+        if _tag_set(encoded) == _tag_set(tag_list):
+            return False
 
+        _call(s3_uri, put_s3_object_tag_list, s3_uri, encoded, s3_client=s3_client)
+        return True
 
+    max_workers = max(clients.MAX_WORKERS, concurrency.max_limit) if concurrency else clients.MAX_WORKERS
+    return work_queue.run_work_queue(s3_uris, 
+                                     _migrate_object, 
+                                     max_workers=max_workers, 
+                                     stop_fn=stop_fn)
 
 
+def _tag_set(tag_list):
+    return {(tag['Key'], tag['Value']) for tag in tag_list}
@@ -15,6 +15,36 @@ def is_media_reference_mssing(clip):
     return isinstance(clip.media_reference, otio.schema.MissingReference)
 
 
+def get_clip_frame_range(clip, first_frame, last_frame, *, handles=0):
+    """
+    Map the part of the media used by the clip to frame numbers of an image sequence
+    that holds the media available range as frames first_frame to last_frame.
+    @returns inclusive (first, last) frames used plus handles, or None if unknown
+    """
+    source_range = clip.source_range
+    try:
+        available_range = clip.media_reference.available_range
+    except AttributeError:
+        available_range = None
+
+    # without the available range the sequence frame numbers can not be mapped
+    if not source_range or not available_range:
+        return None
+
+    rate = available_range.start_time.rate
+    offset = otio.opentime.to_frames(source_range.start_time - available_range.start_time, rate)
+    duration = otio.opentime.to_frames(source_range.duration, rate)
+    if duration <= 0:
+        return None
+
+    first = max(first_frame, first_frame + offset - handles)
+    last = min(last_frame, first_frame + offset + duration - 1 + handles)
+    if first > last:
+        return None
+
+    return (first, last)
+
+
 def find_media_url_in_clip(clip, *, include_missing_ref=False):
     url = None
     if isinstance(clip.media_reference, otio.schema.ExternalReference):
@@ -0,0 +1,139 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import json
+import time
+import datetime
+import threading
+from . import clients
+from botocore.exceptions import ClientError
+
+
+# Registry of the active Shot Locker buckets, so checking a bucket does not read the
+# tags of every bucket in the account. Each active locker has a parameter in the SSM
+# Parameter Store, bucket.set_shot_locker_bucket writes it when a locker is enabled
+# and deletes it when it is disabled, the parameters of deleted buckets are pruned
+# when the buckets are scanned. A bucket that is not registered is checked from its
+# tags.
+#
+#   /ShotLocker/Lockers/{bucket}    {"active": true, "update_time": "..."}
+#
+# Lookups are cached in the process for LOCKER_REGISTRY_TTL seconds, the cache
+# survives warm lambda invocations. Buckets that are not registered are cached for
+# LOCKER_REGISTRY_MISS_TTL seconds only, so a locker enabled by another process is
+# found soon.
+
+LOCKER_REGISTRY_PATH = '/ShotLocker/Lockers/'
+LOCKER_REGISTRY_TTL = float(os.environ.get('SHOTLOCKER_REGISTRY_TTL', '60'))
+LOCKER_REGISTRY_MISS_TTL = float(os.environ.get('SHOTLOCKER_REGISTRY_MISS_TTL', '5'))
+
+# bucket name -> (expire time, entry or None when the bucket is not registered)
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def get_locker_parameter_name(bucket_name):
+    return f'{LOCKER_REGISTRY_PATH}{bucket_name}'
+
+
+def get_locker(bucket_name, *, ssm_client=None, use_cache=True):
+    """
+    @returns the registry entry of the bucket {'active': bool, 'update_time': str},
+    or None when the bucket is not registered
+    """
+    if use_cache:
+        with _cache_lock:
+            cached = _cache.get(bucket_name)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+    if not ssm_client:
+        ssm_client = clients.get_client('ssm')
+
+    try:
+        response = ssm_client.get_parameter(Name=get_locker_parameter_name(bucket_name))
+        entry = json.loads(response['Parameter']['Value'])
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ParameterNotFound':
+            raise
+        entry = None
+
+    _set_cache(bucket_name, entry)
+    return entry
+
+
+def set_locker(bucket_name, active, *, ssm_client=None):
+    """ register the bucket as an active or inactive locker, @returns the entry """
+    if not ssm_client:
+        ssm_client = clients.get_client('ssm')
+
+    entry = {
+        'active': active,
+        'update_time': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S') + 'Z',
+    }
+    ssm_client.put_parameter(Name=get_locker_parameter_name(bucket_name),
+                             Value=json.dumps(entry),
+                             Type='String',
+                             Overwrite=True)
+
+    _set_cache(bucket_name, entry)
+    return entry
+
+
+def delete_locker(bucket_name, *, ssm_client=None):
+    if not ssm_client:
+        ssm_client = clients.get_client('ssm')
+
+    try:
+        ssm_client.delete_parameter(Name=get_locker_parameter_name(bucket_name))
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ParameterNotFound':
+            raise
+
+    _set_cache(bucket_name, None)
+
+
+def list_lockers(*, ssm_client=None):
+    """ @returns {bucket name: entry} of every registered locker """
+    if not ssm_client:
+        ssm_client = clients.get_client('ssm')
+
+    lockers = {}
+    kwargs = {'Path': LOCKER_REGISTRY_PATH}
+    while True:
+        response = ssm_client.get_parameters_by_path(**kwargs)
+        for parameter in response.get('Parameters', []):
+            lockers[parameter['Name'][len(LOCKER_REGISTRY_PATH):]] = json.loads(parameter['Value'])
+        if 'NextToken' not in response:
+            break
+        kwargs['NextToken'] = response['NextToken']
+
+    for bucket_name, entry in lockers.items():
+        _set_cache(bucket_name, entry)
+
+    return lockers
+
+
+def prune_lockers(bucket_names, *, ssm_client=None):
+    """
+    delete the registry entries of the buckets not in bucket_names, e.g. the names
+    listed by list_buckets
+    @returns list of the bucket names unregistered
+    """
+    bucket_names = set(bucket_names)
+    pruned = [name for name in list_lockers(ssm_client=ssm_client) if name not in bucket_names]
+    for bucket_name in pruned:
+        delete_locker(bucket_name, ssm_client=ssm_client)
+    return pruned
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
+
+
+def _set_cache(bucket_name, entry):
+    ttl = LOCKER_REGISTRY_TTL if entry is not None else LOCKER_REGISTRY_MISS_TTL
+    with _cache_lock:
+        _cache[bucket_name] = (time.monotonic() + ttl, entry)
@@ -1,12 +1,28 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import gzip
 import json
+import contextlib
+import collections
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from .cwprint import cwprint_exc
-import boto3
+from . import clients
 from botocore.exceptions import ClientError
 
 
+# parallel listing: requests in flight, prefix levels explored to find
+# enough shards and pages buffered for each shard (and for the pages discovered ahead)
+LIST_MAX_WORKERS = clients.MAX_WORKERS
+LIST_SHARD_MAX_DEPTH = 3
+LIST_SHARD_QUEUE_SIZE = 8
+
+# list_objects_v2 returns up to 1000 keys a page
+LIST_PAGE_SIZE = 1000
+
+
 def get_enabled_tag_value_list():
     return ('Enable', 'enable', 'Enabled', 'enabled', 'True', 'true', 't', '1', 'On', 'on')
 
@@ -21,13 +37,14 @@ def get_bucket_key_from_s3_uri(s3_uri):
     if 'access_point' in parts[0]:
         return (parts[0] + '/' + parts[1], parts[2])
 
-    return (parts[0], parts[1] + '/' + parts[2])
+    # keys at the root of the bucket have no slash
+    return (parts[0], '/'.join(parts[1:]))
 
 
 def does_s3_object_exist(s3_uri, *, s3_client=None):
     bucket, key = get_bucket_key_from_s3_uri(s3_uri)
     if not s3_client:
-        s3_client = boto3.client('s3')
+        s3_client = clients.get_client('s3')
     try:
         s3_client.head_object(Bucket=bucket, Key=key)
     except ClientError:
@@ -42,48 +59,327 @@ def list_all_objects(
     s3_client=None, 
     recursive=False, 
     names_only=True,
-    content_callback_fn=None
+    content_callback_fn=None,
+    parallel=False,
+    max_workers=LIST_MAX_WORKERS
 ):
-
+    """
+    @returns list of the objects under the prefix
+    content_callback_fn is called with each page of objects as it is listed,
+    if it returns True the listing stops early
+    parallel lists a recursive listing with max_workers requests in flight,
+    the objects are returned in the same order as the sequential listing
+    """
     object_list = []
 
-    if not s3_client:
-        s3_client = boto3.client('s3')
+    pages = iter_pages(bucket, 
+                       prefix, 
+                       s3_client=s3_client, 
+                       recursive=recursive, 
+                       names_only=names_only, 
+                       parallel=parallel, 
+                       max_workers=max_workers)
 
-    delimiter = '' if recursive else '/'
+    with contextlib.closing(pages):
+        for page in pages:
+            object_list.extend(page)
 
-    try:
-        objs = s3_client.list_objects_v2(Bucket=bucket, Prefix=prefix, Delimiter=delimiter)
-    except:
-        print(f"shotlocker.s3_utils.list_all_objects: ERROR accessing bucket {bucket} prefix {prefix} delimiter {delimiter}")
-        raise
+            if content_callback_fn and content_callback_fn(page):
+                break
+
+    return object_list
 
-    while True:
-        # Contents key only appears if there are actual contents
-        if 'Contents' not in objs:
-            break
 
-        latest_objs = []
-        for obj in objs['Contents']:
+def iter_pages(
+    bucket:str, 
+    prefix:str='', 
+    *, 
+    s3_client=None, 
+    recursive=False, 
+    names_only=True,
+    parallel=False,
+    max_workers=LIST_MAX_WORKERS,
+    start_after=None
+):
+    """
+    Generator of the pages of objects under the prefix, the listing is never held
+    in memory. Close the generator when stopping early so a parallel listing stops
+    its requests (or use contextlib.closing).
+    start_after lists only the keys that sort after it, it is always listed sequentially
+    """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    if parallel and recursive and not start_after:
+        pages = _iter_pages_parallel(s3_client, bucket, prefix, max_workers)
+    else:
+        delimiter = '' if recursive else '/'
+        pages = (objs['Contents'] for objs in _iter_list_responses(s3_client, bucket, prefix, delimiter, start_after)
+                 if 'Contents' in objs)
+
+    with contextlib.closing(pages):
+        for page in pages:
             if names_only:
-                latest_objs.append(obj['Key'])
+                yield [obj['Key'] for obj in page]
             else:
-                latest_objs.append(obj)
+                yield page
+
+
+def iter_objects(
+    bucket:str, 
+    prefix:str='', 
+    **kwargs
+):
+    """
+    Generator of the objects under the prefix, takes the iter_pages keyword arguments
+    """
+    pages = iter_pages(bucket, prefix, **kwargs)
+    with contextlib.closing(pages):
+        for page in pages:
+            yield from page
+
+
+def list_keys_in_range(
+    bucket:str, 
+    prefix:str, 
+    first_key=None, 
+    last_key=None, 
+    *, 
+    s3_client=None
+):
+    """
+    @returns set of the keys under the prefix from first_key to last_key (inclusive),
+    a missing bound lists from the start or to the end of the prefix
+    """
+    # StartAfter is exclusive, start after a key that sorts just before first_key
+    start_after = first_key[:-1] if first_key else None
+
+    keys = set()
+
+    objects = iter_objects(bucket, prefix, s3_client=s3_client, recursive=True, start_after=start_after)
+    with contextlib.closing(objects):
+        for key in objects:
+            if last_key is not None and key > last_key:
+                break
+            keys.add(key)
+
+    return keys
 
-        if content_callback_fn:
-            content_callback_fn(latest_objs)
 
-        object_list.extend(latest_objs)
+class ListingCache:
+    """
+    Per invocation cache of key range listings shared by the references of an edit.
+    Entries are keyed by (bucket, prefix) and remember the key range listed. Call
+    plan() with every range before listing so overlapping references of the same
+    prefix are served by one listing.
+    """
+
+    def __init__(self, *, s3_client=None):
+        self.s3_client = s3_client if s3_client else clients.get_client('s3')
+        self.hits = 0
+        self.misses = 0
+        self._planned = {}
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._prefix_locks = {}
+
+    def plan(self, bucket, prefix, first_key=None, last_key=None):
+        """ widen the range listed for the prefix on its first miss """
+        with self._lock:
+            cache_key = (bucket, prefix)
+            self._planned[cache_key] = _union_key_range(self._planned.get(cache_key), (first_key, last_key))
+
+    def list_keys(self, bucket, prefix, first_key=None, last_key=None):
+        """
+        @returns set of keys under the prefix, at least the keys from first_key to
+        last_key, check membership rather than iterating the result
+        """
+        cache_key = (bucket, prefix)
+        with self._lock:
+            prefix_lock = self._prefix_locks.setdefault(cache_key, threading.Lock())
+
+        # concurrent lookups of the same prefix wait for a single listing
+        with prefix_lock:
+            entry = self._entries.get(cache_key)
+            if entry and _key_range_covers(entry[0], (first_key, last_key)):
+                with self._lock:
+                    self.hits += 1
+                return entry[1]
+
+            key_range = (first_key, last_key)
+            with self._lock:
+                self.misses += 1
+                key_range = _union_key_range(self._planned.get(cache_key), key_range)
+            if entry:
+                key_range = _union_key_range(entry[0], key_range)
+
+            keys = list_keys_in_range(bucket, prefix, *key_range, s3_client=self.s3_client)
+            self._entries[cache_key] = (key_range, keys)
+            return keys
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'prefixes': len(self._entries),
+        }
+
+
+def _union_key_range(key_range, other):
+    if key_range is None:
+        return other
+    # None is an open bound
+    first = None if key_range[0] is None or other[0] is None else min(key_range[0], other[0])
+    last = None if key_range[1] is None or other[1] is None else max(key_range[1], other[1])
+    return (first, last)
+
+
+def _key_range_covers(key_range, other):
+    first_covered = key_range[0] is None or (other[0] is not None and key_range[0] <= other[0])
+    last_covered = key_range[1] is None or (other[1] is not None and key_range[1] >= other[1])
+    return first_covered and last_covered
+
+
+def _iter_list_responses(s3_client, bucket, prefix, delimiter, start_after=None):
+    kwargs = {
+        'Bucket': bucket,
+        'Prefix': prefix,
+        'Delimiter': delimiter,
+    }
+    if start_after:
+        kwargs['StartAfter'] = start_after
+
+    while True:
+        try:
+            objs = s3_client.list_objects_v2(**kwargs)
+        except:
+            print(f"shotlocker.s3_utils.list_all_objects: ERROR accessing bucket {bucket} prefix {prefix} delimiter {delimiter}")
+            raise
+
+        yield objs
 
         if 'NextContinuationToken' not in objs:
             break
 
-        objs = s3_client.list_objects_v2(Bucket=bucket, 
-                                         Prefix=prefix,
-                                         Delimiter=delimiter,
-                                         ContinuationToken=objs['NextContinuationToken'])
+        kwargs['ContinuationToken'] = objs['NextContinuationToken']
 
-    return object_list
+
+def _iter_list_shards(s3_client, bucket, prefix, max_workers, max_depth=LIST_SHARD_MAX_DEPTH):
+    """
+    Generator splitting a recursive listing into shards in key order. A shard is
+    either a prefix still to be listed or a page of objects found while discovering
+    the prefixes. Each level is listed page by page with a delimiter, its prefixes are
+    expanded up to max_depth levels while fewer than max_workers were found.
+    """
+    found = 0
+
+    def _expand(shard_prefix, depth):
+        nonlocal found
+        for objs in _iter_list_responses(s3_client, bucket, shard_prefix, '/'):
+            prefixes = [p['Prefix'] for p in objs.get('CommonPrefixes', [])]
+            found += len(prefixes)
+
+            # every key under a common prefix sorts next to the prefix itself, so
+            # the shards in this order list the objects in the sequential order
+            entries = [(obj['Key'], obj) for obj in objs.get('Contents', [])]
+            entries.extend((p, p) for p in prefixes)
+            entries.sort(key=lambda entry: entry[0])
+
+            page = []
+            for _, entry in entries:
+                if not isinstance(entry, str):
+                    page.append(entry)
+                    continue
+                if page:
+                    yield page
+                    page = []
+                if depth + 1 < max_depth and found < max_workers:
+                    yield from _expand(entry, depth + 1)
+                else:
+                    yield entry
+            if page:
+                yield page
+
+    yield from _expand(prefix, 0)
+
+
+def _iter_pages_parallel(s3_client, bucket, prefix, max_workers):
+    """
+    Generator of the pages of a recursive listing, the prefix shards are listed
+    concurrently and the pages are yielded in key order as they arrive. The shards
+    are discovered ahead of the pages yielded, up to 2 * max_workers prefixes and
+    LIST_SHARD_QUEUE_SIZE pages of objects.
+    """
+    shards = _iter_list_shards(s3_client, bucket, prefix, max_workers)
+
+    stop = threading.Event()
+
+    def _put(shard_queue, item):
+        # bounded queue, wait for the consumer unless the listing was stopped
+        while not stop.is_set():
+            try:
+                shard_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _list_shard(shard_prefix, shard_queue):
+        try:
+            for objs in _iter_list_responses(s3_client, bucket, shard_prefix, ''):
+                if stop.is_set():
+                    return
+                if 'Contents' in objs:
+                    _put(shard_queue, objs['Contents'])
+        except Exception as e:
+            _put(shard_queue, e)
+            return
+        _put(shard_queue, None)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        # pages of objects and queues of the prefixes being listed, in key order
+        pending = collections.deque()
+        listing = 0
+        buffered = 0
+
+        while True:
+            # the executor starts the prefixes in the order submitted, so the first
+            # pending queue always has a worker and the ones ahead of it never block it
+            while shards and listing < 2 * max_workers and buffered < LIST_SHARD_QUEUE_SIZE:
+                shard = next(shards, None)
+                if shard is None:
+                    shards = None
+                elif isinstance(shard, str):
+                    shard_queue = queue.Queue(maxsize=LIST_SHARD_QUEUE_SIZE)
+                    executor.submit(_list_shard, shard, shard_queue)
+                    pending.append(shard_queue)
+                    listing += 1
+                else:
+                    pending.append(shard)
+                    buffered += 1
+
+            if not pending:
+                break
+
+            shard = pending.popleft()
+            if not isinstance(shard, queue.Queue):
+                buffered -= 1
+                yield shard
+                continue
+
+            listing -= 1
+            while True:
+                page = shard.get()
+                if page is None:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                yield page
+    finally:
+        stop.set()
+        if shards:
+            shards.close()
+        executor.shutdown(wait=True, cancel_futures=True)
 
 
 def list_all_prefixes(
@@ -97,7 +393,7 @@ def list_all_prefixes(
     prefix_list = []
 
     if not s3_client:
-        s3_client = boto3.client('s3')
+        s3_client = clients.get_client('s3')
 
     delimiter = '' if recursive else '/'
 
@@ -110,14 +406,32 @@ def list_all_prefixes(
     return prefix_list
 
 
+def iter_prefixes(
+    bucket:str, 
+    prefix:str='', 
+    *, 
+    s3_client=None
+):
+    """
+    Generator of the common prefixes directly under the prefix, every page of the listing
+    """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    for objs in _iter_list_responses(s3_client, bucket, prefix, '/'):
+        for obj in objs.get('CommonPrefixes', []):
+            yield obj['Prefix']
+
+
 def read_json_from_s3(
     bucket,
     s3_key,
     *,
-    s3_client=None
+    s3_client=None,
+    compressed=False
 ):
     if not s3_client:
-        s3_client = boto3.client('s3')
+        s3_client = clients.get_client('s3')
 
     try:
         response = s3_client.get_object(Bucket=bucket, Key=s3_key)
@@ -126,9 +440,11 @@ def read_json_from_s3(
         raise 
 
     # get the contents of the object
-    obj = response['Body'].read().decode()
+    obj = response['Body'].read()
+    if compressed:
+        obj = gzip.decompress(obj)
 
-    return json.loads(obj)
+    return json.loads(obj.decode())
 
 
 def write_json_to_s3(
@@ -136,14 +452,19 @@ def write_json_to_s3(
     bucket,
     s3_key,
     *,
-    s3_client=None
+    s3_client=None,
+    compressed=False
 ):
     if not s3_client:
-        s3_client = boto3.client('s3')
+        s3_client = clients.get_client('s3')
 
     # write the file check results
     try:
-        data = json.dumps(json_dict, indent=4).encode()
+        if compressed:
+            # compact separators, the object is not meant to be read by people
+            data = gzip.compress(json.dumps(json_dict, separators=(',', ':')).encode())
+        else:
+            data = json.dumps(json_dict, indent=4).encode()
         s3_client.put_object(Body=data, Bucket=bucket, Key=s3_key)
     except Exception as e:
         cwprint_exc(f'Error writing updated object {s3_key} to bucket {bucket}.')
@@ -1,13 +1,13 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import boto3
+from . import clients
 from .log import log_entry
 
 
 def get_stepfn_arn(edit_id, arn_config):
     # retrieve the arn for step function
-    ssm_client = boto3.client("ssm")
+    ssm_client = clients.get_client("ssm")
     try:
         response = ssm_client.get_parameter(Name=f"/ShotLocker/Config/{arn_config}")
     except:
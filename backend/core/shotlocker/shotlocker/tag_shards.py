@@ -0,0 +1,286 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+from concurrent.futures import ThreadPoolExecutor
+from . import clients
+from . import checkpoint
+from . import object_tag
+from . import s3_utils
+from . import token_index
+
+
+# The objects of an edit are tagged in shards, a Step Functions Map state runs a
+# worker for each shard and a reduce step merges the shard results.
+#
+#   ShotLocker/TagShards/{edit_id}/{mode}/manifest.json               tagging state without the files
+#   ShotLocker/TagShards/{edit_id}/{mode}/shard-NNNN.json             {'files': [s3_uri, ...]}
+#   ShotLocker/TagShards/{edit_id}/{mode}/shard-NNNN.result.json      shard result, also its checkpoint
+#
+# The worker functions are plain Python, run_tag_shards runs the whole
+# fan-out in process, e.g. for local runs and tests.
+
+TAG_SHARDS_PREFIX = 'ShotLocker/TagShards/'
+TAG_SHARD_SIZE = 5000
+
+
+def get_tag_shards_prefix(edit_id, mode):
+    return f'{TAG_SHARDS_PREFIX}{edit_id}/{mode}/'
+
+
+def get_tag_shards_manifest_key(edit_id, mode):
+    return get_tag_shards_prefix(edit_id, mode) + 'manifest.json'
+
+
+def get_shard_result_key(shard_key):
+    return shard_key[:-len('.json')] + '.result.json'
+
+
+def write_tag_shards(
+    bucket,
+    edit_id,
+    mode,
+    state,
+    *,
+    shard_size=TAG_SHARD_SIZE,
+    s3_client=None
+):
+    """
+    Split state['files_tagged'] into shards and write them with the manifest. The
+    shards and shard results of an earlier run (e.g. one that failed before its
+    reduce step) are deleted first, so no shard resumes from a stale result.
+    @returns list of the Map state items, one {'shard_key': key, 'mode': mode} for each shard
+    """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    delete_tag_shards(bucket, edit_id, mode, s3_client=s3_client)
+
+    prefix = get_tag_shards_prefix(edit_id, mode)
+    files = sorted(state['files_tagged'])
+
+    shard_keys = []
+    for start in range(0, len(files), shard_size):
+        shard_key = f'{prefix}shard-{len(shard_keys):04d}.json'
+        s3_utils.write_json_to_s3({'files': files[start:start + shard_size]}, bucket, shard_key, s3_client=s3_client)
+        shard_keys.append(shard_key)
+
+    manifest = {key: value for key, value in state.items() if key not in ('files_tagged', 'cursor')}
+    manifest['shard_keys'] = shard_keys
+    manifest['shard_size'] = shard_size
+    s3_utils.write_json_to_s3(manifest, bucket, get_tag_shards_manifest_key(edit_id, mode), s3_client=s3_client)
+
+    return [{'shard_key': shard_key, 'mode': mode} for shard_key in shard_keys]
+
+
+def get_tag_delta(
+    bucket, 
+    access_token, 
+    s3_uris, 
+    *, 
+    keep=(), 
+    verify=True, 
+    s3_client=None
+):
+    """
+    Diff the objects to tag with the access token against its token index, the
+    objects recorded as tagged by earlier runs.
+    keep lists objects the edit still uses without tagging them (e.g. prefix grants),
+    they are not stale. With verify the tags of the objects both used and indexed are
+    read, the index records what earlier runs tagged and the tags may have been
+    removed since (e.g. by a bucket disable or outside of Shot Locker).
+    @returns (objects to tag, stale objects to untag, summary) or None without an index
+    """
+    indexed_keys = token_index.read_token_index(bucket, access_token, s3_client=s3_client)
+    if indexed_keys is None:
+        return None
+
+    s3_uris = set(s3_uris)
+    indexed = {f's3://{bucket}/{key}' for key in indexed_keys}
+    in_place = s3_uris & indexed
+    stale = indexed - s3_uris - set(keep)
+
+    summary = {
+        'indexed': len(indexed),
+        'in_place': len(in_place),
+        'stale': len(stale),
+        'verified': verify,
+    }
+
+    if verify and in_place:
+        if not s3_client:
+            s3_client = clients.get_client('s3')
+
+        def _has_token(s3_uri):
+            try:
+                tag_list = object_tag.get_s3_object_tag_list(s3_uri, s3_client=s3_client)
+            except Exception:
+                return False
+            return access_token in object_tag.get_shot_locker_access_token_list(tag_list)
+
+        in_place_list = sorted(in_place)
+        with ThreadPoolExecutor(max_workers=clients.MAX_WORKERS) as executor:
+            untagged = {s3_uri for s3_uri, has_token in zip(in_place_list, executor.map(_has_token, in_place_list))
+                        if not has_token}
+        in_place -= untagged
+        summary['in_place'] = len(in_place)
+        summary['untagged'] = len(untagged)
+
+    return sorted(s3_uris - in_place), sorted(stale), summary
+
+
+def tag_shard(
+    bucket,
+    shard_key,
+    access_token,
+    *,
+    add=True,
+    s3_client=None,
+    tag_s3_client=None,
+    concurrency=None,
+    stop_fn=None
+):
+    """
+    Shard worker, tag the objects of the shard continuing from its last result.
+    tag_s3_client makes the tag requests, defaults to s3_client, see
+    clients.CONCURRENCY_CONFIG_OPTIONS when concurrency paces them.
+    @returns the shard result, result['done'] is False when stop_fn stopped it
+    """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    result_key = get_shard_result_key(shard_key)
+    result = checkpoint.read_checkpoint(bucket, result_key, s3_client=s3_client)
+    if not result:
+        result = {
+            'cursor': None,
+            'written': 0,
+            'skipped': 0,
+            'retried': 0,
+            'failed': {},
+            'done': False,
+        }
+    if result['done']:
+        return result
+
+    files = s3_utils.read_json_from_s3(bucket, shard_key, s3_client=s3_client)['files']
+    cursor = result['cursor']
+    if cursor:
+        files = [s3_uri for s3_uri in files if s3_uri > cursor]
+
+    summary = object_tag.tag_objects(files,
+                                     access_token,
+                                     add=add,
+                                     s3_client=tag_s3_client or s3_client,
+                                     concurrency=concurrency,
+                                     stop_fn=stop_fn)
+
+    result['written'] += summary.succeeded
+    result['skipped'] += summary.skipped
+    result['retried'] += summary.retried
+    result['failed'].update(summary.failed)
+    if summary.last_key:
+        result['cursor'] = summary.last_key
+    result['done'] = not summary.stopped
+
+    checkpoint.write_checkpoint(result, bucket, result_key, s3_client=s3_client)
+
+    return result
+
+
+def reduce_tag_shards(bucket, edit_id, mode, *, s3_client=None, cleanup=True, update_index=True):
+    """
+    Merge the shard results into the tagging state of the edit and update the
+    token index of the edit with the objects tagged or untagged
+    @returns the state, the same as the one written by write_tag_shards with the
+    tag_plan counts and tag_failed filled in and files_tagged listed again
+    """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    manifest_key = get_tag_shards_manifest_key(edit_id, mode)
+    state = s3_utils.read_json_from_s3(bucket, manifest_key, s3_client=s3_client)
+    shard_keys = state.pop('shard_keys')
+    state.pop('shard_size', None)
+
+    def _read_shard(shard_key):
+        files = s3_utils.read_json_from_s3(bucket, shard_key, s3_client=s3_client)['files']
+        result = checkpoint.read_checkpoint(bucket, get_shard_result_key(shard_key), s3_client=s3_client)
+        return files, result
+
+    with ThreadPoolExecutor(max_workers=clients.MAX_WORKERS) as executor:
+        shards = list(executor.map(_read_shard, shard_keys))
+
+    files_tagged = []
+    tag_summary = state['tag_plan']
+    for shard_key, (files, result) in zip(shard_keys, shards):
+        files_tagged.extend(files)
+        if not result or not result['done']:
+            raise RuntimeError(f'shotlocker.tag_shards.reduce_tag_shards: shard {shard_key} is not done')
+        tag_summary['written'] += result['written']
+        tag_summary['skipped'] += result['skipped']
+        tag_summary['retried'] += result['retried']
+        state['tag_failed'].update(result['failed'])
+    tag_summary['failed'] = len(state['tag_failed'])
+    tag_summary['shards'] = len(shard_keys)
+    state['files_tagged'] = files_tagged
+
+    if update_index:
+        # failed objects keep their tags, they stay out of (or in) the index
+        changed_keys = set()
+        for s3_uri in files_tagged:
+            tagged_bucket, key = s3_utils.get_bucket_key_from_s3_uri(s3_uri)
+            if tagged_bucket == bucket and s3_uri not in state['tag_failed']:
+                changed_keys.add(key)
+        if mode == 'add':
+            count = token_index.update_token_index(bucket, edit_id, add_keys=changed_keys, s3_client=s3_client)
+        else:
+            count = token_index.update_token_index(bucket, edit_id, remove_keys=changed_keys, s3_client=s3_client)
+        state['token_index'] = {'count': count}
+
+    if cleanup:
+        delete_tag_shards(bucket, edit_id, mode, s3_client=s3_client)
+
+    return state
+
+
+def delete_tag_shards(bucket, edit_id, mode, *, s3_client=None):
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    prefix = get_tag_shards_prefix(edit_id, mode)
+    for page in s3_utils.iter_pages(bucket, prefix, s3_client=s3_client, recursive=True):
+        if not page:
+            continue
+        s3_client.delete_objects(Bucket=bucket, Delete={
+            'Objects': [{'Key': key} for key in page],
+            'Quiet': True,
+        })
+
+
+def run_tag_shards(
+    bucket,
+    edit_id,
+    mode,
+    state,
+    *,
+    shard_size=TAG_SHARD_SIZE,
+    max_concurrency=10,
+    s3_client=None
+):
+    """
+    Local runner of the fan-out: write the shards, run max_concurrency shard
+    workers at once and reduce, the same steps the state machine runs.
+    @returns the reduced state
+    """
+    items = write_tag_shards(bucket, edit_id, mode, state, shard_size=shard_size, s3_client=s3_client)
+
+    def _run_worker(item):
+        result = {'done': False}
+        while not result['done']:
+            result = tag_shard(bucket, item['shard_key'], edit_id, add=item['mode'] == 'add', s3_client=s3_client)
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        list(executor.map(_run_worker, items))
+
+    return reduce_tag_shards(bucket, edit_id, mode, s3_client=s3_client)
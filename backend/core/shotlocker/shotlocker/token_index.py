@@ -0,0 +1,290 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import json
+import zlib
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from . import clients
+from . import object_tag
+from . import s3_utils
+from botocore.exceptions import ClientError
+
+
+# The token index maps an access token to the keys of the objects tagged with it,
+# so what a token exposes is known without listing and reading the tags of the
+# whole bucket. It is written by the tagging steps.
+#
+#   ShotLocker/Index/Tokens/{token}/manifest.json         index information
+#   ShotLocker/Index/Tokens/{token}/shard-NNNN.json.gz    {dirname: [basename, ...]}
+#
+# Keys are sharded by a hash of the key, the number of shards grows with the
+# number of keys so each shard stays small enough to read quickly.
+
+TOKEN_INDEX_PREFIX = 'ShotLocker/Index/Tokens/'
+TOKEN_INDEX_VERSION = 1
+TOKEN_INDEX_SHARD_KEYS = 50000
+
+# Directories whose every object an edit uses can be granted as a whole by the
+# bucket policy rather than tagging each object, see find_prefix_grants.
+#
+#   ShotLocker/Index/Prefixes/{token}.json    {'prefixes': [prefix, ...]}
+#
+# Objects added to a granted directory later are granted too, so it is opt-in.
+PREFIX_GRANTS_PREFIX = 'ShotLocker/Index/Prefixes/'
+PREFIX_GRANTS_ENABLED = os.environ.get('SHOTLOCKER_PREFIX_GRANTS', '').lower() in ('1', 'true', 'yes')
+PREFIX_GRANTS_MIN_OBJECTS = 100
+# each prefix is a bucket policy Resource, the policy is limited to 20 KB
+PREFIX_GRANTS_MAX_PREFIXES = 20
+# requests to tag an object: read, write and verify
+TAG_REQUESTS_PER_OBJECT = 3
+
+
+def get_token_index_prefix(access_token):
+    return f'{TOKEN_INDEX_PREFIX}{access_token}/'
+
+
+def get_token_index_manifest_key(access_token):
+    return get_token_index_prefix(access_token) + 'manifest.json'
+
+
+def get_token_index_shard_key(access_token, shard):
+    return f'{get_token_index_prefix(access_token)}shard-{shard:04d}.json.gz'
+
+
+def read_token_index(bucket, access_token, *, s3_client=None):
+    """
+    @returns sorted list of the keys tagged with the access token, or None
+    when the token has no index
+    """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=get_token_index_manifest_key(access_token))
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return None
+        raise
+
+    manifest = json.loads(response['Body'].read().decode())
+    if manifest.get('version') != TOKEN_INDEX_VERSION:
+        return None
+
+    def _read_shard(shard):
+        return s3_utils.read_json_from_s3(bucket,
+                                          get_token_index_shard_key(access_token, shard),
+                                          s3_client=s3_client,
+                                          compressed=True)
+
+    with ThreadPoolExecutor(max_workers=clients.MAX_WORKERS) as executor:
+        shards = list(executor.map(_read_shard, range(manifest['shards'])))
+
+    keys = []
+    for entries in shards:
+        for dirname, basenames in entries.items():
+            keys.extend(f'{dirname}/{basename}' if dirname else basename for basename in basenames)
+
+    return sorted(keys)
+
+
+def write_token_index(bucket, access_token, keys, *, s3_client=None):
+    """ replace the index of the access token with the keys """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    keys = set(keys)
+    shard_count = max(1, -(-len(keys) // TOKEN_INDEX_SHARD_KEYS))
+
+    shards = [{} for _ in range(shard_count)]
+    for key in keys:
+        dirname, _, basename = key.rpartition('/')
+        shards[zlib.crc32(key.encode()) % shard_count].setdefault(dirname, []).append(basename)
+
+    def _write_shard(shard):
+        entries = {dirname: sorted(basenames) for dirname, basenames in shards[shard].items()}
+        s3_utils.write_json_to_s3(entries,
+                                  bucket,
+                                  get_token_index_shard_key(access_token, shard),
+                                  s3_client=s3_client,
+                                  compressed=True)
+
+    with ThreadPoolExecutor(max_workers=clients.MAX_WORKERS) as executor:
+        list(executor.map(_write_shard, range(shard_count)))
+
+    # the manifest is written last, readers never see a partial set of shards
+    s3_utils.write_json_to_s3({
+        'version': TOKEN_INDEX_VERSION,
+        'token': access_token,
+        'shards': shard_count,
+        'count': len(keys),
+        'update_time': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S') + 'Z',
+    }, bucket, get_token_index_manifest_key(access_token), s3_client=s3_client)
+
+    # drop the shards of a larger earlier index
+    stale_keys = [key for key in s3_utils.iter_objects(bucket, get_token_index_prefix(access_token), s3_client=s3_client)
+                  if key.endswith('.json.gz') and key >= get_token_index_shard_key(access_token, shard_count)]
+    _delete_keys(s3_client, bucket, stale_keys)
+
+
+def update_token_index(bucket, access_token, *, add_keys=(), remove_keys=(), s3_client=None):
+    """
+    add and remove keys of the access token index, the index is deleted once empty
+    @returns the number of keys in the index
+    """
+    keys = set(read_token_index(bucket, access_token, s3_client=s3_client) or [])
+    keys.update(add_keys)
+    keys.difference_update(remove_keys)
+
+    if keys:
+        write_token_index(bucket, access_token, keys, s3_client=s3_client)
+    else:
+        delete_token_index(bucket, access_token, s3_client=s3_client)
+
+    return len(keys)
+
+
+def delete_token_index(bucket, access_token, *, s3_client=None):
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    keys = list(s3_utils.iter_objects(bucket, get_token_index_prefix(access_token), s3_client=s3_client))
+    # the manifest first so readers never see an index with missing shards
+    keys.sort(key=lambda key: not key.endswith('manifest.json'))
+    _delete_keys(s3_client, bucket, keys)
+
+
+def list_indexed_tokens(bucket, *, s3_client=None):
+    """ @returns the access tokens with an index """
+    prefixes = s3_utils.iter_prefixes(bucket, TOKEN_INDEX_PREFIX, s3_client=s3_client)
+    return [prefix[len(TOKEN_INDEX_PREFIX):].rstrip('/') for prefix in prefixes]
+
+
+def audit_token_index(bucket, access_token, *, s3_client=None):
+    """
+    Check the tags of the indexed objects against the index
+    @returns {'count', 'tagged', 'untagged': [keys], 'missing': [keys]} or None without an index
+    """
+    keys = read_token_index(bucket, access_token, s3_client=s3_client)
+    if keys is None:
+        return None
+
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    def _has_token(key):
+        try:
+            tag_list = object_tag.get_s3_object_tag_list(f's3://{bucket}/{key}', s3_client=s3_client)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey':
+                return None
+            raise
+        return access_token in object_tag.get_shot_locker_access_token_list(tag_list)
+
+    with ThreadPoolExecutor(max_workers=clients.MAX_WORKERS) as executor:
+        tagged = list(executor.map(_has_token, keys))
+
+    return {
+        'count': len(keys),
+        'tagged': sum(1 for t in tagged if t),
+        'untagged': [key for key, t in zip(keys, tagged) if t is False],
+        'missing': [key for key, t in zip(keys, tagged) if t is None],
+    }
+
+
+def get_prefix_grants_key(access_token):
+    return f'{PREFIX_GRANTS_PREFIX}{access_token}.json'
+
+
+def find_prefix_grants(
+    bucket, 
+    s3_uris, 
+    *, 
+    min_objects=PREFIX_GRANTS_MIN_OBJECTS, 
+    max_prefixes=PREFIX_GRANTS_MAX_PREFIXES, 
+    s3_client=None
+):
+    """
+    Find the directories of the bucket whose objects, including the ones in
+    sub directories, are all in s3_uris
+    @returns (sorted list of the prefixes, number of list requests made)
+    """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    directories = {}
+    for s3_uri in s3_uris:
+        uri_bucket, key = s3_utils.get_bucket_key_from_s3_uri(s3_uri)
+        if uri_bucket == bucket and '/' in key:
+            directories.setdefault(key.rpartition('/')[0] + '/', set()).add(key)
+
+    # the largest directories save the most requests
+    candidates = sorted((prefix for prefix, keys in directories.items() if len(keys) >= min_objects),
+                        key=lambda prefix: -len(directories[prefix]))[:max_prefixes]
+
+    def _is_fully_used(prefix):
+        keys = directories[prefix]
+        list_requests = 0
+        for page in s3_utils.iter_pages(bucket, prefix, s3_client=s3_client, recursive=True):
+            list_requests += 1
+            if any(key not in keys for key in page):
+                return False, list_requests
+        return True, list_requests
+
+    with ThreadPoolExecutor(max_workers=clients.MAX_WORKERS) as executor:
+        results = list(executor.map(_is_fully_used, candidates))
+
+    prefixes = sorted(prefix for prefix, (fully_used, _) in zip(candidates, results) if fully_used)
+    return prefixes, sum(list_requests for _, list_requests in results)
+
+
+def read_prefix_grants(bucket, access_token, *, s3_client=None):
+    """ @returns the prefixes granted to the access token """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=get_prefix_grants_key(access_token))
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return []
+        raise
+
+    return json.loads(response['Body'].read().decode())['prefixes']
+
+
+def write_prefix_grants(bucket, access_token, prefixes, *, s3_client=None):
+    if not prefixes:
+        delete_prefix_grants(bucket, access_token, s3_client=s3_client)
+        return
+    s3_utils.write_json_to_s3({'prefixes': sorted(prefixes)}, 
+                              bucket, 
+                              get_prefix_grants_key(access_token), 
+                              s3_client=s3_client)
+
+
+def delete_prefix_grants(bucket, access_token, *, s3_client=None):
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+    s3_client.delete_object(Bucket=bucket, Key=get_prefix_grants_key(access_token))
+
+
+def delete_all_prefix_grants(bucket, *, s3_client=None):
+    """ @returns the access tokens whose prefix grants were deleted """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    keys = [key for key in s3_utils.iter_objects(bucket, PREFIX_GRANTS_PREFIX, s3_client=s3_client)
+            if key.endswith('.json')]
+    _delete_keys(s3_client, bucket, keys)
+    return [key[len(PREFIX_GRANTS_PREFIX):-len('.json')] for key in keys]
+
+
+def _delete_keys(s3_client, bucket, keys):
+    # delete_objects takes up to 1000 keys
+    for start in range(0, len(keys), 1000):
+        s3_client.delete_objects(Bucket=bucket, Delete={
+            'Objects': [{'Key': key} for key in keys[start:start + 1000]],
+            'Quiet': True,
+        })
@@ -0,0 +1,154 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from . import clients
+from . import s3_utils
+from .concurrency import is_throttle_error
+from botocore.exceptions import (
+    ClientError,
+    ConnectionError as BotocoreConnectionError,
+    ConnectTimeoutError,
+    EndpointConnectionError,
+    ReadTimeoutError,
+)
+
+
+# items submitted and not finished, for each worker
+WORK_QUEUE_PENDING_PER_WORKER = 4
+WORK_QUEUE_MAX_ATTEMPTS = 5
+# full jitter exponential backoff between attempts, in seconds
+WORK_QUEUE_BACKOFF_BASE = 0.2
+WORK_QUEUE_BACKOFF_MAX = 10.0
+
+
+def is_transient_error(e) -> bool:
+    """ errors worth retrying: throttling, server errors and connection failures """
+    if isinstance(e, (BotocoreConnectionError, ConnectTimeoutError, EndpointConnectionError, ReadTimeoutError)):
+        return True
+    if isinstance(e, ClientError):
+        status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        return is_throttle_error(e) or status >= 500
+    return False
+
+
+class WorkSummary:
+    """
+    Outcome of run_work_queue. Only the counts of succeeded and skipped items are
+    kept so the summary does not grow with the work, failed items keep their key.
+    """
+
+    def __init__(self):
+        self.succeeded = 0
+        self.skipped = 0
+        self.retried = 0
+        self.failed = {}
+        # stop_fn stopped the work before the end of the items,
+        # every item up to last_key has been processed
+        self.stopped = False
+        self.last_key = None
+
+    def to_dict(self):
+        return {
+            'succeeded': self.succeeded,
+            'skipped': self.skipped,
+            'retried': self.retried,
+            'failed': len(self.failed),
+            'failed_keys': sorted(self.failed),
+            'stopped': self.stopped,
+            'last_key': self.last_key,
+        }
+
+
+def run_work_queue(
+    items,
+    fn,
+    *,
+    key_fn=str,
+    max_workers=clients.MAX_WORKERS,
+    max_pending=None,
+    max_attempts=WORK_QUEUE_MAX_ATTEMPTS,
+    is_retryable=is_transient_error,
+    stop_fn=None
+):
+    """
+    Call fn(item) for every item with max_workers threads. items can be a generator,
+    e.g. s3_utils.iter_objects, it is only read as fast as the work finishes so at
+    most max_pending items are held at once. fn returns False when it skipped the
+    item. Retryable failures are retried with jittered backoff, the last failure of
+    an item is recorded in the summary under key_fn(item).
+    stop_fn is checked before each item is started, once it returns True no more
+    items are started (e.g. checkpoint.Deadline.expired) and summary.stopped is set.
+    @returns WorkSummary
+    """
+    if not max_pending:
+        max_pending = max_workers * WORK_QUEUE_PENDING_PER_WORKER
+
+    summary = WorkSummary()
+    summary_lock = threading.Lock()
+    pending = threading.BoundedSemaphore(max_pending)
+
+    def _run(item):
+        retried = 0
+        try:
+            for attempt in range(max_attempts):
+                try:
+                    result = fn(item)
+                    break
+                except Exception as e:
+                    if attempt + 1 == max_attempts or not is_retryable(e):
+                        raise
+                    retried += 1
+                    time.sleep(random.uniform(0, min(WORK_QUEUE_BACKOFF_MAX, WORK_QUEUE_BACKOFF_BASE * 2 ** attempt)))
+
+            with summary_lock:
+                summary.retried += retried
+                if result is False:
+                    summary.skipped += 1
+                else:
+                    summary.succeeded += 1
+        except Exception as e:
+            with summary_lock:
+                summary.retried += retried
+                summary.failed[key_fn(item)] = str(e)
+        finally:
+            pending.release()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for item in items:
+            # backpressure, wait for a finished item before reading the next one
+            pending.acquire()
+            if stop_fn and stop_fn():
+                pending.release()
+                summary.stopped = True
+                break
+            summary.last_key = key_fn(item)
+            executor.submit(_run, item)
+
+    return summary
+
+
+def write_failed_keys(summary, bucket, s3_key, *, s3_client=None):
+    """ persist the failed keys of a WorkSummary so a later run can retry just those """
+    s3_utils.write_json_to_s3({
+        'failed': summary.failed,
+    }, bucket, s3_key, s3_client=s3_client)
+
+
+def read_failed_keys(bucket, s3_key, *, s3_client=None):
+    """ @returns the failed keys written by write_failed_keys, or an empty list """
+    if not s3_client:
+        s3_client = clients.get_client('s3')
+
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=s3_key)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return []
+        raise
+
+    return sorted(json.loads(response['Body'].read().decode()).get('failed', {}))
@@ -0,0 +1,130 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import io
+import os
+import sys
+import hashlib
+import threading
+
+import pytest
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import shotlocker.clients
+
+
+class StubS3:
+    """ in memory stand-in of the S3 client calls the library makes on objects """
+
+    def __init__(self):
+        self.objects = {}
+        self.tags = {}
+        self.notifications = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _error(code, operation):
+        return ClientError({'Error': {'Code': code}}, operation)
+
+    def _etag(self, bucket, key):
+        return '"%s"' % hashlib.md5(self.objects[(bucket, key)]).hexdigest()
+
+    def put_object(self, Bucket, Key, Body=b'', IfMatch=None, IfNoneMatch=None, **kwargs):
+        if isinstance(Body, str):
+            Body = Body.encode()
+        with self._lock:
+            exists = (Bucket, Key) in self.objects
+            if IfNoneMatch == '*' and exists:
+                raise self._error('PreconditionFailed', 'PutObject')
+            if IfMatch and (not exists or IfMatch != self._etag(Bucket, Key)):
+                raise self._error('PreconditionFailed', 'PutObject')
+            self.objects[(Bucket, Key)] = Body
+            return {'ETag': self._etag(Bucket, Key)}
+
+    def get_object(self, Bucket, Key):
+        with self._lock:
+            if (Bucket, Key) not in self.objects:
+                raise self._error('NoSuchKey', 'GetObject')
+            return {'Body': io.BytesIO(self.objects[(Bucket, Key)]), 'ETag': self._etag(Bucket, Key)}
+
+    def head_object(self, Bucket, Key):
+        with self._lock:
+            if (Bucket, Key) not in self.objects:
+                raise self._error('404', 'HeadObject')
+            return {'ETag': self._etag(Bucket, Key)}
+
+    def delete_object(self, Bucket, Key):
+        with self._lock:
+            self.objects.pop((Bucket, Key), None)
+            self.tags.pop((Bucket, Key), None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete['Objects']:
+            self.delete_object(Bucket=Bucket, Key=obj['Key'])
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter='', StartAfter='', ContinuationToken=None, MaxKeys=1000):
+        with self._lock:
+            keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+
+        entries = []
+        for key in keys:
+            if key <= StartAfter:
+                continue
+            rest = key[len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                prefix = Prefix + rest.split(Delimiter)[0] + Delimiter
+                if not entries or entries[-1] != ('prefix', prefix):
+                    entries.append(('prefix', prefix))
+            else:
+                entries.append(('key', key))
+
+        start = int(ContinuationToken or 0)
+        page = entries[start:start + MaxKeys]
+        response = {'KeyCount': len(page)}
+        contents = [{'Key': value, 'Size': 0} for kind, value in page if kind == 'key']
+        prefixes = [{'Prefix': value} for kind, value in page if kind == 'prefix']
+        if contents:
+            response['Contents'] = contents
+        if prefixes:
+            response['CommonPrefixes'] = prefixes
+        if start + MaxKeys < len(entries):
+            response['NextContinuationToken'] = str(start + MaxKeys)
+        return response
+
+    def get_object_tagging(self, Bucket, Key):
+        with self._lock:
+            if (Bucket, Key) not in self.objects:
+                raise self._error('NoSuchKey', 'GetObjectTagging')
+            return {'TagSet': [dict(tag) for tag in self.tags.get((Bucket, Key), [])]}
+
+    def put_object_tagging(self, Bucket, Key, Tagging):
+        with self._lock:
+            if (Bucket, Key) not in self.objects:
+                raise self._error('NoSuchKey', 'PutObjectTagging')
+            self.tags[(Bucket, Key)] = [dict(tag) for tag in Tagging['TagSet']]
+        return {}
+
+    def get_bucket_notification_configuration(self, Bucket):
+        return dict(self.notifications.get(Bucket, {}))
+
+    def put_bucket_notification_configuration(self, Bucket, NotificationConfiguration):
+        self.notifications[Bucket] = NotificationConfiguration
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    """ stub S3 client, also returned by shotlocker.clients.get_client('s3') """
+    s3_client = StubS3()
+    get_client = shotlocker.clients.get_client
+
+    def _get_client(service_name, **kwargs):
+        if service_name == 's3':
+            return s3_client
+        return get_client(service_name, **kwargs)
+
+    monkeypatch.setattr(shotlocker.clients, 'get_client', _get_client)
+    return s3_client
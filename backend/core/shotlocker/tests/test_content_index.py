@@ -0,0 +1,93 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+
+from shotlocker import content_index
+
+SAMPLE_EVENT_FEED = os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                                 '..', '..', '..', 'content_index', 'sample-event-feed.json')
+BUCKET = 'my-content-lake'
+PLATE_1001 = 'shots/sh010/plates/sh010_plate.1001.exr'
+PLATE_1002 = 'shots/sh010/plates/sh010_plate.1002.exr'
+
+
+def _save_index(s3, keys, create_time):
+    index = content_index.ContentIndex.create_empty(BUCKET, s3_client=s3, shard_count=4)
+    index.manifest['create_time'] = create_time
+    for key in keys:
+        index.add(key)
+    index.save()
+
+
+def test_replay_sample_event_feed(s3):
+    _save_index(s3, [PLATE_1001], '2024-01-01T00:00:00Z')
+
+    records = content_index.load_s3_event_records(SAMPLE_EVENT_FEED)
+    summary = content_index.update_content_index_from_records(records, s3_client=s3, lock_wait=0)
+
+    # the delete of 1001 is its latest event, the create of 1002 is new
+    assert summary[BUCKET]['added'] == 1
+    assert summary[BUCKET]['removed'] == 1
+    assert summary[BUCKET]['watermark']['event_time'] == '2024-05-01T12:00:09.000Z'
+
+    index = content_index.read_content_index(BUCKET, s3_client=s3)
+    assert index.count == 1
+    assert index.find('sh010_plate.1002.exr') == [PLATE_1002]
+    assert index.find('sh010_plate.1001.exr') == []
+    assert (BUCKET, content_index.CONTENT_INDEX_LOCK_KEY) not in s3.objects
+
+
+def test_events_before_the_build_are_not_saved(s3):
+    _save_index(s3, [PLATE_1001], '2025-01-01T00:00:00Z')
+    manifest = s3.objects[(BUCKET, content_index.CONTENT_INDEX_MANIFEST_KEY)]
+
+    records = content_index.load_s3_event_records(SAMPLE_EVENT_FEED)
+    summary = content_index.update_content_index_from_records(records, s3_client=s3, lock_wait=0)
+
+    assert summary[BUCKET]['before_build'] == 2
+    assert s3.objects[(BUCKET, content_index.CONTENT_INDEX_MANIFEST_KEY)] == manifest
+
+
+def test_bucket_without_index_is_skipped(s3):
+    records = content_index.load_s3_event_records(SAMPLE_EVENT_FEED)
+    summary = content_index.update_content_index_from_records(records, s3_client=s3, lock_wait=0)
+
+    assert summary == {BUCKET: {'skipped': 2}}
+    assert not s3.objects
+
+
+def test_locked_bucket_is_deferred(s3):
+    _save_index(s3, [PLATE_1001], '2024-01-01T00:00:00Z')
+    owner = content_index.acquire_content_index_lock(BUCKET, s3_client=s3)
+
+    records = content_index.load_s3_event_records(SAMPLE_EVENT_FEED)
+    summary = content_index.update_content_index_from_records(records, s3_client=s3, lock_wait=0)
+
+    assert summary == {BUCKET: {'deferred': 2}}
+    content_index.release_content_index_lock(BUCKET, owner, s3_client=s3)
+
+
+def test_build_continues_after_stopping(s3):
+    keys = [f'shots/sh{shot:03d}/plates/plate.{frame:04d}.exr' for shot in range(12) for frame in range(200)]
+    for key in keys:
+        s3.put_object(Bucket=BUCKET, Key=key)
+
+    stops = iter([False, True] * 100)
+    result = content_index.build_content_index(BUCKET, s3_client=s3, shard_count=4, stop_fn=lambda: next(stops))
+    assert result['status'] == 'stopped'
+    assert content_index.read_content_index(BUCKET, s3_client=s3) is None
+    assert content_index.build_content_index(BUCKET, s3_client=s3, lock_wait=0)['status'] == 'locked'
+
+    while result['status'] == 'stopped':
+        result = content_index.build_content_index(BUCKET, 
+                                                   owner=result['owner'], 
+                                                   s3_client=s3, 
+                                                   stop_fn=lambda: next(stops))
+
+    index = content_index.read_content_index(BUCKET, s3_client=s3)
+    assert index.count == len(keys)
+    assert index.find('plate.0042.exr') == sorted(key for key in keys if key.endswith('plate.0042.exr'))
+    assert not [key for _, key in s3.objects if key.startswith(content_index.CONTENT_INDEX_BUILD_PREFIX)]
+    assert (BUCKET, content_index.CONTENT_INDEX_LOCK_KEY) not in s3.objects
+    assert s3.notifications[BUCKET] == {'EventBridgeConfiguration': {}}
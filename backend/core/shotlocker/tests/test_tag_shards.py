@@ -0,0 +1,81 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+from shotlocker import object_tag, tag_shards, token_index
+
+BUCKET = 'content-lake'
+ACCESS_TOKEN = 'A1b2C3d4E5'
+
+
+def _get_tag_state(s3_uris):
+    return {
+        'cursor': None,
+        'files_tagged': sorted(s3_uris),
+        'total_files': len(s3_uris),
+        'tag_plan': {
+            'planned': len(s3_uris),
+            'written': 0,
+            'skipped': 0,
+            'failed': 0,
+            'retried': 0,
+        },
+        'tag_failed': {},
+    }
+
+
+def _put_objects(s3, count):
+    keys = [f'shots/sh{i // 10:03d}/plate.{i:04d}.exr' for i in range(count)]
+    for key in keys:
+        s3.put_object(Bucket=BUCKET, Key=key)
+    return keys
+
+
+def _has_token(s3, key):
+    tag_list = s3.get_object_tagging(Bucket=BUCKET, Key=key)['TagSet']
+    return ACCESS_TOKEN in object_tag.get_shot_locker_access_token_list(tag_list)
+
+
+def test_run_tag_shards_add_and_remove(s3):
+    keys = _put_objects(s3, 45)
+    s3_uris = [f's3://{BUCKET}/{key}' for key in keys]
+
+    state = tag_shards.run_tag_shards(BUCKET, ACCESS_TOKEN, 'add', _get_tag_state(s3_uris), 
+                                      shard_size=10, max_concurrency=3, s3_client=s3)
+
+    assert state['tag_plan']['shards'] == 5
+    assert state['tag_plan']['written'] == len(keys)
+    assert not state['tag_failed']
+    assert sorted(state['files_tagged']) == sorted(s3_uris)
+    assert all(_has_token(s3, key) for key in keys)
+    assert token_index.read_token_index(BUCKET, ACCESS_TOKEN, s3_client=s3) == sorted(keys)
+    # the shards are deleted once reduced
+    assert not [key for _, key in s3.objects if key.startswith(tag_shards.get_tag_shards_prefix(ACCESS_TOKEN, 'add'))]
+
+    state = tag_shards.run_tag_shards(BUCKET, ACCESS_TOKEN, 'remove', _get_tag_state(s3_uris), 
+                                      shard_size=10, s3_client=s3)
+
+    assert state['tag_plan']['written'] == len(keys)
+    assert not any(_has_token(s3, key) for key in keys)
+    assert token_index.read_token_index(BUCKET, ACCESS_TOKEN, s3_client=s3) is None
+
+
+def test_tag_delta_reads_the_tags(s3):
+    keys = _put_objects(s3, 20)
+    s3_uris = [f's3://{BUCKET}/{key}' for key in keys]
+    tag_shards.run_tag_shards(BUCKET, ACCESS_TOKEN, 'add', _get_tag_state(s3_uris[:15]), 
+                              shard_size=10, s3_client=s3)
+
+    # tags removed outside of the tagging steps
+    s3.put_object_tagging(Bucket=BUCKET, Key=keys[0], Tagging={'TagSet': []})
+
+    to_tag, stale, summary = tag_shards.get_tag_delta(BUCKET, ACCESS_TOKEN, s3_uris[1:], s3_client=s3)
+
+    assert to_tag == sorted(s3_uris[15:])
+    assert stale == [s3_uris[0]]
+    assert summary['in_place'] == 14
+
+    to_tag, stale, summary = tag_shards.get_tag_delta(BUCKET, ACCESS_TOKEN, s3_uris, s3_client=s3)
+
+    assert to_tag == sorted([s3_uris[0]] + s3_uris[15:])
+    assert stale == []
+    assert summary['untagged'] == 1
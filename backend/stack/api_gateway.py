@@ -78,6 +78,16 @@ def create_rest_api_lambda(
                "s3:PutObjectTagging"],
       resources=[f"arn:{stack.partition}:s3:::*"],
     ))
+    # the prefixes granted to an edit are added to the bucket policy with its users
+    lambda_role.add_to_policy(iam.PolicyStatement(
+      actions=["s3:GetObject"],
+      resources=[f"arn:{stack.partition}:s3:::*/ShotLocker/Index/*"],
+    ))
+    # the edits of a locker are listed from its edit catalog
+    lambda_role.add_to_policy(iam.PolicyStatement(
+      actions=["s3:GetObject"],
+      resources=[f"arn:{stack.partition}:s3:::*/ShotLocker/catalog.json"],
+    ))
     lambda_role.add_to_policy(iam.PolicyStatement(
       actions=["iam:ListRoles", "iam:PassRole"],
       resources=["*"],
@@ -98,6 +108,12 @@ def create_rest_api_lambda(
       actions=["ssm:GetParameter",],
       resources=["*"],
     ))
+    # locker registry, written through when a locker is set or first checked
+    lambda_role.add_to_policy(iam.PolicyStatement(
+      actions=["ssm:DeleteParameter", "ssm:GetParametersByPath", "ssm:PutParameter"],
+      resources=[f"arn:{stack.partition}:ssm:*:*:parameter/ShotLocker/Lockers",
+                 f"arn:{stack.partition}:ssm:*:*:parameter/ShotLocker/Lockers/*"],
+    ))
 
     nag.NagSuppressions.add_resource_suppressions(
         lambda_role,
@@ -111,6 +127,16 @@ def create_rest_api_lambda(
                            "read from the SSM Parameter store"]),
                 'applies_to': [ "Resource::*" ]
             },
+            {
+                'id': "AwsSolutions-IAM5",
+                'reason': ','.join(["read the token indexes of every Shot Locker bucket",
+                           "read the edit catalog of every Shot Locker bucket",
+                           "register every Shot Locker bucket"]),
+                'applies_to': [ "Resource::arn:<AWS::Partition>:s3:::*/ShotLocker/Index/*",
+                                "Resource::arn:<AWS::Partition>:s3:::*/ShotLocker/catalog.json",
+                                "Resource::arn:<AWS::Partition>:ssm:*:*:parameter/ShotLocker/Lockers",
+                                "Resource::arn:<AWS::Partition>:ssm:*:*:parameter/ShotLocker/Lockers/*" ]
+            },
         ], True
     )
 
@@ -30,7 +30,7 @@ def create_bucket_step_functions(
 
     # Step 2: Remove All Object Tags
     remove_fn = _create_remove_tags_function(stack, lambda_layers, environment)
-    remove_job = _create_remove_tags_task(stack, remove_fn)
+    remove_job = _create_remove_tags_loop(stack, remove_fn)
 
     # Bucket Disable Step Function definition
     chain = disable_job.next(remove_job)
@@ -48,7 +48,24 @@ def create_bucket_step_functions(
 
     suppress_cdk_nag_errors_by_grant_readwrite(bucket_disable, 'stepfn lambdas')
 
-    return {'bucket_disable': bucket_disable}
+    # Bucket Migrate Access Tags, started by an operator for buckets tagged when every
+    # access token was stored in ShotLockerAccess
+    migrate_fn = _create_migrate_tags_function(stack, lambda_layers, environment)
+    migrate_job = _create_migrate_tags_loop(stack, migrate_fn)
+
+    bucket_migrate_tags = stepfn.StateMachine(stack, 'ShotLocker-Bucket-Migrate-Tags-StepFn', 
+        state_machine_name='ShotLocker-Bucket-Migrate-Tags-StepFn', 
+        definition_body=stepfn.DefinitionBody.from_chainable(migrate_job),
+        logs=stepfn.LogOptions(
+            destination=log_group,
+            level=stepfn.LogLevel.ALL
+        ),
+        tracing_enabled=True,
+    )
+
+    suppress_cdk_nag_errors_by_grant_readwrite(bucket_migrate_tags, 'stepfn lambdas')
+
+    return {'bucket_disable': bucket_disable, 'bucket_migrate_tags': bucket_migrate_tags}
 
 
 def _create_disable_edits_function(stack, lambda_layers, environment):
@@ -125,6 +142,19 @@ def _create_remove_tags_function(stack, lambda_layers, environment):
                  "s3:PutObjectTagging",],
         resources=[f"*"],
     ))
+    # finished checkpoints and the prefix grants are deleted
+    lambda_role.add_to_policy(iam.PolicyStatement(
+        actions=["s3:DeleteObject"],
+        resources=[f"arn:{stack.partition}:s3:::*/ShotLocker/Checkpoints/*",
+                   f"arn:{stack.partition}:s3:::*/ShotLocker/Index/*"],
+    ))
+    # the prefix grant statements are removed from the bucket policy
+    lambda_role.add_to_policy(iam.PolicyStatement(
+        actions=["s3:GetBucketPolicy",
+                 "s3:PutBucketPolicy",
+                 "s3:DeleteBucketPolicy",],
+        resources=[f"arn:{stack.partition}:s3:::*"],
+    ))
     suppress_cdk_nag_errors_by_grant_readwrite(lambda_role)
 
     with open(os.path.join(SCRIPT_DIRECTORY, "..", "stepfn", "bucket_disable", "remove-object-tags.py")) as fd:
@@ -155,3 +185,88 @@ def _create_remove_tags_task(stack, lambda_fn, postfix=""):
         output_path="$.Payload",
     )
     return job
+
+
+def _create_remove_tags_loop(stack, lambda_fn, postfix=""):
+    """ remove tags task invoked again while it returns with a checkpoint to continue from """
+    job = _create_remove_tags_task(stack, lambda_fn, postfix)
+    job_continue = stepfn.Choice(stack, 'ShotLocker-Remove-Tags-Continue' + postfix)
+    job_continue.when(
+        stepfn.Condition.and_(
+            stepfn.Condition.is_present('$.continue'),
+            stepfn.Condition.boolean_equals('$.continue', True),
+        ),
+        job,
+    )
+    job_continue.otherwise(stepfn.Succeed(stack, 'ShotLocker-Remove-Tags-Done' + postfix))
+    return job.next(job_continue)
+
+
+def _create_migrate_tags_function(stack, lambda_layers, environment):
+
+    # lambda role
+    lambda_role = iam.Role(stack, 'ShotLocker-Bucket-StepFns-MigrateTags-Role', 
+        assumed_by=iam.ServicePrincipal('lambda.amazonaws.com'),
+    )
+    lambda_role.add_to_policy(iam.PolicyStatement(
+        actions=["logs:CreateLogGroup", "logs:CreateLogStream", "logs:PutLogEvents"],
+        resources=[f"arn:{stack.partition}:logs:*:*:*"],
+    ))
+    lambda_role.add_to_policy(iam.PolicyStatement(
+        actions=["s3:GetBucketLocation",
+                 "s3:GetBucketPolicy",
+                 "s3:GetBucketTagging",
+                 "s3:GetObject",
+                 "s3:GetObjectTagging",
+                 "s3:ListBucket",
+                 "s3:PutBucketPolicy",
+                 "s3:PutBucketTagging",
+                 "s3:PutObject",
+                 "s3:PutObjectTagging",],
+        resources=[f"*"],
+    ))
+    # finished checkpoints are deleted
+    lambda_role.add_to_policy(iam.PolicyStatement(
+        actions=["s3:DeleteObject"],
+        resources=[f"arn:{stack.partition}:s3:::*/ShotLocker/Checkpoints/*"],
+    ))
+    suppress_cdk_nag_errors_by_grant_readwrite(lambda_role)
+
+    with open(os.path.join(SCRIPT_DIRECTORY, "..", "stepfn", "bucket_migrate", "migrate-access-tags.py")) as fd:
+        code = fd.read()
+
+    fn = aws_lambda.Function(
+        stack,
+        id='ShotLocker-Migrate-Access-Tags',
+        function_name='ShotLocker-Migrate-Access-Tags',
+        description='Migrate the Access Tags of a Content Lake to the hashed tag keys',
+        runtime=aws_lambda.Runtime.PYTHON_3_9,
+        handler='index.lambda_handler',
+        role=lambda_role,
+        code=aws_lambda.Code.from_inline(code),
+        timeout=Duration.seconds(900),
+        layers=lambda_layers,
+        environment=environment,
+        retry_attempts=0,
+        memory_size=1024, # MB
+    )
+    return fn
+
+
+def _create_migrate_tags_loop(stack, lambda_fn, postfix=""):
+    """ migrate tags task invoked again while it returns with a checkpoint to continue from """
+    job = stepfn_tasks.LambdaInvoke(stack, 
+        'ShotLocker-Migrate-Tags-Task' + postfix,
+        lambda_function=lambda_fn,
+        output_path="$.Payload",
+    )
+    job_continue = stepfn.Choice(stack, 'ShotLocker-Migrate-Tags-Continue' + postfix)
+    job_continue.when(
+        stepfn.Condition.and_(
+            stepfn.Condition.is_present('$.continue'),
+            stepfn.Condition.boolean_equals('$.continue', True),
+        ),
+        job,
+    )
+    job_continue.otherwise(stepfn.Succeed(stack, 'ShotLocker-Migrate-Tags-Done' + postfix))
+    return job.next(job_continue)
@@ -32,16 +32,24 @@ def create_edit_step_functions(
     convert_fn = _create_convert_to_otio_function(stack, lambda_layers, environment)
     convert_job = _create_convert_to_otio_task(stack, convert_fn)
 
-    # Step 3: Conform S3 Media
+    # Step 3: Build the content lake index, continued while it runs out of time
+    index_fn = _create_build_content_index_function(stack, lambda_layers, environment)
+    index_job, index_continue = _create_build_content_index_loop(stack, index_fn)
+
+    # Step 4: Conform S3 Media
     conform_fn = _create_conform_s3_media_function(stack, lambda_layers, environment)
     conform_job = _create_conform_s3_media_task(stack, conform_fn)
 
-    # Step 4: Tag Objects in S3
-    tag_fn = _create_s3_object_tag_function(stack, lambda_layers, environment)
-    tag_job = _create_s3_object_tag_task(stack, tag_fn)
+    # Step 5: Tag Objects in S3, the objects are split into shards tagged in parallel
+    tag_max_concurrency = stack.user_settings.get('tag_max_concurrency', 10)
+    tag_environment = dict(environment)
+    tag_environment['SHOTLOCKER_PREFIX_GRANTS'] = 'true' if stack.user_settings.get('prefix_grants', False) else 'false'
+    tag_fns = _create_s3_object_tag_functions(stack, lambda_layers, tag_environment)
+    tag_job = _create_s3_object_tag_fan_out(stack, tag_fns, tag_max_concurrency)
 
     # Process Edit Step Function definition
-    chain = validate_job.next(convert_job).next(conform_job).next(tag_job)
+    index_continue.otherwise(conform_job.next(tag_job))
+    chain = validate_job.next(convert_job).next(index_job).next(index_continue)
 
     # Process Edit Create State Machine
     process_edit = stepfn.StateMachine(stack, 'ShotLocker-Process-Edit-StepFn', 
@@ -57,7 +65,7 @@ def create_edit_step_functions(
     # Add Access Step Function
     find_fn = _create_find_processed_edit_function(stack, lambda_layers, environment)
     find_job = _create_find_processed_edit_task(stack, find_fn, "-Add")
-    tag_job = _create_s3_object_tag_task(stack, tag_fn, "-Add")
+    tag_job = _create_s3_object_tag_fan_out(stack, tag_fns, tag_max_concurrency, "-Add")
 
     # Add Access Step Function definition
     chain = find_job.next(tag_job)
@@ -76,7 +84,7 @@ def create_edit_step_functions(
     # Remove Access Step Function
     rm_fn = _create_remove_bucket_access_function(stack, lambda_layers, environment)
     rm_job = _create_remove_bucket_access_task(stack, rm_fn, "-Remove")
-    tag_job = _create_s3_object_tag_task(stack, tag_fn, "-Remove")
+    tag_job = _create_s3_object_tag_fan_out(stack, tag_fns, tag_max_concurrency, "-Remove")
 
     # Remove Access Step Function definition
     chain = rm_job.next(tag_job)
@@ -203,6 +211,74 @@ def _create_convert_to_otio_task(stack, convert_fn, postfix=""):
     return convert_job
 
 
+def _create_build_content_index_function(stack, lambda_layers, environment):
+
+    # lambda role
+    lambda_role = iam.Role(stack, 'ShotLocker-Edit-Build-Content-Index-Role', 
+        assumed_by=iam.ServicePrincipal('lambda.amazonaws.com'),
+    )
+    lambda_role.add_to_policy(iam.PolicyStatement(
+        actions=["logs:CreateLogGroup", "logs:CreateLogStream", "logs:PutLogEvents"],
+        resources=[f"arn:{stack.partition}:logs:*:*:*"],
+    ))
+    lambda_role.add_to_policy(iam.PolicyStatement(
+        actions=["s3:GetObject",
+                 "s3:ListBucket",
+                 "s3:PutObject",],
+        resources=["*"],
+    ))
+    # the content index build turns on the object events of the bucket, releases
+    # the index lock and drops its partial index by deleting them
+    lambda_role.add_to_policy(iam.PolicyStatement(
+        actions=["s3:GetBucketNotification",
+                 "s3:PutBucketNotification",],
+        resources=[f"arn:{stack.partition}:s3:::*"],
+    ))
+    lambda_role.add_to_policy(iam.PolicyStatement(
+        actions=["s3:DeleteObject"],
+        resources=[f"arn:{stack.partition}:s3:::*/ShotLocker/Index/Content/*"],
+    ))
+    suppress_cdk_nag_errors_by_grant_readwrite(lambda_role)
+
+    with open(os.path.join(SCRIPT_DIRECTORY, "..", "stepfn", "process_edit", "build-content-index.py")) as fd:
+        code = fd.read()
+
+    index_fn = aws_lambda.Function(
+        stack,
+        id='ShotLocker-Build-Content-Index',
+        function_name='ShotLocker-Build-Content-Index',
+        description='Build the content lake index',
+        runtime=aws_lambda.Runtime.PYTHON_3_9,
+        handler='index.lambda_handler',
+        role=lambda_role,
+        code=aws_lambda.Code.from_inline(code),
+        timeout=Duration.seconds(900),
+        layers=lambda_layers,
+        environment=environment,
+        retry_attempts=0,
+        memory_size=4096, # MB
+    )
+    return index_fn
+
+
+def _create_build_content_index_loop(stack, index_fn, postfix=""):
+    """ build task invoked again while it returns with a partial index to continue from """
+    index_job = stepfn_tasks.LambdaInvoke(stack, 
+        'ShotLocker-Build-Content-Index-Task' + postfix,
+        lambda_function=index_fn,
+        output_path="$.Payload",
+    )
+    index_continue = stepfn.Choice(stack, 'ShotLocker-Build-Content-Index-Continue' + postfix)
+    index_continue.when(
+        stepfn.Condition.and_(
+            stepfn.Condition.is_present('$.continue'),
+            stepfn.Condition.boolean_equals('$.continue', True),
+        ),
+        index_job,
+    )
+    return index_job, index_continue
+
+
 def _create_conform_s3_media_function(stack, lambda_layers, environment):
 
     # lambda role
@@ -257,7 +333,7 @@ def _create_conform_s3_media_task(stack, conform_fn, postfix=""):
     return conform_job
 
 
-def _create_s3_object_tag_function(stack, lambda_layers, environment):
+def _create_s3_object_tag_role(stack):
 
     # lambda role
     lambda_role = iam.Role(stack, 'ShotLocker-Edit-Object-Tag-Role', 
@@ -269,37 +345,67 @@ def _create_s3_object_tag_function(stack, lambda_layers, environment):
     ))
     lambda_role.add_to_policy(iam.PolicyStatement(
         actions=["s3:GetBucketLocation",
+                 "s3:GetBucketPolicy",
                  "s3:GetBucketTagging",
                  "s3:GetObject",
                  "s3:GetObjectTagging",
                  "s3:ListAllMyBuckets",
                  "s3:ListBucket",
+                 "s3:PutBucketPolicy",
                  "s3:PutBucketTagging",
                  "s3:PutObject",
                  "s3:PutObjectTagging",],
         resources=["*"],
     ))
+    # finished checkpoints and tag shards, emptied token indexes and prefix grants are deleted
+    lambda_role.add_to_policy(iam.PolicyStatement(
+        actions=["s3:DeleteObject"],
+        resources=[f"arn:{stack.partition}:s3:::*/ShotLocker/Checkpoints/*",
+                   f"arn:{stack.partition}:s3:::*/ShotLocker/TagShards/*",
+                   f"arn:{stack.partition}:s3:::*/ShotLocker/Index/*"],
+    ))
     suppress_cdk_nag_errors_by_grant_readwrite(lambda_role)
+    return lambda_role
+
+
+def _create_s3_object_tag_functions(stack, lambda_layers, environment):
+    """ @returns the plan, shard worker and reduce functions of the tagging fan-out """
+    lambda_role = _create_s3_object_tag_role(stack)
+
+    def _create_function(id, script, description, memory_size):
+        with open(os.path.join(SCRIPT_DIRECTORY, "..", "stepfn", "process_edit", script)) as fd:
+            code = fd.read()
+
+        return aws_lambda.Function(
+            stack,
+            id=id,
+            function_name=id,
+            description=description,
+            runtime=aws_lambda.Runtime.PYTHON_3_9,
+            handler='index.lambda_handler',
+            role=lambda_role,
+            code=aws_lambda.Code.from_inline(code),
+            timeout=Duration.seconds(900),
+            layers=lambda_layers,
+            environment=environment,
+            retry_attempts=0,
+            memory_size=memory_size, # MB
+        )
 
-    with open(os.path.join(SCRIPT_DIRECTORY, "..", "stepfn", "process_edit", "object-tag-access-token.py")) as fd:
-        code = fd.read()
-
-    tag_fn = aws_lambda.Function(
-        stack,
-        id='ShotLocker-S3-Object-Tag',
-        function_name='ShotLocker-S3-Object-Tag',
-        description='Tag objects in S3',
-        runtime=aws_lambda.Runtime.PYTHON_3_9,
-        handler='index.lambda_handler',
-        role=lambda_role,
-        code=aws_lambda.Code.from_inline(code),
-        timeout=Duration.seconds(900),
-        layers=lambda_layers,
-        environment=environment,
-        retry_attempts=0,
-        memory_size=4096, # MB
-    )
-    return tag_fn
+    return {
+        'plan': _create_function('ShotLocker-S3-Object-Tag', 
+                                 "object-tag-access-token.py", 
+                                 'Split the objects of an edit to tag in S3 into shards',
+                                 4096),
+        'shard': _create_function('ShotLocker-S3-Object-Tag-Shard', 
+                                  "object-tag-shard.py", 
+                                  'Tag the objects of a shard in S3',
+                                  4096),
+        'reduce': _create_function('ShotLocker-S3-Object-Tag-Reduce', 
+                                   "object-tag-reduce.py", 
+                                   'Merge the tag shard results of an edit',
+                                   1024),
+    }
 
 
 def _create_s3_object_tag_task(stack, tag_fn, postfix=""):
@@ -311,6 +417,54 @@ def _create_s3_object_tag_task(stack, tag_fn, postfix=""):
     return tag_job
 
 
+def _create_s3_object_tag_shard_loop(stack, shard_fn, postfix=""):
+    """ shard task invoked again while it returns with a checkpoint to continue from """
+    shard_job = stepfn_tasks.LambdaInvoke(stack, 
+        'ShotLocker-S3-Object-Tag-Shard-Task' + postfix,
+        lambda_function=shard_fn,
+        output_path="$.Payload",
+    )
+    shard_continue = stepfn.Choice(stack, 'ShotLocker-S3-Object-Tag-Shard-Continue' + postfix)
+    shard_continue.when(
+        stepfn.Condition.and_(
+            stepfn.Condition.is_present('$.continue'),
+            stepfn.Condition.boolean_equals('$.continue', True),
+        ),
+        shard_job,
+    )
+    shard_continue.otherwise(stepfn.Succeed(stack, 'ShotLocker-S3-Object-Tag-Shard-Done' + postfix))
+    return shard_job.next(shard_continue)
+
+
+def _create_s3_object_tag_fan_out(stack, tag_fns, max_concurrency, postfix=""):
+    """ plan the shards, tag them with a Map state and reduce the shard results """
+    tag_job = _create_s3_object_tag_task(stack, tag_fns['plan'], postfix)
+
+    shard_map = stepfn.Map(stack, 
+        'ShotLocker-S3-Object-Tag-Shards' + postfix,
+        items_path=stepfn.JsonPath.string_at('$.tag_shards'),
+        item_selector={
+            'bucket': stepfn.JsonPath.string_at('$.bucket'),
+            'edit_id': stepfn.JsonPath.string_at('$.edit_id'),
+            # stale objects of an edit tagged again are untagged by remove shards in the same map
+            'mode': stepfn.JsonPath.string_at('$$.Map.Item.Value.mode'),
+            'shard_key': stepfn.JsonPath.string_at('$$.Map.Item.Value.shard_key'),
+        },
+        max_concurrency=max_concurrency,
+        # the shard results are merged from S3 by the reduce step
+        result_path=stepfn.JsonPath.DISCARD,
+    )
+    shard_map.item_processor(_create_s3_object_tag_shard_loop(stack, tag_fns['shard'], postfix))
+
+    reduce_job = stepfn_tasks.LambdaInvoke(stack, 
+        'ShotLocker-S3-Object-Tag-Reduce-Task' + postfix,
+        lambda_function=tag_fns['reduce'],
+        output_path="$.Payload",
+    )
+
+    return tag_job.next(shard_map).next(reduce_job)
+
+
 def _create_find_processed_edit_function(stack, lambda_layers, environment):
 
     # lambda role
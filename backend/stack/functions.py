@@ -4,9 +4,14 @@
 import os
 from aws_cdk import (
     Duration,
+    aws_events as events,
+    aws_events_targets as events_targets,
     aws_iam as iam,
     aws_lambda,
+    aws_lambda_event_sources as lambda_event_sources,
+    aws_sqs as sqs,
 )
+import cdk_nag as nag
 from .security import suppress_cdk_nag_errors_by_grant_readwrite
 
 SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
@@ -35,6 +40,12 @@ def create_upload_edit_function(
       actions=["ssm:GetParameter",],
       resources=["*"],
     ))
+    # locker registry, written through when a locker is set or first checked
+    lambda_role.add_to_policy(iam.PolicyStatement(
+      actions=["ssm:DeleteParameter", "ssm:GetParametersByPath", "ssm:PutParameter"],
+      resources=[f"arn:{stack.partition}:ssm:*:*:parameter/ShotLocker/Lockers",
+                 f"arn:{stack.partition}:ssm:*:*:parameter/ShotLocker/Lockers/*"],
+    ))
     lambda_role.add_to_policy(iam.PolicyStatement(
       actions=["s3:GetBucketLocation",
                "s3:GetBucketTagging",
@@ -82,3 +93,98 @@ def create_upload_edit_function(
 
     return upload_fn
 
+
+
+def create_content_index_update_function(
+    stack, 
+    lambda_layers, 
+    log_group
+):
+
+    # content index update lambda role
+    lambda_role = iam.Role(stack, 'ShotLocker-Content-Index-Update-Role', 
+        assumed_by=iam.ServicePrincipal('lambda.amazonaws.com'),
+    )
+    lambda_role.add_to_policy(iam.PolicyStatement(
+      actions=["logs:CreateLogGroup", "logs:CreateLogStream", "logs:PutLogEvents"],
+      resources=[f"arn:{stack.partition}:logs:*:*:*"],
+    ))
+    lambda_role.add_to_policy(iam.PolicyStatement(
+      actions=["s3:GetObject",
+               "s3:ListBucket",],
+      resources=[f"arn:{stack.partition}:s3:::*", 
+                 f"arn:{stack.partition}:s3:::*/*"],
+    ))
+    # the rule matches the object events of every bucket, only the content index
+    # of a locker is written (the index lock is released by deleting it)
+    lambda_role.add_to_policy(iam.PolicyStatement(
+      actions=["s3:PutObject",
+               "s3:DeleteObject",],
+      resources=[f"arn:{stack.partition}:s3:::*/ShotLocker/Index/Content/*"],
+    ))
+
+    # S3 object events of the Shot Locker buckets (EventBridge notifications are
+    # turned on when a bucket becomes a Shot Locker) are queued so bursts of events
+    # are batched into a single content index update
+    dead_letter_queue = sqs.Queue(stack, 'ShotLocker-Content-Index-DLQ',
+        enforce_ssl=True,
+        retention_period=Duration.days(14),
+    )
+    nag.NagSuppressions.add_resource_suppressions(dead_letter_queue, [
+        {
+            'id': "AwsSolutions-SQS3",
+            'reason': "This queue is the dead letter queue",
+        },
+    ])
+
+    queue = sqs.Queue(stack, 'ShotLocker-Content-Index-Queue',
+        enforce_ssl=True,
+        visibility_timeout=Duration.seconds(6 * 300),
+        dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=5, queue=dead_letter_queue),
+    )
+
+    rule = events.Rule(stack, 'ShotLocker-Content-Index-Rule',
+        description='Shot Locker content lake object events',
+        event_pattern=events.EventPattern(
+            source=['aws.s3'],
+            detail_type=['Object Created', 'Object Deleted'],
+            detail={'object': {'key': [{'anything-but': {'prefix': 'ShotLocker/'}}]}},
+        ),
+        targets=[events_targets.SqsQueue(queue)],
+    )
+
+    with open(os.path.join(SCRIPT_DIRECTORY, "..", "content_index", "s3-object-event-update-index.py")) as fd:
+        code = fd.read()
+
+    environment = {
+        "LOG_GROUP_NAME": log_group.log_group_name,
+    }
+
+    index_fn = aws_lambda.Function(
+        stack,
+        id='ShotLocker-Content-Index-Update',
+        function_name='ShotLocker-Content-Index-Update',
+        description='Shot Locker content lake index update from S3 object events',
+        runtime=aws_lambda.Runtime.PYTHON_3_9,
+        handler='index.lambda_handler',
+        role=lambda_role,
+        code=aws_lambda.Code.from_inline(code),
+        timeout=Duration.seconds(300),
+        environment = environment,
+        layers=lambda_layers,
+        retry_attempts=0,
+        memory_size=1024, # MB
+    )
+
+    # the index lock serializes the writers of each bucket index, the messages of a
+    # locked bucket are reported as failed and delivered again
+    index_fn.add_event_source(lambda_event_sources.SqsEventSource(queue,
+        batch_size=1000,
+        max_batching_window=Duration.seconds(60),
+        max_concurrency=2,
+        report_batch_item_failures=True,
+    ))
+
+    suppress_cdk_nag_errors_by_grant_readwrite(lambda_role)
+
+    return index_fn, queue, rule
@@ -62,6 +62,8 @@ class ShotLockerStack(Stack):
 
         upload = functions.create_upload_edit_function(self, lambda_layer_list, log_group, edit_stepfns['process_edit'])
 
+        content_index = functions.create_content_index_update_function(self, lambda_layer_list, log_group)
+
         s3_bucket, cdn_dist = website_cdn.create_website_and_cdn(self, api_gateway_rest_api=api,
                                                                  access_log_bucket=access_bucket)
 
@@ -78,6 +80,7 @@ class ShotLockerStack(Stack):
         resources.extend(bucket_stepfns.values())
         resources.extend(edit_stepfns.values())
         resources.extend(api_resources)
+        resources.extend(content_index)
         for resource in resources:
             Tags.of(resource).add('Owner', 'ShotLocker')
 
@@ -202,6 +205,12 @@ class ShotLockerStack(Stack):
             string_value=bucket_stepfns['bucket_disable'].state_machine_arn
         )
 
+        ssm.StringParameter(self, "ShotLockerConfigBucketMigrateTagsArn",
+            parameter_name="/ShotLocker/Config/BucketMigrateTagsArn",
+            description="Bucket Migrate Access Tags Step Function Arn",
+            string_value=bucket_stepfns['bucket_migrate_tags'].state_machine_arn
+        )
+
         ssm.StringParameter(self, "ShotLockerConfigProcessEditArn",
             parameter_name="/ShotLocker/Config/ProcessEditArn",
             description="Process Edit Step Function Arn",
@@ -1,20 +1,18 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import boto3
 import shotlocker
-from shotlocker.log import log_entry
-
-
-s3_client = boto3.client('s3')
+from shotlocker.log import log_entry, buffered_log_entries
 
 
+@buffered_log_entries()
 def lambda_handler(event, context):
     bucket = event['bucket']
 
-    s3_client = boto3.client('s3')
+    s3_client = shotlocker.clients.get_client('s3')
 
-    edits = shotlocker.edit.get_shot_locker_bucket_edit_detailed_list(bucket, include_inactive=False, s3_client=s3_client)
+    # the edit tags are checked, not the catalog
+    edits = shotlocker.edit.get_shot_locker_bucket_edit_detailed_list(bucket, include_inactive=False, use_catalog=False, s3_client=s3_client)
 
     for edit in edits:
         edit_id = edit['name']
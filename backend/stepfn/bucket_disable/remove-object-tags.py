@@ -1,31 +1,135 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-import boto3
 import shotlocker
 
 
+# keys whose access tokens could not be removed, retried with the retry_failed option
+FAILED_KEYS_KEY = 'ShotLocker/BucketDisable/remove-object-tags-failed.json'
+
+
 def lambda_handler(event, context):
     bucket = event['bucket']
 
-    s3_client = boto3.client('s3')
+    # option: list the bucket with concurrent requests
+    parallel_listing = event.get('parallel_listing', True)
+
+    # option: only retry the keys that failed in the previous run
+    retry_failed = event.get('retry_failed', False)
+
+    # option: list every object in the bucket rather than the objects the edits tagged
+    full_scan = event.get('full_scan', False)
+
+    s3_client = shotlocker.clients.get_client('s3')
+
+    # resume from the checkpoint written when the previous invocation ran out of time
+    checkpoint_key = event.get('checkpoint_key')
+    state = None
+    if checkpoint_key:
+        state = shotlocker.checkpoint.read_checkpoint(bucket, checkpoint_key, s3_client=s3_client)
+    if not state:
+        state = {
+            'cursor': None,
+            'succeeded': 0,
+            'skipped': 0,
+            'retried': 0,
+            'failed': {},
+        }
+    cursor = state['cursor']
+
+    concurrency = shotlocker.concurrency.AdaptiveConcurrency()
+    # the tag requests are retried by the work queue, paced by the concurrency controller
+    tag_s3_client = shotlocker.clients.get_client('s3', **shotlocker.clients.CONCURRENCY_CONFIG_OPTIONS)
+    # the removals of a bucket-wide pass are not held in memory to be verified
+    tag_plan = shotlocker.object_tag.TagPlan(s3_client=tag_s3_client, concurrency=concurrency, verify=False)
+
+    keys = None
+    if retry_failed:
+        keys = shotlocker.work_queue.read_failed_keys(bucket, FAILED_KEYS_KEY, s3_client=s3_client)
+        print(f"Retrying {len(keys)} failed objects in bucket {bucket}")
+    elif not full_scan and state.get('targeted', True):
+        # only visit the objects the edits recorded as tagged
+        keys = shotlocker.edit.get_shot_locker_tagged_keys(bucket, s3_client=s3_client)
+        if keys is None:
+            print(f"Tagged objects are not recorded for every edit in bucket {bucket}, listing the whole bucket")
+        else:
+            print(f"Removing access tokens from {len(keys)} tagged objects in bucket {bucket}")
+
+    # a resumed run keeps visiting the same objects
+    state['targeted'] = keys is not None and not retry_failed
+
+    if keys is not None:
+        keys = [key for key in keys if not cursor or key > cursor]
+    else:
+        # the listing is streamed, memory does not grow with the bucket size
+        keys = shotlocker.s3_utils.iter_objects(bucket, 
+                                                s3_client=s3_client, 
+                                                names_only=True, 
+                                                recursive=True,
+                                                parallel=parallel_listing,
+                                                start_after=cursor)
+
+    def _remove_all_access_tokens(key):
+        s3_uri = f's3://{bucket}/{key}'
+        tag_plan.clear_tokens(s3_uri)
+        if not tag_plan.apply(s3_uri):
+            return False
+        print(f"Removed Access tokens from {s3_uri}")
+        return True
+
+    deadline = shotlocker.checkpoint.Deadline(context)
+
+    summary = shotlocker.work_queue.run_work_queue(keys, 
+                                                   _remove_all_access_tokens, 
+                                                   max_workers=concurrency.max_limit,
+                                                   stop_fn=deadline.expired)
+
+    for key, error in summary.failed.items():
+        print(f"ERROR: unable to remove access tokens from s3://{bucket}/{key}: {error}")
+
+    state['succeeded'] += summary.succeeded
+    state['skipped'] += summary.skipped
+    state['retried'] += summary.retried
+    state['failed'].update(summary.failed)
+    if summary.last_key:
+        state['cursor'] = summary.last_key
+
+    print(f"Tag request concurrency {concurrency.get_stats()}")
+
+    if summary.stopped:
+        checkpoint_key = shotlocker.checkpoint.get_checkpoint_key(f'remove-object-tags-{bucket}')
+        shotlocker.checkpoint.write_checkpoint(state, bucket, checkpoint_key, s3_client=s3_client)
+        print(f"Out of time, continuing after {state['cursor']} in bucket {bucket}")
+        return shotlocker.checkpoint.set_continuation(event, checkpoint_key)
+
+    # always written so a retry run does not pick up an older failed list
+    summary.failed = state['failed']
+    shotlocker.work_queue.write_failed_keys(summary, bucket, FAILED_KEYS_KEY, s3_client=s3_client)
+
+    # the token indexes are kept, an edit enabled again diffs its objects against its
+    # index and reads their tags, only the objects untagged here are tagged again
 
-    objects= shotlocker.s3_utils.list_all_objects(bucket, 
-                                                  s3_client=s3_client, 
-                                                  names_only=True, 
-                                                  recursive=True) 
+    # the directories granted as a whole carry no tags, their grants are removed here
+    policy = shotlocker.bucket_policy.get_shot_locker_bucket_policy_as_json(bucket, s3_client=s3_client)
+    shotlocker.bucket_policy.remove_shot_locker_prefix_grants(bucket, policy, s3_client=s3_client)
+    prefix_grants = shotlocker.token_index.delete_all_prefix_grants(bucket, s3_client=s3_client)
+    if prefix_grants:
+        print(f"Removed the prefix grants of {len(prefix_grants)} access tokens in bucket {bucket}")
 
-    print(f"Checking {len(objects)} objects in bucket {bucket}")
+    if checkpoint_key:
+        shotlocker.checkpoint.delete_checkpoint(bucket, checkpoint_key, s3_client=s3_client)
 
-    def _remove_all_access_tokens(s3_uri, s3_client):
-        if shotlocker.object_tag.clear_all_access_tokens_from_shot_locker_tag(s3_uri, s3_client=s3_client):
-            print(f"Removed Access tokens from {s3_uri}")
+    print(f"Removed access tokens from {state['succeeded']} objects in bucket {bucket}, "
+          f"{state['skipped']} unchanged, {len(state['failed'])} failed")
 
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        for object in objects:
-            s3_uri = f's3://{bucket}/{object}'
-            executor.submit(_remove_all_access_tokens, s3_uri, s3_client) 
+    event['remove_object_tags'] = {
+        'succeeded': state['succeeded'],
+        'skipped': state['skipped'],
+        'retried': state['retried'],
+        'targeted': state['targeted'],
+        'failed': len(state['failed']),
+        'failed_keys_key': FAILED_KEYS_KEY,
+        'prefix_grants_removed': len(prefix_grants),
+    }
 
-    return event
+    return shotlocker.checkpoint.set_continuation(event)
@@ -0,0 +1,74 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import shotlocker
+
+
+def lambda_handler(event, context):
+    """
+    migrate a bucket tagged when every access token was stored in ShotLockerAccess,
+    start the ShotLocker-Bucket-Migrate-Tags-StepFn with {"bucket": "..."}
+    """
+    bucket = event['bucket']
+
+    s3_client = shotlocker.clients.get_client('s3')
+    # the tag requests are retried by the work queue, paced by the concurrency controller
+    tag_s3_client = shotlocker.clients.get_client('s3', **shotlocker.clients.CONCURRENCY_CONFIG_OPTIONS)
+
+    # resume from the checkpoint written when the previous invocation ran out of time
+    checkpoint_key = event.get('checkpoint_key')
+    state = None
+    if checkpoint_key:
+        state = shotlocker.checkpoint.read_checkpoint(bucket, checkpoint_key, s3_client=s3_client)
+    if not state:
+        state = {
+            'cursor': None,
+            'succeeded': 0,
+            'skipped': 0,
+            'retried': 0,
+            'failed': {},
+        }
+
+    deadline = shotlocker.checkpoint.Deadline(context)
+
+    # the legacy policy statements are only dropped when no object failed in any invocation
+    summary = shotlocker.bucket.migrate_shot_locker_bucket_access_tags(bucket,
+                                                                      s3_client=s3_client,
+                                                                      tag_s3_client=tag_s3_client,
+                                                                      stop_fn=deadline.expired,
+                                                                      start_after=state['cursor'],
+                                                                      drop_legacy=not state['failed'])
+
+    for s3_uri, error in summary.failed.items():
+        print(f"ERROR: unable to migrate the access tokens of {s3_uri}: {error}")
+
+    state['succeeded'] += summary.succeeded
+    state['skipped'] += summary.skipped
+    state['retried'] += summary.retried
+    state['failed'].update(summary.failed)
+    if summary.last_key:
+        state['cursor'] = summary.last_key
+
+    if summary.stopped:
+        checkpoint_key = shotlocker.checkpoint.get_checkpoint_key(f'migrate-access-tags-{bucket}')
+        shotlocker.checkpoint.write_checkpoint(state, bucket, checkpoint_key, s3_client=s3_client)
+        print(f"Out of time, continuing after {state['cursor']} in bucket {bucket}")
+        return shotlocker.checkpoint.set_continuation(event, checkpoint_key)
+
+    if checkpoint_key:
+        shotlocker.checkpoint.delete_checkpoint(bucket, checkpoint_key, s3_client=s3_client)
+
+    print(f"Migrated the access tokens of {state['succeeded']} objects in bucket {bucket}, "
+          f"{state['skipped']} unchanged, {len(state['failed'])} failed")
+    if state['failed']:
+        print(f"Legacy bucket policy statements of bucket {bucket} are kept, run the migration again")
+
+    event['migrate_access_tags'] = {
+        'succeeded': state['succeeded'],
+        'skipped': state['skipped'],
+        'retried': state['retried'],
+        'failed': len(state['failed']),
+        'legacy_statements_dropped': not state['failed'],
+    }
+
+    return shotlocker.checkpoint.set_continuation(event)
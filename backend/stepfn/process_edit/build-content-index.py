@@ -0,0 +1,61 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import time
+
+import shotlocker
+import shotlocker.content_index
+from shotlocker.log import log_entry, buffered_log_entries
+
+
+@buffered_log_entries()
+def lambda_handler(event, context):
+    """
+    Build the content lake index used to conform the edit when it is missing or too old,
+    returns with continue set when it ran out of time
+    """
+    bucket = event['bucket']
+    edit_id = event['edit_id']
+
+    # option: look up media in the content lake index instead of listing the bucket
+    use_content_index = event.get('use_content_index', True)
+
+    # option: rebuild the content lake index from a full listing when it is older than
+    # this many seconds, in case object events were missed
+    content_index_max_age = event.get('content_index_max_age', shotlocker.content_index.CONTENT_INDEX_MAX_AGE)
+
+    if not use_content_index:
+        return shotlocker.checkpoint.set_continuation(event)
+
+    s3_client = shotlocker.clients.get_client('s3')
+
+    # the index lock held by the build continued from the previous invocation
+    owner = event.pop('content_index_owner', None)
+
+    if not owner:
+        index = shotlocker.content_index.read_content_index(bucket, s3_client=s3_client)
+        if index and shotlocker.content_index.is_content_index_current(index, content_index_max_age):
+            return shotlocker.checkpoint.set_continuation(event)
+        log_entry(edit_id, 'Content lake index build started')
+
+    start_time = time.time()
+
+    deadline = shotlocker.checkpoint.Deadline(context)
+
+    result = shotlocker.content_index.build_content_index(bucket,
+                                                          owner=owner,
+                                                          s3_client=s3_client,
+                                                          stop_fn=deadline.expired)
+
+    if result['status'] == 'stopped':
+        event['content_index_owner'] = result['owner']
+        return shotlocker.checkpoint.set_continuation(event, shotlocker.content_index.CONTENT_INDEX_BUILD_PREFIX + 'manifest.json')
+
+    if result['status'] == 'locked':
+        # conform uses the index built by the other invocation, or lists the content lake
+        log_entry(edit_id, 'Content lake index is being built by another edit')
+    else:
+        end_time = time.time()
+        log_entry(edit_id, f"Content lake index built ({result['index'].count} objects, {round(end_time-start_time)} seconds)")
+
+    return shotlocker.checkpoint.set_continuation(event)
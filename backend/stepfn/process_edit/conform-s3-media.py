@@ -5,75 +5,55 @@
 
 import os
 import time
+import contextlib
 import urllib
 import urllib.parse
-from shotlocker.log import log_entry
+from shotlocker.log import log_entry, buffered_log_entries
 from shotlocker.cwprint import cwprint_exc
 from shotlocker.s3_utils import read_json_from_s3, write_json_to_s3
 import shotlocker.s3_utils
 import shotlocker.otio
-import boto3
+import shotlocker.content_index
+import shotlocker.media_match
+import shotlocker.clients
 import opentimelineio as otio
 
 
-s3_client = boto3.client('s3')
+s3_client = shotlocker.clients.get_client('s3')
 
 
-def _find_media_in_content_lake(bucket, media_files, first_frame_files):
-
-    def _content_lake_objects(object_list):
-        nonlocal bucket
-        nonlocal media_files
-        nonlocal first_frame_files
-
-        for object in object_list:
-
-            fullpath = f's3://{bucket}/{object}'
-            base = os.path.basename(object)
-
-            if base in media_files and not media_files[base]:
-                # if found the file and not yet saved it
-                media_files[base] = fullpath
-            elif base in first_frame_files:
-                # if the file a first frame of a frame range?
-                if not media_files[first_frame_files[base]]:
-                    media_files[first_frame_files[base]] = os.path.dirname(fullpath) + "/" + first_frame_files[base]
-
-    shotlocker.s3_utils.list_all_objects(bucket, 
-                                         s3_client=s3_client, 
-                                         names_only=True, 
-                                         recursive=True, 
-                                         content_callback_fn=_content_lake_objects)
-
-
-def _find_media_root_in_content_lake(bucket, media_files, media_files_root):
+def _find_media_in_content_lake(bucket, media_files, first_frame_files, media_files_root, *, parallel=False):
     """ 
-    Find media files that have the same root base name but different extensions. Only run
-    after not finding the matching full base name.
+    Find the media files with a single listing of the content lake, the listing stops
+    as soon as every media file has an exact match
     """
+    matcher = shotlocker.media_match.MediaMatcher(bucket, media_files, first_frame_files, media_files_root)
 
-    def _content_lake_objects(object_list):
-        nonlocal bucket
-        nonlocal media_files
-        nonlocal media_files_root
+    pages = shotlocker.s3_utils.iter_pages(bucket, 
+                                           s3_client=s3_client, 
+                                           names_only=True, 
+                                           recursive=True, 
+                                           parallel=parallel)
 
-        for object in object_list:
+    with contextlib.closing(pages):
+        for page in pages:
+            if matcher.match_objects(page):
+                break
 
-            fullpath = f's3://{bucket}/{object}'
-            base = os.path.basename(object)
-            root, _ = os.path.splitext(base)
+    matcher.finish()
 
-            if root in media_files_root and not media_files[media_files_root[root]]:
-                # if found a media file with different extension 
-                media_files[media_files_root[root]] = fullpath
 
-    shotlocker.s3_utils.list_all_objects(bucket, 
-                                         s3_client=s3_client, 
-                                         names_only=True, 
-                                         recursive=True, 
-                                         content_callback_fn=_content_lake_objects)
+def _find_media_in_content_index(index, bucket, media_files, first_frame_files, media_files_root):
+    """
+    Look up the media files in the content lake index instead of listing the bucket.
+    The lowest sorting key wins, the same file the bucket listing would find first.
+    """
+    matcher = shotlocker.media_match.MediaMatcher(bucket, media_files, first_frame_files, media_files_root)
+    matcher.match_content_index(index)
+    matcher.finish()
 
 
+@buffered_log_entries()
 def lambda_handler(event, context):
 
     bucket = event['bucket']
@@ -87,6 +67,16 @@ def lambda_handler(event, context):
     # option: replace any external references that are missing with missing references
     replace_missing = event.get('replace_missing', True)
 
+    # option: look up media in the content lake index instead of listing the bucket
+    use_content_index = event.get('use_content_index', True)
+
+    # option: rebuild the content lake index from a full listing when it is older than
+    # this many seconds, in case object events were missed
+    content_index_max_age = event.get('content_index_max_age', shotlocker.content_index.CONTENT_INDEX_MAX_AGE)
+
+    # option: list the content lake with concurrent requests
+    parallel_listing = event.get('parallel_listing', True)
+
     start_time = time.time()
 
     try:
@@ -174,12 +164,24 @@ def lambda_handler(event, context):
         log_entry(edit_id, f'Warning: All media references ({total}) already reference Amazon S3')
         return event
 
-    # find the media in the content lake
-    _find_media_in_content_lake(bucket, media_files, first_frame_files)
-
-    # if some of the media files have not been found, try searching for the media base name root
-    if not all(media_files.values()):
-        _find_media_root_in_content_lake(bucket, media_files, root_media_files)
+    # find the media in the content lake, the index is built by the step before
+    index = None
+    if use_content_index:
+        index = shotlocker.content_index.get_content_index(bucket, 
+                                                           s3_client=s3_client, 
+                                                           build=False)
+        if not index:
+            log_entry(edit_id, 'Content lake index is being built, listing the content lake')
+        elif not shotlocker.content_index.is_content_index_current(index, content_index_max_age):
+            log_entry(edit_id, 'Content lake index is being rebuilt, using the current index')
+
+    if index:
+        watermark = shotlocker.content_index.get_content_index_watermark(index)
+        log_entry(edit_id, f'Using content lake index ({index.count} objects, current to {watermark})')
+        _find_media_in_content_index(index, bucket, media_files, first_frame_files, root_media_files)
+    else:
+        _find_media_in_content_lake(bucket, media_files, first_frame_files, root_media_files, 
+                                    parallel=parallel_listing)
 
     # replace the clip filenames with one in the content lake
     replaced_with_missing = {}
@@ -3,16 +3,18 @@
 
 import os
 import tempfile
-import boto3
-from shotlocker.log import log_entry
+import shotlocker.clients
+import shotlocker.catalog
+from shotlocker.log import log_entry, buffered_log_entries
 from shotlocker.cwprint import cwprint_exc
 from shotlocker.s3_utils import read_json_from_s3, write_json_to_s3
 import opentimelineio as otio
 
 
-s3_client = boto3.client('s3')
+s3_client = shotlocker.clients.get_client('s3')
 
 
+@buffered_log_entries()
 def lambda_handler(event, context):
     bucket = event['bucket']
     key = event['key']
@@ -74,6 +76,9 @@ def lambda_handler(event, context):
     except:
         log_entry(edit_id, f"ERROR: unable to write results.json")
 
+    if not shotlocker.catalog.update_catalog_edit(bucket, edit_id, manifest=os.path.basename(new_key), s3_client=s3_client):
+        log_entry(edit_id, f"ERROR: unable to update the edit catalog")
+
     event['original_key'] = key
     event['key'] = new_key
 
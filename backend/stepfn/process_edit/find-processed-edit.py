@@ -13,7 +13,7 @@ def lambda_handler(event, context):
         raise ValueError("Missing required parameters")
 
     if not key:
-        results = shotlocker.edit.get_shot_locker_bucket_edit_info(bucket, edit_id, as_s3_uri=False)
+        results = shotlocker.edit.resolve_edit(bucket, edit_id, as_s3_uri=False, process_status=False)
         event['key'] = results['manifest']
 
     return event
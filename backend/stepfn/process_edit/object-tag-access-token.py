@@ -5,25 +5,29 @@ import time
 
 from concurrent.futures import ThreadPoolExecutor
 
-import boto3
 import opentimelineio as otio
 import shotlocker
 import shotlocker.otio
-from shotlocker.log import log_entry
-from shotlocker.cwprint import cwprint_exc
-from shotlocker.s3_utils import read_json_from_s3, write_json_to_s3
+import shotlocker.frame_range
+from shotlocker.log import log_entry, buffered_log_entries
+from shotlocker.cwprint import cwprint, cwprint_exc
 
 
+@buffered_log_entries()
 def lambda_handler(event, context):
-
+    """
+    Expand the edit into the objects to tag and split them into shards, the shards
+    are tagged by ShotLocker-S3-Object-Tag-Shard and merged by ShotLocker-S3-Object-Tag-Reduce
+    """
     bucket = event['bucket']
     key = event['key']
     edit_id = event['edit_id']
-    results_key = event.get('results_key')
-    
+
     # option: add or remove tags
     mode = event.get('mode', 'add')
-    add_access_token = mode == "add"
+
+    # option: objects tagged by each shard worker
+    shard_size = int(event.get('tag_shard_size', shotlocker.tag_shards.TAG_SHARD_SIZE))
 
     start_time = time.time()
 
@@ -33,14 +37,134 @@ def lambda_handler(event, context):
         msg = f'object-tag-access-token: missing required fields'
         raise ValueError(msg)
 
-    s3_client = boto3.client('s3')
+    # option: only tag the objects not already tagged by an earlier run and untag
+    # the objects the edit no longer uses, from the token index of the edit
+    delta = event.get('delta', True)
+
+    # option: read the tags of the objects the token index records as tagged, so the
+    # objects untagged since (e.g. by a bucket disable) are tagged again
+    verify_delta = event.get('verify_delta', True)
+
+    s3_client = shotlocker.clients.get_client('s3')
+
+    state = None
+    stale = []
+    if delta and mode != 'add':
+        # the objects to untag are the ones recorded as tagged, no need to expand the edit
+        state = _get_indexed_files(event, s3_client)
+
+    if state is None:
+        state = _expand_edit_files(event, s3_client)
+
+        # the objects of the prefix grants are still used by the edit, not stale
+        files_granted = state.pop('files_granted', [])
+
+        if delta and mode == 'add':
+            tag_delta = shotlocker.tag_shards.get_tag_delta(bucket, 
+                                                            edit_id, 
+                                                            state['files_tagged'], 
+                                                            keep=files_granted, 
+                                                            verify=verify_delta, 
+                                                            s3_client=s3_client)
+            if tag_delta:
+                state['files_tagged'], stale, state['tag_delta'] = tag_delta
+                state['tag_plan']['planned'] = len(state['files_tagged'])
+                log_entry(edit_id, f"Files already tagged: {state['tag_delta']['in_place']} no longer used: {len(stale)}")
+
+    if mode == 'add':
+        # new objects are tagged in the tag picked from the token hash, grant on it too
+        # when the statements of the edit were written before the tokens were spread
+        policy = shotlocker.bucket_policy.get_shot_locker_bucket_policy_as_json(bucket, s3_client=s3_client)
+        shotlocker.bucket_policy.migrate_shot_locker_bucket_policy(bucket, 
+                                                                  policy, 
+                                                                  keep_legacy=True, 
+                                                                  access_token=edit_id, 
+                                                                  s3_client=s3_client)
+
+    shards = shotlocker.tag_shards.write_tag_shards(bucket, 
+                                                    edit_id, 
+                                                    mode, 
+                                                    state, 
+                                                    shard_size=shard_size, 
+                                                    s3_client=s3_client)
+
+    if stale:
+        shards += shotlocker.tag_shards.write_tag_shards(bucket, 
+                                                         edit_id, 
+                                                         'remove', 
+                                                         _get_tag_state(stale), 
+                                                         shard_size=shard_size, 
+                                                         s3_client=s3_client)
+        event['tag_stale'] = True
+
+    end_time = time.time()
+
+    log_entry(edit_id, f"Total files to {mode} tag: {len(state['files_tagged'])} in {len(shards)} shards ({round(end_time-start_time)} seconds)")
+
+    event['mode'] = mode
+    event['tag_shards'] = shards
+
+    return event
 
-    results = {}
-    if results_key:
-        try:
-            results = read_json_from_s3(bucket, results_key, s3_client=s3_client)
-        except:
-            log_entry(edit_id, f"ERROR: unable to read results json")
+
+def _get_tag_state(files_to_tag):
+    """ @returns the tagging state of files_to_tag, without the edit file checks """
+    return {
+        'cursor': None,
+        'files_tagged': sorted(files_to_tag),
+        'total_files': len(files_to_tag),
+        'tag_plan': {
+            'planned': len(files_to_tag),
+            'written': 0,
+            'skipped': 0,
+            'failed': 0,
+            'retried': 0,
+        },
+        'tag_failed': {},
+    }
+
+
+def _get_indexed_files(event, s3_client):
+    """
+    @returns the tagging state of the objects the token index records as tagged,
+    or None when the edit has no token index (e.g. tagged before the index existed)
+    """
+    bucket = event['bucket']
+    edit_id = event['edit_id']
+
+    indexed_keys = shotlocker.token_index.read_token_index(bucket, edit_id, s3_client=s3_client)
+    if indexed_keys is None:
+        return None
+
+    state = _get_tag_state([f's3://{bucket}/{indexed_key}' for indexed_key in indexed_keys])
+    state['tag_delta'] = {
+        'indexed': len(indexed_keys),
+        'in_place': 0,
+        'stale': 0,
+        'verified': False,
+    }
+    log_entry(edit_id, f'Files recorded as tagged: {len(indexed_keys)}')
+    return state
+
+
+def _expand_edit_files(event, s3_client):
+    """
+    expand the media references of the edit into the objects to tag
+    @returns the tagging state
+    """
+    bucket = event['bucket']
+    key = event['key']
+    edit_id = event['edit_id']
+    add_access_token = event.get('mode', 'add') == "add"
+
+    # option: only tag the frames of an image sequence the clip uses plus handles,
+    # removing tags always covers the whole sequence so nothing is left tagged
+    trim_to_clip_range = event.get('trim_to_clip_range', False) and add_access_token
+    handle_frames = int(event.get('handle_frames', 8))
+
+    # option: grant the directories the edit uses every object of through the bucket
+    # policy rather than tagging their objects, objects added to them later are granted too
+    prefix_grants = event.get('prefix_grants', shotlocker.token_index.PREFIX_GRANTS_ENABLED) and add_access_token
 
     try:
         response = s3_client.get_object(Bucket=bucket, Key=key)
@@ -60,10 +184,15 @@ def lambda_handler(event, context):
         raise
 
     file_check = {}
+    trimmed_ranges = {}
 
     total_files = set()
     files_to_tag = set()
 
+    # (clip name, media reference) of each clip, edits reuse clip names for different
+    # media or trims, clips sharing a reference are expanded once
+    clip_filenames = []
+
     for clip in timeline.find_clips():
         name = clip.name
 
@@ -74,68 +203,116 @@ def lambda_handler(event, context):
         if not filename:
             continue
 
+        if trim_to_clip_range:
+            trimmed = _trim_to_clip_range(clip, filename, handle_frames)
+            if trimmed:
+                trimmed_ranges.setdefault(name, []).append({
+                    's3_uri': filename,
+                    'trimmed_s3_uri': trimmed,
+                    'handle_frames': handle_frames,
+                })
+                filename = trimmed
+
+        clip_filenames.append((name, filename))
+
+    # plan the listings first so references to the same sequence share a listing
+    listing_cache = shotlocker.s3_utils.ListingCache(s3_client=s3_client)
+    unique_filenames = {filename for name, filename in clip_filenames}
+    for filename in unique_filenames:
+        shotlocker.frame_range.plan_frame_range_listing(filename, listing_cache)
+
+    def _expand_filename(filename):
         try:
-            filenames = shotlocker.frame_range.expand_filename_frame_range(
+            return shotlocker.frame_range.expand_filename_frame_range(
                 filename,
                 s3_client=s3_client, 
-                check_exist=True)
+                check_exist=True,
+                listing_cache=listing_cache)
         except Exception as e:
+            cwprint_exc(f'Error: Unable to expand file {filename}')
+            return e
+
+    with ThreadPoolExecutor(max_workers=shotlocker.clients.MAX_WORKERS) as executor:
+        expanded = dict(zip(unique_filenames, executor.map(_expand_filename, unique_filenames)))
+
+    for name, filename in clip_filenames:
+        # clips with the same name merge their file checks
+        check = file_check.setdefault(name, [])
+
+        filenames = expanded[filename]
+        if isinstance(filenames, Exception):
+            e = filenames
             msg = f'Error: Clip {name} - Unable to expand file {filename}'
             log_entry(edit_id, msg)
             log_entry(edit_id, f'Error {e}')
 
-            cwprint_exc(msg)
-
-            file_check[name] = [{
+            check.append({
                 'exists': False, 
                 's3_uri': None,
-            }]
+            })
             continue
 
-        print(f'{name} - {filename} - {len(filenames)} files')
+        cwprint(f'{name} - {filename} - {len(filenames)} files')
         total_files.update(filenames)
 
-        check = []
+        checked = {c['s3_uri'] for c in check}
         for s3_uri,exists in filenames:
-            check.append({
-                'exists': exists, 
-                's3_uri': s3_uri,
-            })
+            if s3_uri not in checked:
+                checked.add(s3_uri)
+                check.append({
+                    'exists': exists, 
+                    's3_uri': s3_uri,
+                })
             if exists:
                 files_to_tag.add(s3_uri)
 
-        file_check[name] = check
-
-    def _add_access_token(s3_uri, access_token, s3_client):
-        shotlocker.object_tag.add_access_token_to_shot_locker_tag(s3_uri, access_token, s3_client=s3_client) 
-
-    def _remove_access_token(s3_uri, access_token, s3_client):
-        if shotlocker.object_tag.remove_access_token_from_shot_locker_tag(s3_uri, access_token, s3_client=s3_client):
-            print(f"Removed access token {access_token} from {s3_uri}")
-
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        for s3_uri in files_to_tag:
-            print(f"Object {mode} tag {s3_uri}")
-            if add_access_token:
-                executor.submit(_add_access_token, s3_uri, edit_id, s3_client) 
-            else:
-                executor.submit(_remove_access_token, s3_uri, edit_id, s3_client) 
-
-    end_time = time.time()
-
-    log_entry(edit_id, f'Total files to {mode} tag: {len(total_files)}')
-    log_entry(edit_id, f'Total files tagged: {len(files_to_tag)}')
-    log_entry(edit_id, f'Tagging ({mode}) Amazon S3 objects completed ({round(end_time-start_time)} seconds)')
-
-    # write the file check results
-    results['object_tag'] = file_check
-    results['files_tagged'] = list(files_to_tag)
-    if results_key:
-        try:
-            write_json_to_s3(results, bucket, results_key, s3_client=s3_client)
-        except:
-            log_entry(edit_id, f"ERROR: unable to write results.json")
-
-    return event
-
- 
+    if not add_access_token:
+        # also untag the objects indexed for the token, e.g. frames tagged by an
+        # earlier version of the edit that its current references no longer cover
+        indexed_keys = shotlocker.token_index.read_token_index(bucket, edit_id, s3_client=s3_client)
+        if indexed_keys:
+            files_to_tag.update(f's3://{bucket}/{indexed_key}' for indexed_key in indexed_keys)
+
+    granted = None
+    if prefix_grants:
+        prefixes, list_requests = shotlocker.token_index.find_prefix_grants(bucket, files_to_tag, s3_client=s3_client)
+        granted_files = {s3_uri for s3_uri in files_to_tag
+                         if any(s3_uri.startswith(f's3://{bucket}/{prefix}') for prefix in prefixes)}
+        files_to_tag.difference_update(granted_files)
+        granted = {
+            'prefixes': prefixes,
+            'objects': len(granted_files),
+            'list_requests': list_requests,
+            'saved_requests': len(granted_files) * shotlocker.token_index.TAG_REQUESTS_PER_OBJECT - list_requests,
+        }
+        for prefix in prefixes:
+            log_entry(edit_id, f'Granting s3://{bucket}/{prefix} as a whole, its objects are not tagged')
+
+    state = _get_tag_state(files_to_tag)
+    state['object_tag'] = file_check
+    state['total_files'] = len(total_files)
+    state['listing_cache'] = listing_cache.get_stats()
+    if trim_to_clip_range:
+        state['object_tag_trimmed'] = trimmed_ranges
+    if granted is not None:
+        state['prefix_grants'] = granted
+        state['files_granted'] = sorted(granted_files)
+
+    return state
+
+
+def _trim_to_clip_range(clip, filename, handle_frames):
+    """
+    @returns the frame range filename trimmed to the frames the clip uses, or None
+    if it is not a frame range or the used frames can not be mapped to it
+    """
+    frames = shotlocker.frame_range.frame_ranges(filename)
+    if not frames:
+        return None
+
+    first_frame, last_frame = frames[0], frames[1] - 1
+    used = shotlocker.otio.get_clip_frame_range(clip, first_frame, last_frame, handles=handle_frames)
+    if not used or used == (first_frame, last_frame):
+        return None
+
+    return shotlocker.frame_range.set_frame_range(filename, *used)
@@ -0,0 +1,110 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import shotlocker
+from shotlocker.log import log_entry, buffered_log_entries
+from shotlocker.s3_utils import read_json_from_s3, write_json_to_s3
+
+
+@buffered_log_entries()
+def lambda_handler(event, context):
+    """ merge the shard results of the edit tagging into results.json """
+    bucket = event['bucket']
+    edit_id = event['edit_id']
+    results_key = event.get('results_key')
+    mode = event.get('mode', 'add')
+
+    s3_client = shotlocker.clients.get_client('s3')
+
+    state = shotlocker.tag_shards.reduce_tag_shards(bucket, edit_id, mode, s3_client=s3_client)
+
+    if event.pop('tag_stale', False):
+        # objects tagged by an earlier run the edit no longer uses
+        stale_state = shotlocker.tag_shards.reduce_tag_shards(bucket, edit_id, 'remove', s3_client=s3_client)
+        stale_summary = stale_state['tag_plan']
+        state['tag_delta']['stale_removed'] = stale_summary['written']
+        state['tag_delta']['stale_failed'] = stale_summary['failed']
+        state['token_index'] = stale_state['token_index']
+        log_entry(edit_id, f"Tags removed from files no longer used: {stale_summary['written']} written {stale_summary['failed']} failed")
+
+    if 'tag_delta' in state and mode == 'add':
+        # the objects already tagged are not in the shards, the index records them all
+        indexed_keys = shotlocker.token_index.read_token_index(bucket, edit_id, s3_client=s3_client) or []
+        state['files_tagged'] = [f's3://{bucket}/{indexed_key}' for indexed_key in indexed_keys]
+
+    if mode == 'add':
+        _set_prefix_grants(bucket, edit_id, state.get('prefix_grants'), s3_client)
+    else:
+        # remove-bucket-access already removed the prefix statements of the edit
+        shotlocker.token_index.delete_prefix_grants(bucket, edit_id, s3_client=s3_client)
+
+    tag_summary = state['tag_plan']
+    log_entry(edit_id, f"Total files to {mode} tag: {state['total_files']}")
+    log_entry(edit_id, f"Total files tagged: {len(state['files_tagged'])}")
+    log_entry(edit_id, f"Tag writes: {tag_summary['written']} written {tag_summary['skipped']} unchanged {tag_summary['failed']} failed")
+
+    if 'listing_cache' in state:
+        listing_stats = state['listing_cache']
+        log_entry(edit_id, f"Listing cache: {listing_stats['hits']} hits {listing_stats['misses']} misses")
+    if 'prefix_grants' in state:
+        prefix_grants = state['prefix_grants']
+        log_entry(edit_id, f"Prefix grants: {len(prefix_grants['prefixes'])} directories {prefix_grants['objects']} objects not tagged, {prefix_grants['saved_requests']} requests saved")
+    if 'tag_delta' in state:
+        log_entry(edit_id, f"Files already tagged: {state['tag_delta']['in_place']}")
+    if 'token_index' in state:
+        log_entry(edit_id, f"Objects in the token index: {state['token_index']['count']}")
+    if 'object_tag_trimmed' in state:
+        log_entry(edit_id, f"Clips trimmed to their used frame range: {sum(len(trimmed) for trimmed in state['object_tag_trimmed'].values())}")
+    log_entry(edit_id, f'Tagging ({mode}) Amazon S3 objects completed')
+
+    results = {}
+    if results_key:
+        try:
+            results = read_json_from_s3(bucket, results_key, s3_client=s3_client)
+        except:
+            log_entry(edit_id, f"ERROR: unable to read results json")
+
+    # write the file check results, untagging from the token index does not check the edit files
+    if 'object_tag' in state:
+        results['object_tag'] = state['object_tag']
+    if 'object_tag_trimmed' in state:
+        results['object_tag_trimmed'] = state['object_tag_trimmed']
+    results['files_tagged'] = state['files_tagged']
+    if 'listing_cache' in state:
+        results['listing_cache'] = state['listing_cache']
+    results['tag_plan'] = tag_summary
+    if 'tag_delta' in state:
+        results['tag_delta'] = state['tag_delta']
+    # failed objects, tagging the edit again only writes the objects still to change
+    results['tag_failed'] = state['tag_failed']
+    if 'token_index' in state:
+        results['token_index'] = state['token_index']
+    if 'prefix_grants' in state:
+        results['prefix_grants'] = state['prefix_grants']
+    if results_key:
+        try:
+            write_json_to_s3(results, bucket, results_key, s3_client=s3_client)
+        except:
+            log_entry(edit_id, f"ERROR: unable to write results.json")
+
+    if 'original_key' in event:
+        # the tagging of an uploaded edit is the last step of its processing
+        if not shotlocker.catalog.update_catalog_edit(bucket, edit_id, process_status='SUCCEEDED', s3_client=s3_client):
+            log_entry(edit_id, f"ERROR: unable to update the edit catalog")
+
+    # the shard list is not needed by the next steps
+    event.pop('tag_shards', None)
+
+    return event
+
+
+def _set_prefix_grants(bucket, edit_id, prefix_grants, s3_client):
+    """ record the prefixes granted to the edit and grant them to its users """
+    prefixes = prefix_grants['prefixes'] if prefix_grants else []
+    previous = shotlocker.token_index.read_prefix_grants(bucket, edit_id, s3_client=s3_client)
+    if not prefixes and not previous:
+        return
+
+    shotlocker.token_index.write_prefix_grants(bucket, edit_id, prefixes, s3_client=s3_client)
+    policy = shotlocker.bucket_policy.get_shot_locker_bucket_policy_as_json(bucket, s3_client=s3_client)
+    shotlocker.bucket_policy.set_shot_locker_prefix_grants(bucket, policy, edit_id, prefixes, s3_client=s3_client)
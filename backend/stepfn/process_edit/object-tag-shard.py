@@ -0,0 +1,41 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import shotlocker
+from shotlocker.log import log_entry, buffered_log_entries
+
+
+@buffered_log_entries()
+def lambda_handler(event, context):
+    """ tag the objects of one shard, returns with continue set when it ran out of time """
+    bucket = event['bucket']
+    edit_id = event['edit_id']
+    shard_key = event['shard_key']
+    mode = event.get('mode', 'add')
+
+    s3_client = shotlocker.clients.get_client('s3')
+    # the tag requests are retried by the work queue, paced by the concurrency controller
+    tag_s3_client = shotlocker.clients.get_client('s3', **shotlocker.clients.CONCURRENCY_CONFIG_OPTIONS)
+
+    concurrency = shotlocker.concurrency.AdaptiveConcurrency()
+    deadline = shotlocker.checkpoint.Deadline(context)
+
+    result = shotlocker.tag_shards.tag_shard(bucket, 
+                                             shard_key, 
+                                             edit_id, 
+                                             add=mode == 'add', 
+                                             s3_client=s3_client, 
+                                             tag_s3_client=tag_s3_client, 
+                                             concurrency=concurrency, 
+                                             stop_fn=deadline.expired)
+
+    for s3_uri, error in result['failed'].items():
+        log_entry(edit_id, f'ERROR: unable to {mode} tag {s3_uri}: {error}')
+
+    print(f"Shard {shard_key}: {result['written']} written {result['skipped']} unchanged {len(result['failed'])} failed")
+    print(f'Tag request concurrency {concurrency.get_stats()}')
+
+    if not result['done']:
+        return shotlocker.checkpoint.set_continuation(event, shotlocker.tag_shards.get_shard_result_key(shard_key))
+
+    return shotlocker.checkpoint.set_continuation(event)
@@ -4,10 +4,11 @@
 import os
 import datetime
 import shotlocker
-from shotlocker.log import log_entry
+from shotlocker.log import log_entry, buffered_log_entries
 from shotlocker.s3_utils import write_json_to_s3
 
 
+@buffered_log_entries()
 def lambda_handler(event, context):
 
     bucket = event['bucket']
@@ -48,4 +49,12 @@ def lambda_handler(event, context):
     except:
         log_entry(edit_id, f"ERROR: unable to write results.json")
 
+    if not shotlocker.catalog.update_catalog_edit(bucket, edit_id,
+                                                  original=os.path.basename(key),
+                                                  results=os.path.basename(results_key),
+                                                  create_time=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                                                  active=True,
+                                                  process_status='RUNNING'):
+        log_entry(edit_id, f"ERROR: unable to update the edit catalog")
+
     return event
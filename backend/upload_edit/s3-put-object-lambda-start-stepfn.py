@@ -3,15 +3,15 @@
 
 import json
 import urllib.parse
-import boto3
 import shotlocker
-from shotlocker.log import log_entry
+from shotlocker.log import log_entry, buffered_log_entries
 from shotlocker.cwprint import cwprint_exc
 
 
-sfn_client = boto3.client('stepfunctions')
+sfn_client = shotlocker.clients.get_client('stepfunctions')
 
 
+@buffered_log_entries()
 def lambda_handler(event, context):
 
     # Get the object from the event and show its content type